@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: backfill.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for backfill
+
+Builds a playlist out of the votes in the past history of a channel.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import os
+
+from pipeline import sanitize_title
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''backfill'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class Backfill(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Resumable backfill of a playlist from the history of a channel
+
+    It goes through three steps: collecting the votes of every link in the
+    history, page by page, resolving the titles that got enough votes in
+    parallel batches, and adding the tracks to the playlist. The progress is
+    saved to a cursor file after every page and batch, so an interrupted
+    backfill carries on where it stopped. A finished backfill run again
+    only collects the messages posted since. The cursor is only used with
+    the channel, reaction, count and start it was saved with.
+    """
+
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 channel,
+                 spotify,
+                 playlist,
+                 config,
+                 cursor_path,
+                 since=0,
+                 batch_size=50,
+                 max_workers=4):
+        """
+        Initialise object
+
+        Args:
+            channel: Channel or Group object
+            spotify: SpotifyClient object
+            playlist: Playlist object
+            config: SlackSound namedtuple
+            cursor_path: string, file the progress is saved to
+            since: float, unix time of the oldest message to consider
+            batch_size: integer, titles resolved per batch
+            max_workers: integer, searches running at the same time
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._channel = channel
+        self._spotify = spotify
+        self._playlist = playlist
+        self._config = config
+        self._cursor_path = cursor_path
+        self._batch_size = batch_size
+        self._max_workers = max_workers
+        parameters = {'channel': channel.name,
+                      'reaction': config.reaction,
+                      'count': config.count,
+                      'since': since}
+        self._cursor = {'parameters': parameters,
+                        'oldest': since,
+                        'latest': None,
+                        'newest': None,
+                        'collected': False,
+                        'votes': {},
+                        'resolved': {}}
+        if os.path.isfile(cursor_path):
+            with open(cursor_path) as cursor_file:
+                cursor = json.load(cursor_file)
+            if cursor.get('parameters') == parameters:
+                self._cursor.update(cursor)
+                self._logger.info('Resuming backfill from %s', cursor_path)
+            else:
+                self._logger.warning('Backfill %s was saved for %s, starting over',
+                                     cursor_path, cursor.get('parameters'))
+
+    def run(self, top=None):
+        """
+        Runs or resumes the backfill
+
+        Args:
+            top: integer, most voted tracks to add, all if not given
+
+        Returns: list of track IDs added
+
+        """
+        if self._cursor['collected'] and self._cursor['newest']:
+            self._logger.info('Collecting the history posted since the last backfill')
+            self._cursor.update({'oldest': self._cursor['newest'],
+                                 'latest': None,
+                                 'collected': False})
+        if not self._cursor['collected']:
+            self.collect()
+        self.resolve()
+        return self.write(top)
+
+    def collect(self):
+        """Counts the votes of every link in the history, page by page"""
+        votes = self._cursor['votes']
+        for page in self._channel.iter_history_pages(oldest=self._cursor['oldest'],
+                                                     latest=self._cursor['latest']):
+            for message in page:
+                count = sum(reaction.count for reaction in message.reaction
+                            if reaction.name == self._config.reaction)
+                if count < self._config.count:
+                    continue
+                for attachment in message.attachments:
+                    if attachment.title:
+                        title = sanitize_title(attachment.title)
+                        votes[title] = max(votes.get(title, 0), count)
+            self._cursor['latest'] = page[-1].ts
+            if not self._cursor['newest'] or float(page[0].ts) > float(self._cursor['newest']):
+                self._cursor['newest'] = page[0].ts
+            self._save()
+            self._logger.info('Collected history up to %s, %s titles voted',
+                              page[-1].datetime, len(votes))
+        self._cursor['collected'] = True
+        self._save()
+
+    def resolve(self):
+        """Resolves the voted titles not resolved yet, in parallel batches"""
+        resolved = self._cursor['resolved']
+        pending = [title for title in self._cursor['votes'] if title not in resolved]
+        for start in range(0, len(pending), self._batch_size):
+            batch = pending[start:start + self._batch_size]
+            tracks = self._spotify.get_tracks_by_titles(batch,
+                                                        max_workers=self._max_workers)
+            for title, track in tracks.items():
+                resolved[title] = track.track_id if track else None
+            self._save()
+            self._logger.info('Resolved %s of %s titles',
+                              min(start + self._batch_size, len(pending)), len(pending))
+
+    def write(self, top=None):
+        """
+        Adds the most voted tracks missing from the playlist
+
+        Args:
+            top: integer, most voted tracks to add, all if not given
+
+        Returns: list of track IDs added
+
+        """
+        votes = self._cursor['votes']
+        resolved = self._cursor['resolved']
+        ranked = sorted((title for title in votes if resolved.get(title)),
+                        key=lambda title: votes[title],
+                        reverse=True)
+        present = set(track.track_id for track in self._playlist.iter_tracks())
+        track_ids = []
+        for title in ranked[:top]:
+            track_id = resolved[title]
+            if track_id not in present:
+                present.add(track_id)
+                track_ids.append(track_id)
+        if track_ids:
+            self._playlist.add_tracks(track_ids)
+        self._logger.info('Added %s tracks to playlist %s',
+                          len(track_ids), self._playlist.name)
+        return track_ids
+
+    def _save(self):
+        """Writes the cursor to a temporary file and moves it in place"""
+        temporary = '{}.tmp'.format(self._cursor_path)
+        with open(temporary, 'w') as cursor_file:
+            json.dump(self._cursor, cursor_file)
+        os.rename(temporary, self._cursor_path)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: budget.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for budget
+
+Keeps the playlist of a session within a total duration.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import itertools
+import logging
+import threading
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''budget'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class DurationBudget(object):
+    """
+    Running total of the duration of the playlist
+
+    Every track is kept with its score, the votes it got. When a new track
+    does not fit, tracks scored lower than it make room for it, the lowest
+    scores first and the oldest first among equal scores. A track that
+    can't fit that way is not admitted. Tracks that were in the playlist
+    before the session score 0, like the ones someone else adds to it
+    while it runs.
+    """
+
+    def __init__(self, max_duration_ms, tracks=()):
+        """
+        Initialise object
+
+        Args:
+            max_duration_ms: integer, longest the playlist can play for
+            tracks: iterable of Track objects in the playlist already
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.max_duration_ms = max_duration_ms
+        self.total_ms = 0
+        self._order = itertools.count()
+        self._tracks = {}
+        self._lock = threading.RLock()
+        for track in tracks:
+            self._put(track.track_id, track.duration_ms, 0)
+
+    def _put(self, track_id, duration_ms, score):
+        self.discard(track_id)
+        self._tracks[track_id] = (score, next(self._order), duration_ms or 0)
+        self.total_ms += duration_ms or 0
+
+    def discard(self, track_id):
+        """
+        Takes a track out of the total, if it is there
+
+        Args:
+            track_id: string
+
+        """
+        with self._lock:
+            entry = self._tracks.pop(track_id, None)
+            if entry:
+                self.total_ms -= entry[2]
+
+    def rescore(self, track_id, score):
+        """
+        Updates the score of a track as its votes change
+
+        Args:
+            track_id: string
+            score: number, votes of the track
+
+        """
+        with self._lock:
+            entry = self._tracks.get(track_id)
+            if entry:
+                self._tracks[track_id] = (score,) + entry[1:]
+
+    def sync(self, tracks):
+        """
+        Matches the total with the tracks the playlist has now
+
+        The tracks still there keep their score and their place among equal
+        scores, and get the duration Spotify has for them. The ones taken out
+        of the playlist are dropped and the ones added by others score 0.
+
+        Args:
+            tracks: iterable of Track objects in the playlist
+
+        """
+        with self._lock:
+            previous = self._tracks
+            self._tracks = {}
+            self.total_ms = 0
+            for track in tracks:
+                entry = previous.get(track.track_id)
+                if entry:
+                    self._tracks[track.track_id] = (entry[0], entry[1], track.duration_ms or 0)
+                    self.total_ms += track.duration_ms or 0
+                else:
+                    self._put(track.track_id, track.duration_ms, 0)
+
+    def admit(self, track, score):
+        """
+        Adds a track to the total, making room for it if needed
+
+        Args:
+            track: Track object
+            score: number, votes of the track
+
+        Returns: list of the IDs of the tracks to remove from the playlist,
+            None if the track can't fit
+
+        """
+        with self._lock:
+            return self._admit(track, score)
+
+    def _admit(self, track, score):
+        duration_ms = track.duration_ms or 0
+        if duration_ms > self.max_duration_ms:
+            self._logger.info('Track %s is longer than %s minutes',
+                              track.name, self.max_duration_ms // 60000)
+            return None
+        evicted = []
+        excess = self.total_ms + duration_ms - self.max_duration_ms
+        if excess > 0:
+            for track_id, entry in sorted(self._tracks.items(), key=lambda item: item[1][:2]):
+                if excess <= 0 or entry[0] >= score:
+                    break
+                if not entry[2]:
+                    continue
+                evicted.append(track_id)
+                excess -= entry[2]
+        if excess > 0:
+            self._logger.info('No room for track %s in %s minutes, the other tracks scored higher',
+                              track.name, self.max_duration_ms // 60000)
+            return None
+        for track_id in evicted:
+            self.discard(track_id)
+        self._put(track.track_id, duration_ms, score)
+        if evicted:
+            self._logger.info('Removing %s tracks to fit %s in %s minutes',
+                              len(evicted), track.name, self.max_duration_ms // 60000)
+        return evicted
+
+    def __len__(self):
+        return len(self._tracks)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: cache.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for cache
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''cache'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class SQLiteCache(object):
+    """
+    Key value cache in a SQLite file
+
+    Every process on a host pointing to the same file shares the cached
+    entries. SQLite takes care of locking the file, and the write ahead log
+    lets readers go on while another process writes. Values are stored as
+    JSON under a namespace and expire after their time to live. Expired
+    entries are deleted when the cache is opened and then every
+    purge_interval seconds, on the next write.
+    """
+
+    def __init__(self, path, ttl=604800, purge_interval=3600):
+        """
+        Initialise object
+
+        Args:
+            path: string, location of the database file
+            ttl: float, default seconds entries are valid for
+            purge_interval: float, seconds between deletions of the expired entries
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._purged = 0
+        self._local = threading.local()
+        with self._connection as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS cache ('
+                               'namespace TEXT NOT NULL, '
+                               'key TEXT NOT NULL, '
+                               'value TEXT NOT NULL, '
+                               'expires REAL NOT NULL, '
+                               'PRIMARY KEY (namespace, key))')
+        self.purge()
+
+    @property
+    def _connection(self):
+        """
+        Connection of the current thread, as they can't be shared
+
+        Returns: Connection object
+
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, namespace, key):
+        """
+        Gets a value if it is cached and not expired
+
+        Args:
+            namespace: string
+            key: string
+
+        Returns: the cached value or None
+
+        """
+        row = self._connection.execute('SELECT value FROM cache '
+                                       'WHERE namespace = ? AND key = ? AND expires > ?',
+                                       (namespace, key, time.time())).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Caches a value
+
+        Args:
+            namespace: string
+            key: string
+            value: anything that can be serialised to JSON
+            ttl: float, seconds the value is valid for, defaults to the cache's
+
+        """
+        now = time.time()
+        with self._connection as connection:
+            connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                               (namespace, key, json.dumps(value),
+                                now + (self.ttl if ttl is None else ttl)))
+        if now - self._purged >= self.purge_interval:
+            self.purge()
+
+    def purge(self):
+        """
+        Deletes the expired entries
+
+        Returns: integer, number of entries deleted
+
+        """
+        self._purged = time.time()
+        with self._connection as connection:
+            cursor = connection.execute('DELETE FROM cache WHERE expires <= ?',
+                                        (self._purged,))
+        if cursor.rowcount:
+            self._logger.debug('Purged %s expired entries', cursor.rowcount)
+        return cursor.rowcount
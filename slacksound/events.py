@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: events.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for events
+
+Receives Slack's Events API callbacks as an alternative to polling history.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from collections import deque
+from six.moves import queue
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from slackapi import Message
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''events'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# Requests signed longer ago than this are rejected as replays
+MAX_SIGNATURE_AGE = 300
+
+EVENT_TYPES = ('message', 'reaction_added', 'reaction_removed')
+
+
+def verify_signature(signing_secret, timestamp, body, signature, now=None):
+    """
+    Checks that a request was signed by Slack
+
+    https://api.slack.com/authentication/verifying-requests-from-slack
+
+    Args:
+        signing_secret: string
+        timestamp: string, X-Slack-Request-Timestamp header
+        body: bytes, raw body of the request
+        signature: string, X-Slack-Signature header
+        now: float, unix time, defaults to the current time
+
+    Returns: boolean
+
+    """
+    try:
+        if abs((now or time.time()) - int(timestamp)) > MAX_SIGNATURE_AGE:
+            return False
+    except (TypeError, ValueError):
+        return False
+    base = b'v0:' + timestamp.encode('utf-8') + b':' + body
+    expected = 'v0=' + hmac.new(signing_secret.encode('utf-8'),
+                                base,
+                                hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+class EventStore(object):
+    """
+    Mirror of the messages of a channel kept up to date from events
+
+    Applying an event returns the message it changed, with its reactions and
+    attachments as they are after the event, ready for the vote pipeline.
+    """
+
+    def __init__(self, channel_id):
+        """
+        Initialise object
+
+        Args:
+            channel_id: string, events of other channels are ignored
+        """
+        self.channel_id = channel_id
+        self._messages = {}
+
+    def apply(self, event):
+        """
+        Applies an event to the mirror
+
+        Args:
+            event: dictionary, the inner event of an event callback
+
+        Returns: Message object changed by the event, or None
+
+        """
+        event_type = event.get('type')
+        if event_type == 'message':
+            return self._apply_message(event)
+        if event_type in ('reaction_added', 'reaction_removed'):
+            return self._apply_reaction(event)
+        return None
+
+    def _apply_message(self, event):
+        if event.get('channel') != self.channel_id:
+            return None
+        subtype = event.get('subtype')
+        if subtype == 'message_deleted':
+            self._messages.pop(event.get('deleted_ts'), None)
+            return None
+        if subtype == 'message_changed':
+            changed = event.get('message', {})
+            details = self._messages.setdefault(changed.get('ts'), {'reactions': []})
+            details.update(changed)
+        else:
+            details = self._messages.setdefault(event.get('ts'), {'reactions': []})
+            details.update(event)
+        return Message(details)
+
+    def _apply_reaction(self, event):
+        item = event.get('item', {})
+        if item.get('type') != 'message' or item.get('channel') != self.channel_id:
+            return None
+        details = self._messages.get(item.get('ts'))
+        if details is None:
+            return None
+        reactions = details.setdefault('reactions', [])
+        reaction = next((reaction for reaction in reactions
+                         if reaction.get('name') == event.get('reaction')), None)
+        user = event.get('user')
+        if event.get('type') == 'reaction_added':
+            if reaction is None:
+                reaction = {'name': event.get('reaction'), 'count': 0, 'users': []}
+                reactions.append(reaction)
+            if user not in reaction['users']:
+                reaction['users'].append(user)
+                reaction['count'] += 1
+        elif reaction is not None and user in reaction['users']:
+            reaction['users'].remove(user)
+            reaction['count'] -= 1
+            if not reaction['count']:
+                reactions.remove(reaction)
+        return Message(details)
+
+    def evict(self, oldest):
+        """
+        Forgets the messages older than a unix time
+
+        Args:
+            oldest: float
+
+        """
+        for timestamp in [timestamp for timestamp in self._messages
+                          if float(timestamp) < oldest]:
+            del self._messages[timestamp]
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class EventsReceiver(object):
+    """
+    Embedded HTTP endpoint for Slack's Events API
+
+    Every request is checked against the signing secret and acknowledged
+    with a 200 straight away; the events are only queued, for the vote loop
+    to apply at its own pace. Retries of events already queued are dropped.
+    """
+
+    def __init__(self, signing_secret, host='0.0.0.0', port=3000, max_queued=10000):
+        """
+        Initialise object
+
+        Args:
+            signing_secret: string, signing secret of the Slack app
+            host: string, address to listen on
+            port: integer, port to listen on
+            max_queued: integer, events queued at most before answering 503
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.signing_secret = signing_secret
+        self.events = queue.Queue(max_queued)
+        self._seen = deque(maxlen=1000)
+        self._seen_lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='EventsReceiver')
+        self._thread.daemon = True
+
+    @property
+    def address(self):
+        """
+        Address and port the receiver listens on
+
+        Returns: tuple
+
+        """
+        return self._server.server_address
+
+    def start(self):
+        """Starts serving on a background thread"""
+        self._logger.info('Listening for Slack events on %s:%s', *self.address)
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drain(self, timeout=1.0):
+        """
+        Gets the events queued, waiting for the first one up to a timeout
+
+        Args:
+            timeout: float, seconds
+
+        Returns: list of event dictionaries
+
+        """
+        try:
+            drained = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                drained.append(self.events.get_nowait())
+            except queue.Empty:
+                return drained
+
+    def accept(self, headers, body):
+        """
+        Handles the body of a request
+
+        Args:
+            headers: mapping of the request headers
+            body: bytes
+
+        Returns: tuple of HTTP status and response body
+
+        """
+        if not verify_signature(self.signing_secret,
+                                headers.get('X-Slack-Request-Timestamp'),
+                                body,
+                                headers.get('X-Slack-Signature')):
+            return 401, b''
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, b''
+        if payload.get('type') == 'url_verification':
+            return 200, payload.get('challenge', '').encode('utf-8')
+        event = payload.get('event', {})
+        if payload.get('type') != 'event_callback' or event.get('type') not in EVENT_TYPES:
+            return 200, b''
+        with self._seen_lock:
+            if payload.get('event_id') in self._seen:
+                return 200, b''
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                # Slack retries it later
+                self._logger.warning('Event queue full, refusing %s', payload.get('event_id'))
+                return 503, b''
+            self._seen.append(payload.get('event_id'))
+        return 200, b''
+
+    def _handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Request handler passing the requests to the receiver"""
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Answers a callback from Slack"""
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                status, response = receiver.accept(self.headers, body)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                receiver._logger.debug(format, *args)  # pylint: disable=protected-access
+
+        return Handler
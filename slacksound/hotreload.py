@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: hotreload.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for hotreload
+
+Notices changes of the configuration file while the bot runs.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import os
+import time
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''hotreload'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def options_changed(previous, current, section, *options):
+    """
+    Whether any of the options of a section differs between two configurations
+
+    Args:
+        previous: ConfigParser object
+        current: ConfigParser object
+        section: string
+        *options: strings
+
+    Returns: boolean
+
+    """
+    def value(config, option):
+        if config.has_option(section, option):
+            return config.get(section, option)
+        return None
+    return any(value(previous, option) != value(current, option) for option in options)
+
+
+class ConfigWatcher(object):
+    """
+    Polls the modification time of a configuration file
+
+    The file is read again only when its modification time or size change.
+    A file that can't be read is reported and ignored, the running
+    configuration is kept until the file is fixed.
+    """
+
+    def __init__(self, path, loader, interval=5.0):
+        """
+        Initialise object
+
+        Args:
+            path: string, location of the configuration file
+            loader: callable taking the path and returning a ConfigParser
+            interval: float, seconds between checks of the file
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.path = path
+        self.interval = interval
+        self._loader = loader
+        self._checked = time.time()
+        self._stamp = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def poll(self, now=None):
+        """
+        Reads the file again if it changed since the last time
+
+        Args:
+            now: float, unix time, defaults to the current time
+
+        Returns: ConfigParser object, None if the file did not change
+
+        """
+        now = time.time() if now is None else now
+        if now - self._checked < self.interval:
+            return None
+        self._checked = now
+        stamp = self._stat()
+        if stamp is None or stamp == self._stamp:
+            return None
+        self._stamp = stamp
+        try:
+            config = self._loader(self.path)
+        except (configparser.Error, IOError, OSError):
+            self._logger.exception('Could not read %s, keeping the running configuration',
+                                   self.path)
+            return None
+        self._logger.info('Configuration file %s changed', self.path)
+        return config
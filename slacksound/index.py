@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: index.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for index
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''index'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+MAGIC = b'SSTI'
+VERSION = 1
+# magic, version, number of slots, number of records
+HEADER = struct.Struct('<4sIII')
+# hash of the normalized title, record number plus one (0 is an empty slot)
+SLOT = struct.Struct('<QI')
+# track id, popularity, duration in milliseconds, ISRC
+RECORD = struct.Struct('<22sBI12s')
+
+
+def normalize_title(title):
+    """
+    Reduces a title to lowercase words without punctuation
+
+    Examples:
+        in: "Bon Jovi - Livin' On A Prayer"
+        out: 'bon jovi livin on a prayer'
+
+    Args:
+        title: string
+
+    Returns: string
+
+    """
+    return ' '.join(re.sub(r'[^\w\s]', '', title.lower(), flags=re.UNICODE).split())
+
+
+def title_hash(title):
+    """
+    Hash of a normalized title that is the same across processes
+
+    Args:
+        title: string
+
+    Returns: integer, never 0
+
+    """
+    digest = hashlib.md5(normalize_title(title).encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+
+class TrackIndex(object):
+    """
+    Memory mapped index of the track resolved for every title
+
+    The file holds a header, an open addressing hash table of title hashes
+    and a table of fixed width records with the id, popularity, duration and
+    ISRC of a track. Only the pages touched by a lookup are read from disk, so
+    the resident memory stays small however many titles are indexed. When
+    half of the slots are used the file is rebuilt with twice as many.
+
+    Only one process can write to an index at a time, it holds a lock on a
+    file next to it for as long as the index is open. Any number can open
+    it read only, those see the titles indexed up to when they opened it
+    and never add any. An index opened for writing while another writer
+    has it is opened read only instead.
+    """
+
+    def __init__(self, path, slots=4096, read_only=False):
+        """
+        Initialise object
+
+        Args:
+            path: string, location of the index file
+            slots: integer, number of slots of a new index
+            read_only: boolean, only look titles up, the file must exist
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._path = path
+        self.read_only = read_only
+        self._writer_lock = None
+        if not read_only:
+            self._writer_lock = self._lock_writer('{}.lock'.format(path))
+            if self._writer_lock is None:
+                self._logger.warning('Index %s is being written by another process, '
+                                     'opening it read only', path)
+                self.read_only = True
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._slots = 0
+        self._count = 0
+        self._records_offset = 0
+        if not self.read_only and (not os.path.exists(path) or not os.path.getsize(path)):
+            self._create(path, slots)
+        self._open()
+
+    @staticmethod
+    def _lock_writer(path):
+        """
+        Takes the lock of the only writer of an index
+
+        Args:
+            path: string, location of the lock file
+
+        Returns: the open lock file, or None if another writer holds it
+
+        """
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _create(path, slots, records=()):
+        """
+        Writes a new index file
+
+        Args:
+            path: string
+            slots: integer
+            records: iterable of (hash, record bytes) tuples to add
+        """
+        size = HEADER.size + slots * SLOT.size + (slots // 2) * RECORD.size
+        table = bytearray(slots * SLOT.size)
+        data = bytearray()
+        count = 0
+        for hashed, record in records:
+            position = hashed % slots
+            while SLOT.unpack_from(table, position * SLOT.size)[0]:
+                position = (position + 1) % slots
+            count += 1
+            SLOT.pack_into(table, position * SLOT.size, hashed, count)
+            data.extend(record)
+        with open(path, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, slots, count))
+            index_file.write(table)
+            index_file.write(data)
+            index_file.truncate(size)
+
+    def _open(self):
+        """Maps the index file in memory"""
+        if self.read_only:
+            self._file = open(self._path, 'rb')
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._file = open(self._path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self._slots, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a track index'.format(self._path))
+        self._records_offset = HEADER.size + self._slots * SLOT.size
+
+    def close(self):
+        """Unmaps and closes the index file"""
+        self._map.close()
+        self._file.close()
+        if self._writer_lock is not None:
+            self._writer_lock.close()
+            self._writer_lock = None
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, hashed):
+        """
+        Finds the slot of a title hash
+
+        Args:
+            hashed: integer
+
+        Returns: tuple of slot number and record number, 0 if not indexed
+
+        """
+        position = hashed % self._slots
+        while True:
+            slot_hash, record = SLOT.unpack_from(self._map,
+                                                 HEADER.size + position * SLOT.size)
+            if not slot_hash or slot_hash == hashed:
+                return position, record
+            position = (position + 1) % self._slots
+
+    def get(self, title):
+        """
+        Gets the track indexed for a title
+
+        Args:
+            title: string
+
+        Returns: dictionary with the details of the track or None
+
+        """
+        with self._lock:
+            _, record = self._find(title_hash(title))
+            if not record:
+                return None
+            track_id, popularity, duration, isrc = RECORD.unpack_from(
+                self._map, self._records_offset + (record - 1) * RECORD.size)
+        track_id = track_id.rstrip(b'\0').decode('ascii')
+        isrc = isrc.rstrip(b'\0').decode('ascii')
+        return {'id': track_id,
+                'uri': 'spotify:track:{}'.format(track_id),
+                'popularity': popularity,
+                'duration_ms': duration,
+                'external_ids': {'isrc': isrc} if isrc else {}}
+
+    def put(self, title, track_details):
+        """
+        Indexes the track resolved for a title
+
+        Args:
+            title: string
+            track_details: dictionary as returned by Spotify
+
+        """
+        if self.read_only:
+            return
+        hashed = title_hash(title)
+        isrc = track_details.get('external_ids', {}).get('isrc') or ''
+        record = RECORD.pack(track_details.get('id').encode('ascii'),
+                             track_details.get('popularity') or 0,
+                             track_details.get('duration_ms') or 0,
+                             isrc.encode('ascii', 'ignore'))
+        with self._lock:
+            position, number = self._find(hashed)
+            if not number:
+                if self._count >= self._slots // 2:
+                    self._grow()
+                    position, number = self._find(hashed)
+                self._count += 1
+                number = self._count
+                SLOT.pack_into(self._map, HEADER.size + position * SLOT.size,
+                               hashed, number)
+                HEADER.pack_into(self._map, 0, MAGIC, VERSION, self._slots, self._count)
+            self._map[self._records_offset + (number - 1) * RECORD.size:
+                      self._records_offset + number * RECORD.size] = record
+
+    def _grow(self):
+        """Rebuilds the index with twice as many slots"""
+        records = []
+        for position in range(self._slots):
+            hashed, number = SLOT.unpack_from(self._map,
+                                              HEADER.size + position * SLOT.size)
+            if hashed:
+                start = self._records_offset + (number - 1) * RECORD.size
+                records.append((hashed, self._map[start:start + RECORD.size]))
+        self._logger.debug('Growing index %s to %s slots', self._path, self._slots * 2)
+        temporary = '{}.tmp'.format(self._path)
+        self._create(temporary, self._slots * 2, records)
+        # The writer lock is kept while the file is replaced
+        self._map.close()
+        self._file.close()
+        os.rename(temporary, self._path)
+        self._open()
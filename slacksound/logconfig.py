@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: logconfig.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for logconfig
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+
+from datetime import datetime
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    from logutils.queue import QueueHandler, QueueListener
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# Attributes every LogRecord has, anything else was passed in extra
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+
+# Loggers of dependencies that are too chatty for their own good. spotifylib
+# formats a debug message eagerly on every request it makes.
+DEFAULT_LEVELS = {'spotifylib': 'INFO',
+                  'requests': 'WARNING',
+                  'urllib3': 'WARNING'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as one line of JSON"""
+
+    def format(self, record):
+        """
+        Formats a record
+
+        Fields passed with extra are added to the output as they are.
+
+        Args:
+            record: LogRecord object
+
+        Returns: string
+
+        """
+        entry = {'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in ('message', 'asctime'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_levels(levels):
+    """
+    Parses per logger levels
+
+    Examples:
+        in: 'resolver=DEBUG,spotifyclient=WARNING'
+        out: {'resolver': 'DEBUG', 'spotifyclient': 'WARNING'}
+
+    Args:
+        levels: string
+
+    Returns: dictionary of logger name to level name
+
+    """
+    parsed = {}
+    for entry in filter(None, (entry.strip() for entry in levels.split(','))):
+        name, _, level = entry.partition('=')
+        parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def start_queue_logging(handlers, level='INFO', levels=None):
+    """
+    Sends all logging through a queue to handlers running on their own thread
+
+    Logging calls only put the record in the queue, so writing the output
+    never blocks the caller. Records below the level of their logger are
+    dropped before they are even created.
+
+    Args:
+        handlers: list of Handler objects doing the output
+        level: string, level of the root logger
+        levels: dictionary of logger name to level, optional
+
+    Returns: QueueListener object, to be stopped on exit to flush the queue
+
+    """
+    records = queue.Queue(-1)
+    listener = QueueListener(records, *handlers)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    configured = dict(DEFAULT_LEVELS)
+    configured.update(levels or {})
+    for name, logger_level in configured.items():
+        logging.getLogger(name).setLevel(logger_level)
+    listener.start()
+    return listener
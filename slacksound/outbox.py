@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: outbox.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for outbox
+
+Keeps the voted songs until they are in the playlist.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from spotifyclient import RecordingIndex, Track
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''outbox'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+# Changes of the playlist an outbox holds
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class Outbox(object):
+    """
+    Playlist changes decided but not applied yet, in a SQLite file
+
+    Tracks to add and tracks to remove stay in the file until Spotify took
+    the change, so none is lost when Spotify fails or the bot is restarted.
+    A track has one change queued at most, the last one decided. The
+    recordings of the tracks waiting to be added are kept apart from the
+    ones of the playlist, so reading the playlist again doesn't drop them.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise object
+
+        Args:
+            path: string, location of the database file
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connection as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                               'track_id TEXT PRIMARY KEY, '
+                               'queued REAL NOT NULL, '
+                               'action TEXT NOT NULL, '
+                               'details TEXT)')
+        self._recordings = RecordingIndex(self._load(track_id, details)
+                                          for track_id, action, _, details in self.peek(None)
+                                          if action == ADD)
+
+    @property
+    def _connection(self):
+        """
+        Connection of the current thread, as they can't be shared
+
+        Returns: Connection object
+
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _load(track_id, details):
+        """
+        Gets the track of a queued change
+
+        Args:
+            track_id: string
+            details: string, JSON details of the track or None
+
+        Returns: Track object
+
+        """
+        if details:
+            return Track(json.loads(details))
+        return Track({'id': track_id, 'uri': 'spotify:track:{}'.format(track_id)})
+
+    def put(self, track, action=ADD):
+        """
+        Queues a change of the playlist
+
+        Args:
+            track: Track object, or string with its ID
+            action: string, ADD or REMOVE
+
+        Returns: boolean, False if the same change was queued already
+
+        """
+        if not isinstance(track, Track):
+            track = self._load(track, None)
+        details = json.dumps(track.details)
+        with self._lock, self._connection as connection:
+            cursor = connection.execute('INSERT OR IGNORE INTO outbox '
+                                        '(track_id, queued, action, details) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        (track.track_id, time.time(), action, details))
+            if not cursor.rowcount:
+                cursor = connection.execute('UPDATE outbox SET action = ?, queued = ?, details = ? '
+                                            'WHERE track_id = ? AND action != ?',
+                                            (action, time.time(), details, track.track_id, action))
+            if action == ADD:
+                self._recordings.add(track)
+            else:
+                self._recordings.discard(track.track_id)
+        return cursor.rowcount > 0
+
+    def peek(self, limit=100):
+        """
+        Gets the changes queued first, without taking them out
+
+        Args:
+            limit: integer, None for all of them
+
+        Returns: list of (track_id, action, queued, details) tuples
+
+        """
+        return self._connection.execute('SELECT track_id, action, queued, details FROM outbox '
+                                        'ORDER BY queued LIMIT ?',
+                                        (-1 if limit is None else limit,)).fetchall()
+
+    def tracks(self, entries):
+        """
+        Gets the tracks of queued changes
+
+        Args:
+            entries: list of tuples as given by peek
+
+        Returns: list of Track objects
+
+        """
+        return [self._load(track_id, details) for track_id, _, _, details in entries]
+
+    def done(self, entries):
+        """
+        Takes changes out of the queue once Spotify took them
+
+        Changes queued again in the meanwhile are kept.
+
+        Args:
+            entries: list of tuples as given by peek
+
+        """
+        with self._lock, self._connection as connection:
+            for track_id, action, queued, _ in entries:
+                cursor = connection.execute('DELETE FROM outbox '
+                                            'WHERE track_id = ? AND action = ? AND queued = ?',
+                                            (track_id, action, queued))
+                if cursor.rowcount and action == ADD:
+                    self._recordings.discard(track_id)
+
+    def action(self, track_id):
+        """
+        Gets the change queued for a track
+
+        Args:
+            track_id: string
+
+        Returns: string, ADD, REMOVE or None
+
+        """
+        row = self._connection.execute('SELECT action FROM outbox WHERE track_id = ?',
+                                       (track_id,)).fetchone()
+        return row[0] if row else None
+
+    def find_recording(self, track):
+        """
+        Gets the track waiting to be added that is a version of the given one
+
+        Args:
+            track: Track object
+
+        Returns: string, ID of the track queued, or None
+
+        """
+        with self._lock:
+            return self._recordings.find(track)
+
+    def __contains__(self, track_id):
+        return self.action(track_id) == ADD
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a service that keeps failing
+
+    After threshold failures in a row the circuit opens and no call is
+    allowed for reset_timeout seconds. Then one call is let through: the
+    circuit closes if it works and opens again if it does not.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        """
+        Initialise object
+
+        Args:
+            threshold: integer, failures in a row that open the circuit
+            reset_timeout: float, seconds the circuit stays open
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened = None
+
+    @property
+    def is_open(self):
+        """
+        Whether calls are being held back
+
+        Returns: boolean
+
+        """
+        return self._opened is not None
+
+    def allow(self, now=None):
+        """
+        Whether a call can be made
+
+        Args:
+            now: float, unix time, defaults to the current time
+
+        Returns: boolean
+
+        """
+        if self._opened is None:
+            return True
+        return (time.time() if now is None else now) - self._opened >= self.reset_timeout
+
+    def success(self):
+        """Notes a call that worked, closing the circuit"""
+        if self._opened is not None:
+            self._logger.info('Circuit closed')
+        self._failures = 0
+        self._opened = None
+
+    def failure(self, now=None):
+        """
+        Notes a call that failed, opening the circuit if there were enough
+
+        Args:
+            now: float, unix time, defaults to the current time
+
+        """
+        self._failures += 1
+        if self._opened is not None or self._failures >= self.threshold:
+            self._logger.warning('Circuit open for %ss after %s failures',
+                                 self.reset_timeout, self._failures)
+            self._opened = time.time() if now is None else now
+
+
+class OutboxFlusher(object):
+    """
+    Applies the changes of an outbox to the playlist in the background
+
+    The queued changes are applied in batches as big as Spotify takes in
+    one call, and the ones the playlist has already are just taken out of
+    the queue. While the circuit breaker is open nothing is tried, and
+    everything queued meanwhile goes in a few calls afterwards. The
+    playlist is also checked for changes made by others every
+    sync_interval seconds, so duplicates can be told from its local copy,
+    and the duration budget, if any, follows what the playlist has.
+    """
+
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 outbox,
+                 playlist,
+                 breaker=None,
+                 batch_size=100,
+                 interval=1.0,
+                 sync_interval=60.0,
+                 budget=None):
+        """
+        Initialise object
+
+        Args:
+            outbox: Outbox object
+            playlist: Playlist object
+            breaker: CircuitBreaker object, defaults to one with its defaults
+            batch_size: integer, changes applied per batch
+            interval: float, seconds between flushes
+            sync_interval: float, seconds between checks of the playlist
+            budget: DurationBudget object to sync with the playlist, optional
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._outbox = outbox
+        self.playlist = playlist
+        self.breaker = breaker or CircuitBreaker()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.sync_interval = sync_interval
+        self.budget = budget
+        self._synced = time.time()
+        self._stopped = threading.Event()
+        self._flushing = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts flushing on a background thread"""
+        self._thread = threading.Thread(target=self._run, name='outbox')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread after a last flush"""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+            if time.time() - self._synced >= self.sync_interval:
+                self.sync()
+        self.flush()
+
+    def sync(self):
+        """
+        Reads the playlist again if someone else changed it
+
+        Returns: boolean, whether Spotify could be reached
+
+        """
+        if not self.breaker.allow():
+            return False
+        self._synced = time.time()
+        try:
+            if self.playlist.refresh() and self.budget is not None:
+                self.budget.sync(self.playlist.tracks)
+        except Exception:  # pylint: disable=broad-except
+            self._logger.exception('Could not check the playlist for changes')
+            self.breaker.failure()
+            return False
+        self.breaker.success()
+        return True
+
+    def flush(self):
+        """
+        Applies everything queued to the playlist, batch by batch
+
+        Returns: integer, number of tracks added or removed
+
+        """
+        with self._flushing:
+            return self._flush()
+
+    def _flush(self):
+        applied = 0
+        while self.breaker.allow():
+            entries = self._outbox.peek(self.batch_size)
+            if not entries:
+                break
+            try:
+                present = set(track.track_id for track in self.playlist.iter_tracks())
+                removals = [entry[0] for entry in entries
+                            if entry[1] == REMOVE and entry[0] in present]
+                additions = self._outbox.tracks([entry for entry in entries
+                                                 if entry[1] == ADD and entry[0] not in present])
+                if removals:
+                    self.playlist.remove_tracks(removals)
+                if additions:
+                    self.playlist.add_tracks(additions)
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception('Could not apply %s queued changes', len(entries))
+                self.breaker.failure()
+                break
+            self.breaker.success()
+            self._synced = time.time()
+            self._outbox.done(entries)
+            applied += len(removals) + len(additions)
+        return applied
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: pipeline.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for pipeline
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+
+from spotifyclient import best_match
+from outbox import REMOVE
+from profiling import TickTimer
+from tracking import ReactionTracker, TrackingWindow
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''pipeline'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def sanitize_title(title):
+    """
+    Gets the artist and song name only
+
+    Splits the string by the the first open parenthesis and gets first item
+    in the list
+
+    Examples:
+        in: 'Eric Clapton - Cocaine (Original Video)'
+        out: 'Eric Clapton - Cocaine'
+
+    Args:
+        title: string
+
+    Returns: string
+
+    """
+    return title.split('(')[0].strip()
+
+
+class VotePipeline(object):
+    """
+    Turns Slack messages into playlist additions
+
+    Links that got reactions are looked up on Spotify and the track that
+    best matches the title is added to the playlist once the configured reaction reaches
+    the minimum count.
+    """
+
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 slack,
+                 playlist,
+                 resolver,
+                 config,
+                 start_time=0,
+                 timer=None,
+                 window=None,
+                 state=None,
+                 unfurls=None,
+                 outbox=None,
+                 budget=None,
+                 threads=None):
+        """
+        Initialise object
+
+        Args:
+            slack: Slack object, used to notify the channel
+            playlist: Playlist object
+            resolver: TrackResolver object
+            config: SlackSound namedtuple
+            start_time: float, messages older than this are ignored
+            timer: TickTimer object to time the stages with, optional
+            window: TrackingWindow object, defaults to one from start_time
+            state: VoteState object to record the voted tracks in, optional
+            unfurls: PendingUnfurls object to note links not unfurled yet, optional
+            outbox: Outbox object to queue the voted tracks in, optional,
+                they are added to the playlist straight away without it
+            budget: DurationBudget object to keep the playlist within, optional
+            threads: ThreadTracker object to follow the threads with, optional
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._slack = slack
+        self._playlist = playlist
+        self._resolver = resolver
+        self._config = config
+        self._blacklisted = []
+        self.tracker = ReactionTracker()
+        self.window = window or TrackingWindow(start_time)
+        self.state = state
+        self.unfurls = unfurls
+        self.outbox = outbox
+        self.budget = budget
+        self.threads = threads
+        self.timer = timer or TickTimer(logger=self._logger)
+
+    def process(self, messages):
+        """
+        Runs one pass of the pipeline over a batch of messages
+
+        All lookups are scheduled before any of them is waited on so that
+        they run in parallel. Only messages in the tracking window that are
+        new or whose reactions or attachments changed since the previous pass
+        are evaluated. Messages whose songs are settled leave the window, and
+        the ones that failed are evaluated again on the next pass.
+        Every pass is timed as one tick.
+
+        Args:
+            messages: iterable of Message objects
+
+        Returns: integer, number of messages processed
+
+        """
+        processed = 0
+        pending = []
+        self.timer.start_tick()
+        for message in self.timer.timed_iter('fetch', messages):
+            processed += 1
+            with self.timer.span('parse'):
+                # Settled parents still get replies worth following until
+                # they age out of the window.
+                if self.threads is not None and message.unix_time >= self.window.oldest:
+                    self.threads.observe(message)
+                if not self.window.contains(message):
+                    continue
+                # Replies are asked for again with their thread while they
+                # have links, the history can't return them on their own.
+                if self.unfurls is not None and message.thread_ts in (None, message.ts):
+                    self.unfurls.observe(message)
+                if self.tracker.changed(message):
+                    pending.extend(self._schedule_lookups(message))
+        evaluated = {}
+        unsettled = set()
+        for message, sanitized_title, future in pending:
+            evaluated[message.ts] = message
+            try:
+                with self.timer.span('resolve'):
+                    tracks = future.result()
+                with self.timer.span('evaluate'):
+                    if not self._evaluate(message, sanitized_title, tracks):
+                        unsettled.add(message.ts)
+            except Exception:  # pylint: disable=broad-except
+                self._logger.exception('Could not evaluate the song %s', sanitized_title)
+                # Evaluated again on the next pass even if nothing changes
+                unsettled.add(message.ts)
+                self.tracker.forget(message.ts)
+        for timestamp, message in evaluated.items():
+            if timestamp not in unsettled:
+                self.window.settle(message, self.tracker)
+        self.window.evict(self.tracker)
+        if self.threads is not None:
+            self.threads.evict(self.window.oldest)
+        self.timer.end_tick()
+        return processed
+
+    def process_threads(self, fetch):
+        """
+        Runs the replies of the threads that need it through the pipeline
+
+        Args:
+            fetch: callable taking a thread ts and the ts of the first reply
+                to get, returning the replies
+
+        Returns: integer, number of replies processed
+
+        """
+        processed = 0
+        for thread_ts, oldest in self.threads.due():
+            replies = list(fetch(thread_ts, oldest))
+            processed += self.process(replies)
+            self.threads.fetched(thread_ts,
+                                 replies,
+                                 [reply.ts for reply in replies
+                                  if (reply.links or reply.attachments) and
+                                  self.window.contains(reply)])
+        return processed
+
+    @property
+    def slack(self):
+        """
+        Slack object the channel is notified with
+
+        Returns: Slack object
+
+        """
+        return self._slack
+
+    @property
+    def playlist(self):
+        """
+        Playlist the voted songs go to
+
+        Returns: Playlist object
+
+        """
+        return self._playlist
+
+    def reconfigure(self, config=None, slack=None, playlist=None):
+        """
+        Switches to a new configuration without losing the messages tracked
+
+        Every message in the window is evaluated again on the next pass, as
+        the votes it needs may have changed.
+
+        Args:
+            config: SlackSound namedtuple, optional
+            slack: Slack object, optional
+            playlist: Playlist object, optional
+        """
+        self._config = config or self._config
+        self._slack = slack or self._slack
+        self._playlist = playlist or self._playlist
+        self.tracker = ReactionTracker()
+
+    @property
+    def signature(self):
+        """
+        Changes whenever a pass sees a new or changed message
+
+        Returns: integer
+
+        """
+        return self.tracker.generation
+
+    def _schedule_lookups(self, message):
+        """
+        Schedules the Spotify lookups of a message that got reactions
+
+        Args:
+            message: Message object
+
+        Returns: list of (Message, title, Future) tuples
+
+        """
+        pending = []
+        if message.reaction:
+            for attachment in message.attachments:
+                sanitized_title = sanitize_title(attachment.title)
+                pending.append((message,
+                                sanitized_title,
+                                self._resolver.resolve(sanitized_title)))
+        return pending
+
+    def _evict(self, track_ids):
+        """
+        Takes tracks out of the playlist, all in one go
+
+        With an outbox the removals are queued like the additions, so they
+        wait for Spotify to be reachable too.
+
+        Args:
+            track_ids: list of strings
+
+        """
+        if not track_ids:
+            return
+        if self.outbox is not None:
+            for track_id in track_ids:
+                self.outbox.put(track_id, REMOVE)
+        else:
+            self._playlist.remove_tracks(track_ids)
+        if self.state:
+            self.state.remove(track_ids)
+
+    def _find_present(self, track):
+        """
+        Gets the version of the recording of a track that is in the playlist
+
+        Tracks waiting in the outbox count as in the playlist, unless they
+        wait to be removed.
+
+        Args:
+            track: Track object
+
+        Returns: string, ID of the track found, or None
+
+        """
+        if self.outbox is None:
+            return self._playlist.find_recording(track)
+        found = self.outbox.find_recording(track)
+        if found:
+            return found
+        found = self._playlist.find_recording(track)
+        return found if found and self.outbox.action(found) != REMOVE else None
+
+    def _evaluate(self, message, sanitized_title, tracks):
+        """
+        Adds the track of a link to the playlist if it got enough votes
+
+        With a budget the votes of the track keep counting towards its score
+        for as long as the message is in the window.
+
+        Args:
+            message: Message object
+            sanitized_title: string
+            tracks: list of Track objects
+
+        Returns: boolean, whether nothing else can happen to this link
+
+        """
+        if not tracks and sanitized_title not in self._blacklisted:
+            self._logger.warning("Couldn't find the song")
+            self._blacklisted.append(sanitized_title)
+            with self.timer.span('notify'):
+                self._slack.post_message("Couldn't find the song",
+                                         self._config.channel)
+        track = best_match(sanitized_title, tracks)
+        if not track:
+            return True
+        for reaction in message.reaction:
+            if reaction.name != self._config.reaction:
+                continue
+            # Any version of the recording in the playlist counts, not
+            # only the very same track.
+            present = self._find_present(track)
+            if present and self.budget is not None:
+                self.budget.rescore(present, reaction.count)
+            if reaction.count < self._config.count:
+                return False
+            if not present:
+                with self.timer.span('mutate'):
+                    if self.budget is not None:
+                        evicted = self.budget.admit(track, reaction.count)
+                        if evicted is None:
+                            return False
+                        self._evict(evicted)
+                    if self.outbox is not None:
+                        self.outbox.put(track)
+                    else:
+                        self._playlist.add_track(track)
+                if self.state:
+                    self.state.add(track.track_id)
+                self._logger.info('Track %s added to playlist', track.name)
+                with self.timer.span('notify'):
+                    self._slack.post_message(
+                        "Song {} added".format(sanitized_title),
+                        self._config.channel)
+            return self.budget is None
+        return False
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: profiling.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for profiling
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import cProfile
+import logging
+import signal
+
+from contextlib import contextmanager
+from timeit import default_timer
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''profiling'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+STAGES = ('fetch', 'parse', 'evaluate', 'resolve', 'mutate', 'notify')
+
+
+class TickTimer(object):
+    """
+    Times the stages of every tick of the main loop
+
+    Spans can be nested, the time of a span does not include the time of the
+    spans opened inside of it. Ticks slower than the threshold are logged
+    with their breakdown and totals are kept for the whole run.
+    """
+
+    def __init__(self, slow_tick=2.0, logger=LOGGER):
+        """
+        Initialise object
+
+        Args:
+            slow_tick: float, seconds after which a tick gets logged
+            logger: Logger object to report to
+        """
+        self._slow_tick = slow_tick
+        self._logger = logger
+        self._stack = []
+        self._tick = {}
+        self._tick_start = None
+        self.ticks = 0
+        self.slow_ticks = 0
+        self.totals = dict.fromkeys(STAGES, 0.0)
+        self.maximums = dict.fromkeys(STAGES, 0.0)
+
+    def start_tick(self):
+        """Starts timing a new tick"""
+        self._tick = dict.fromkeys(STAGES, 0.0)
+        self._tick_start = default_timer()
+
+    def end_tick(self):
+        """
+        Closes the current tick, adding it up and logging it if slow
+
+        Returns: float, duration of the tick in seconds
+
+        """
+        duration = default_timer() - self._tick_start
+        self.ticks += 1
+        for stage, elapsed in self._tick.items():
+            self.totals[stage] = self.totals.get(stage, 0.0) + elapsed
+            self.maximums[stage] = max(self.maximums.get(stage, 0.0), elapsed)
+        if duration >= self._slow_tick:
+            self.slow_ticks += 1
+            self._logger.warning('Slow tick took %.3fs: %s',
+                                 duration, self._format(self._tick))
+        return duration
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Times a block of code as part of a stage
+
+        Args:
+            stage: string
+
+        """
+        start = default_timer()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            children = self._stack.pop()
+            elapsed = default_timer() - start
+            if self._stack:
+                self._stack[-1] += elapsed
+            self._tick[stage] = self._tick.get(stage, 0.0) + elapsed - children
+
+    def timed_iter(self, stage, iterable):
+        """
+        Times every step of an iterator as part of a stage
+
+        Args:
+            stage: string
+            iterable: iterable
+
+        Returns: generator with the items of the iterable
+
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        """
+        Totals of the run so far
+
+        Returns: string
+
+        """
+        return ('{ticks} ticks, {slow} slow. Total: {totals}. '
+                'Slowest tick per stage: {maximums}').format(ticks=self.ticks,
+                                                             slow=self.slow_ticks,
+                                                             totals=self._format(self.totals),
+                                                             maximums=self._format(self.maximums))
+
+    @staticmethod
+    def _format(stages):
+        return ', '.join('{stage}={elapsed:.3f}s'.format(stage=stage,
+                                                         elapsed=stages.get(stage, 0.0))
+                         for stage in STAGES)
+
+
+class Profiler(object):
+    """
+    Runs a callable under cProfile writing the stats to a file
+
+    Stats are written when the callable ends, including by KeyboardInterrupt,
+    and every time dump() is called.
+    """
+
+    def __init__(self, filename):
+        """
+        Initialise object
+
+        Args:
+            filename: string, where to write the pstats file
+        """
+        self._filename = filename
+        self._profile = cProfile.Profile()
+
+    def run(self, function, *args, **kwargs):
+        """
+        Calls a function with profiling enabled
+
+        Args:
+            function: callable
+            *args: positional arguments for the function
+            **kwargs: keyword arguments for the function
+
+        Returns: whatever the function returns
+
+        """
+        self._profile.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._profile.disable()
+            self._profile.dump_stats(self._filename)
+
+    def dump(self):
+        """Writes the stats gathered so far without stopping the profiler"""
+        self._profile.disable()
+        try:
+            self._profile.dump_stats(self._filename)
+        finally:
+            self._profile.enable()
+
+
+def dump_on_signal(timer, logger, profiler=None):
+    """
+    Logs the timing summary, and dumps the profile, on SIGUSR1
+
+    Args:
+        timer: TickTimer object
+        logger: Logger object to log the summary to
+        profiler: Profiler object, optional
+
+    Returns: boolean, whether the handler could be installed
+
+    """
+    if not hasattr(signal, 'SIGUSR1'):
+        return False
+
+    def handler(*_):
+        logger.info(timer.summary())
+        if profiler:
+            profiler.dump()
+
+    signal.signal(signal.SIGUSR1, handler)
+    return True
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: replay.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for replay
+
+Runs the vote pipeline offline over exported Slack history, with Spotify
+served from a recorded fixture.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import os
+import time
+
+from collections import namedtuple
+from slackapi import Message
+from spotifyclient import Track, RecordingIndex
+from resolver import TrackResolver
+from pipeline import VotePipeline
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''replay'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+ReplayStats = namedtuple('ReplayStats', ['messages',
+                                         'added',
+                                         'notifications',
+                                         'elapsed'])
+
+
+def iter_history(path):
+    """
+    Reads Slack history from disk, one file at a time
+
+    The path can be a channel directory of a Slack export, holding one JSON
+    list of messages per day, or a single file. Files with a recorded
+    conversations.history, channels.history or groups.history response are
+    read as well.
+
+    Args:
+        path: string
+
+    Returns: generator of lists of Message objects, oldest first
+
+    """
+    if os.path.isdir(path):
+        filenames = sorted(os.path.join(path, filename)
+                           for filename in os.listdir(path)
+                           if filename.endswith('.json'))
+    else:
+        filenames = [path]
+    for filename in filenames:
+        with open(filename) as history_file:
+            history = json.load(history_file)
+        if isinstance(history, dict):
+            history = history.get('messages', [])
+        yield [Message(message) for message in
+               sorted(history, key=lambda message: float(message.get('ts', 0)))]
+
+
+class FixtureSpotify(object):
+    """
+    Stands in for SpotifyClient serving searches from a recorded fixture
+
+    The fixture is a JSON object of title to either the list of track
+    dictionaries or the full search response recorded for it.
+    """
+
+    def __init__(self, fixture):
+        """
+        Initialise object
+
+        Args:
+            fixture: string, path of the fixture file
+        """
+        with open(fixture) as fixture_file:
+            self._searches = json.load(fixture_file)
+
+    def get_track_by_title(self, track_title, limit=5):
+        """
+        Looks up the recorded results of a title
+
+        Args:
+            track_title: string
+            limit: integer
+
+        Returns: list of Track objects
+
+        """
+        songs = self._searches.get(track_title, [])
+        if isinstance(songs, dict):
+            songs = songs.get('tracks', {}).get('items', [])
+        return [Track(track) for track in songs[:limit]]
+
+
+class ReplaySlack(object):
+    """Stands in for Slack keeping the posted messages in memory"""
+
+    def __init__(self):
+        """Initialise object"""
+        self.messages = []
+
+    def post_message(self, message, channel):
+        """
+        Records a message instead of posting it
+
+        Args:
+            message: string
+            channel: string
+
+        Returns: True
+
+        """
+        self.messages.append((channel, message))
+        return True
+
+
+class ReplayPlaylist(object):
+    """Stands in for Playlist keeping the tracks in memory"""
+
+    def __init__(self):
+        """Initialise object"""
+        self._tracks = []
+        self.recordings = RecordingIndex()
+
+    @property
+    def tracks(self):
+        """
+        Get all tracks in the playlist
+
+        Returns: list of Track objects
+
+        """
+        return list(self._tracks)
+
+    def iter_tracks(self):
+        """
+        Get the tracks in the playlist
+
+        Returns: generator of Track objects
+
+        """
+        return iter(self._tracks)
+
+    def find_recording(self, track):
+        """
+        Gets the track of the playlist that is a version of the given one
+
+        Args:
+            track: Track object
+
+        Returns: string, ID of the track in the playlist, or None
+
+        """
+        return self.recordings.find(track)
+
+    def add_track(self, track_id):
+        """
+        Add a track to the playlist
+
+        Args:
+            track_id: string, or Track object to keep its recording
+
+        Returns: Boolean
+
+        """
+        track = track_id if isinstance(track_id, Track) else \
+            Track({'id': track_id, 'uri': 'spotify:track:{}'.format(track_id)})
+        self._tracks.append(track)
+        self.recordings.add(track)
+        return True
+
+
+def replay(source, fixture, config, max_workers=4, max_pending=32, timer=None):
+    """
+    Streams recorded history through the vote pipeline at full speed
+
+    Args:
+        source: string, export directory or recorded history file
+        fixture: string, recorded Spotify searches
+        config: SlackSound namedtuple
+        max_workers: integer
+        max_pending: integer
+        timer: TickTimer object, optional
+
+    Returns: ReplayStats namedtuple
+
+    """
+    slack = ReplaySlack()
+    playlist = ReplayPlaylist()
+    resolver = TrackResolver(FixtureSpotify(fixture),
+                             max_workers=max_workers,
+                             max_pending=max_pending)
+    pipeline = VotePipeline(slack, playlist, resolver, config, timer=timer)
+    processed = 0
+    start = time.time()
+    try:
+        for messages in iter_history(source):
+            processed += pipeline.process(messages)
+    finally:
+        resolver.shutdown()
+    return ReplayStats(messages=processed,
+                       added=len(playlist.tracks),
+                       notifications=len(slack.messages),
+                       elapsed=time.time() - start)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: resolver.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for resolver
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''resolver'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class TrackResolver(object):
+    """
+    Resolves track titles on Spotify using a bounded pool of threads
+
+    While a search is in flight, any other request for the same title gets
+    the very same future back. Finished lookups are not kept, the cache and
+    the index of the Spotify client serve the titles looked up before. When
+    the number of searches waiting for a worker reaches max_pending, new
+    titles block the caller until a slot is freed.
+    """
+
+    def __init__(self, spotify, max_workers=4, max_pending=32):
+        """
+        Initialise object
+
+        Args:
+            spotify: SpotifyClient object
+            max_workers: integer
+            max_pending: integer
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        # Can be replaced while running, lookups scheduled after that use
+        # the new client.
+        self.spotify = spotify
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._futures = {}
+
+    def resolve(self, title):
+        """
+        Schedules a lookup for a title and returns its future
+
+        Titles being resolved return the existing future.
+
+        Args:
+            title: string
+
+        Returns: Future object resolving to a list of Track objects
+
+        """
+        with self._lock:
+            future = self._futures.get(title)
+        if future:
+            return future
+        # Waiting for a slot outside of the lock keeps finished lookups
+        # able to release theirs.
+        self._slots.acquire()
+        with self._lock:
+            future = self._futures.get(title)
+            if future:
+                self._slots.release()
+                return future
+            self._logger.debug('Scheduling lookup for title: %s', title)
+            future = self._executor.submit(self.spotify.get_track_by_title,
+                                           title)
+            self._futures[title] = future
+        future.add_done_callback(lambda done: self._finish(title, done))
+        return future
+
+    def resolve_many(self, titles):
+        """
+        Schedules lookups for many titles at once
+
+        Args:
+            titles: iterable of strings
+
+        Returns: dictionary of title to Future object
+
+        """
+        return {title: self.resolve(title) for title in titles}
+
+    def _finish(self, title, future):
+        """
+        Frees the slot of a finished lookup and forgets it
+
+        Args:
+            title: string
+            future: Future object
+
+        """
+        self._slots.release()
+        if future.exception() is not None:
+            self._logger.warning('Lookup for title %s failed: %s',
+                                 title, future.exception())
+        with self._lock:
+            if self._futures.get(title) is future:
+                del self._futures[title]
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker threads
+
+        Args:
+            wait: boolean
+
+        """
+        self._executor.shutdown(wait=wait)
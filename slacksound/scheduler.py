@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: scheduler.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for scheduler
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import logging
+import threading
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''scheduler'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class PollScheduler(object):
+    """
+    Decides how long to wait before polling every channel again
+
+    The interval of a channel drops to the minimum as soon as something new
+    shows up on it and doubles, up to the maximum, for every quiet poll.
+    The minimum is raised so that the calls the last poll of every channel
+    made, its history pages, thread replies, unfurls and notifications,
+    stay within the calls per minute budget all together, and nothing is
+    polled while Slack asks to retry later.
+    """
+
+    def __init__(self,
+                 min_interval=1.0,
+                 max_interval=60.0,
+                 backoff=2.0,
+                 calls_per_minute=50,
+                 transport=None):
+        """
+        Initialise object
+
+        Args:
+            min_interval: float, seconds between polls of a busy channel
+            max_interval: float, seconds between polls of a quiet channel
+            backoff: float, factor the interval grows by on quiet polls
+            calls_per_minute: integer, budget shared by all channels
+            transport: Transport object reporting Slack's Retry-After, optional
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.calls_per_minute = calls_per_minute
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._intervals = {}
+        self._signatures = {}
+        self._calls = {}
+
+    @property
+    def budget_interval(self):
+        """
+        Shortest interval that keeps all channels within the budget
+
+        Returns: float
+
+        """
+        calls = max(sum(self._calls.values()), 1)
+        return 60.0 * calls / self.calls_per_minute
+
+    def observe(self, channel_id, signature, calls=1):
+        """
+        Records what a poll of a channel returned
+
+        Args:
+            channel_id: string
+            signature: hashable summary of the messages and reactions seen
+            calls: integer, Slack calls the poll made
+
+        Returns: float, the new interval of the channel
+
+        """
+        with self._lock:
+            self._calls[channel_id] = calls
+            floor = max(self.min_interval, self.budget_interval)
+            previous = self._signatures.get(channel_id)
+            self._signatures[channel_id] = signature
+            if previous is None or previous != signature:
+                interval = floor
+            else:
+                interval = min(self._intervals.get(channel_id, floor) * self.backoff,
+                               self.max_interval)
+            interval = max(interval, floor)
+            if interval != self._intervals.get(channel_id):
+                self._logger.debug('Polling %s every %.1fs', channel_id, interval)
+            self._intervals[channel_id] = interval
+        return interval
+
+    def delay(self, channel_id):
+        """
+        Seconds to wait before polling a channel
+
+        Args:
+            channel_id: string
+
+        Returns: float
+
+        """
+        with self._lock:
+            interval = self._intervals.get(channel_id, self.min_interval)
+        if self._transport:
+            interval = max(interval, self._transport.retry_after('slack.com'))
+        return interval
+
+    def forget(self, channel_id):
+        """
+        Stops tracking a channel
+
+        Args:
+            channel_id: string
+
+        """
+        with self._lock:
+            self._intervals.pop(channel_id, None)
+            self._signatures.pop(channel_id, None)
+            self._calls.pop(channel_id, None)
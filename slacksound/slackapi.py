@@ -32,6 +32,7 @@ Main code for slackapi
 """
 
 import logging
+import re
 import tzlocal
 
 from slackclient import SlackClient
@@ -53,25 +54,160 @@ LOGGER_BASENAME = '''slackapi'''
 LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
+LINK = re.compile(r'<(https?://[^|>]+)')
+
+# Channel types of conversations.list the bot follows
+CONVERSATION_TYPES = 'public_channel,private_channel'
+
+
+def page_size_argument(method):
+    """
+    Name of the page size argument of a history method
+
+    The conversations.* methods take limit where the legacy channels.* and
+    groups.* ones take count.
+
+    Args:
+        method: string
+
+    Returns: string
+
+    """
+    return 'limit' if method.startswith('conversations.') else 'count'
+
+
+def iter_history_pages(client, method, channel_id, oldest=0, latest=None, count=100):
+    """
+    Pages through the history of a channel or group
+
+    Only one page of messages is held at a time and no more pages are
+    requested once the consumer stops iterating. The oldest boundary is
+    sent to Slack so older messages are never transferred. Slack leaves
+    the message at the boundary out, so it is sent one microsecond earlier.
+
+    Args:
+        client: SlackClient object
+        method: string, conversations.history, channels.history or groups.history
+        channel_id: string
+        oldest: float, unix time of the oldest message to get
+        latest: string, ts to start from, exclusive, optional
+        count: integer, messages per page
+
+    Returns: generator of lists of Message objects, newest first
+
+    """
+    if oldest:
+        oldest = '{:.6f}'.format(float(oldest) - 0.000001)
+    while True:
+        arguments = {'channel': channel_id,
+                     'oldest': oldest,
+                     page_size_argument(method): count}
+        if latest:
+            arguments['latest'] = latest
+        page = client.api_call(method, **arguments)
+        messages = page.get('messages', [])
+        if messages:
+            yield [Message(message) for message in messages]
+        if not page.get('has_more') or not messages:
+            return
+        latest = messages[-1].get('ts')
+
+
+def iter_history(client, method, channel_id, oldest=0, count=100):
+    """
+    Messages of the history of a channel or group, paged lazily
+
+    Args:
+        client: SlackClient object
+        method: string, conversations.history, channels.history or groups.history
+        channel_id: string
+        oldest: float, unix time of the oldest message to get
+        count: integer, messages per page
+
+    Returns: generator of Message objects, newest first
+
+    """
+    for page in iter_history_pages(client, method, channel_id, oldest, count=count):
+        for message in page:
+            yield message
+
+
+def get_message(client, method, channel_id, timestamp):
+    """
+    Gets a single message of a channel or group by its timestamp
+
+    Args:
+        client: SlackClient object
+        method: string, conversations.history, channels.history or groups.history
+        channel_id: string
+        timestamp: string, ts of the message
+
+    Returns: Message object, None if it no longer exists
+
+    """
+    arguments = {'channel': channel_id,
+                 'latest': timestamp,
+                 'oldest': timestamp,
+                 'inclusive': 1,
+                 page_size_argument(method): 1}
+    page = client.api_call(method, **arguments)
+    messages = page.get('messages', [])
+    return Message(messages[0]) if messages else None
+
+
+def iter_replies(client, channel_id, thread_ts, oldest=0, limit=200):
+    """
+    Replies of a thread from a given one on, paged by cursor
+
+    Args:
+        client: SlackClient object
+        channel_id: string
+        thread_ts: string, ts of the parent message
+        oldest: string, ts of the first reply to get, included
+        limit: integer, replies per page
+
+    Returns: generator of Message objects, oldest first, without the parent
+
+    """
+    cursor = None
+    while True:
+        arguments = {'channel': channel_id,
+                     'ts': thread_ts,
+                     'oldest': oldest,
+                     'inclusive': 1,
+                     'limit': limit}
+        if cursor:
+            arguments['cursor'] = cursor
+        page = client.api_call('conversations.replies', **arguments)
+        for message in page.get('messages', []):
+            if message.get('ts') != thread_ts:
+                yield Message(message)
+        cursor = page.get('response_metadata', {}).get('next_cursor')
+        if not page.get('has_more') or not cursor:
+            return
+
 
 class Slack(object):
     """SlackClient Wrapper"""
 
-    def __init__(self, token, bot=False):
+    def __init__(self, token, bot=False, transport=None):
         """
         Initialise object. If bot is true it will use the RTM API
 
         Args:
             token: string
             bot: boolean
+            transport: Transport object to do the HTTP calls with, optional
         """
         self.client = SlackClient(token)
+        if transport:
+            transport.mount_slack(self.client)
         if bot:
-            self.client = SlackClient(token)
             self.client.rtm_connect()
         self.__channels = []
         self.__users = []
         self.__groups = []
+        self.__conversations = {}
 
     @property
     def channels(self, **kwargs):
@@ -107,6 +243,55 @@ class Slack(object):
                 self.__groups.append(Group(self, group))
         return self.__groups
 
+    def iter_conversations(self, types=CONVERSATION_TYPES, limit=200):
+        """
+        Gets the conversations of a Slack team of any of the given types
+
+        Pages are only requested while the consumer keeps iterating, and
+        every conversation seen is indexed by name.
+
+        Args:
+            types: string, comma separated conversation types
+            limit: integer, conversations per page
+
+        Returns: generator of Conversation objects
+
+        """
+        cursor = None
+        while True:
+            arguments = {'types': types,
+                         'exclude_archived': True,
+                         'limit': limit}
+            if cursor:
+                arguments['cursor'] = cursor
+            page = self.client.api_call("conversations.list", **arguments)
+            for details in page.get('channels', []):
+                conversation = Conversation(self, details)
+                self.__conversations[conversation.name_normalized] = conversation
+                yield conversation
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+
+    def get_conversation_by_name(self, name, types=CONVERSATION_TYPES):
+        """
+        Gets one public or private channel in a Team with a single listing
+
+        Conversations listed before are found without any call, otherwise
+        the listing stops at the page holding the one looked for.
+
+        Args:
+            name: string
+            types: string, comma separated conversation types
+
+        Returns: Conversation object
+
+        """
+        if name in self.__conversations:
+            return self.__conversations[name]
+        return next((conversation for conversation in self.iter_conversations(types)
+                     if conversation.name_normalized == name), None)
+
     @property
     def users(self, **kwargs):
         """
@@ -174,6 +359,13 @@ class Slack(object):
                              as_user=True)
         return True
 
+    def close(self):
+        """Closes the RTM connection, if there is one"""
+        websocket = self.client.server.websocket
+        if websocket:
+            self.client.server.websocket = None
+            websocket.close()
+
 
 class Member(object):
     """
@@ -241,7 +433,86 @@ class Member(object):
         return self._member_details.get('profile').get('email', None)
 
 
-class Group(object):
+class HistoryMixin(object):
+    """
+    Reading of the history and threads of a channel or group
+
+    Classes using it set HISTORY_METHOD to the method of the API their
+    history is read with, and set _client and _history_id to their client
+    and ID when initialised.
+    """
+
+    HISTORY_METHOD = None
+
+    def iter_history(self, oldest=0, count=100):
+        """
+        Chat history, newest first, one page at a time
+
+        Args:
+            oldest: float, unix time of the oldest message to get
+            count: integer, messages per page
+
+        Returns: generator of Message objects
+
+        """
+        return iter_history(self._client,
+                            self.HISTORY_METHOD,
+                            self._history_id,
+                            oldest,
+                            count)
+
+    def iter_history_pages(self, oldest=0, latest=None, count=1000):
+        """
+        Chat history, newest first, as pages of messages
+
+        Args:
+            oldest: float, unix time of the oldest message to get
+            latest: string, ts to start from, exclusive, optional
+            count: integer, messages per page
+
+        Returns: generator of lists of Message objects
+
+        """
+        return iter_history_pages(self._client,
+                                  self.HISTORY_METHOD,
+                                  self._history_id,
+                                  oldest,
+                                  latest,
+                                  count)
+
+    def get_message(self, timestamp):
+        """
+        Message with the given timestamp
+
+        Args:
+            timestamp: string, ts of the message
+
+        Returns: Message object, None if it no longer exists
+
+        """
+        return get_message(self._client,
+                           self.HISTORY_METHOD,
+                           self._history_id,
+                           timestamp)
+
+    def iter_replies(self, thread_ts, oldest=0):
+        """
+        Replies of a thread
+
+        Args:
+            thread_ts: string, ts of the parent message
+            oldest: string, ts of the first reply to get, included
+
+        Returns: generator of Message objects
+
+        """
+        return iter_replies(self._client,
+                            self._history_id,
+                            thread_ts,
+                            oldest)
+
+
+class Group(HistoryMixin):
     """
     Model for a group
 
@@ -249,6 +520,9 @@ class Group(object):
 
     https://api.slack.com/types/group
     """
+
+    HISTORY_METHOD = 'groups.history'
+
     def __init__(self, slack_instance, group_details):
         """
         Initialise object
@@ -259,6 +533,8 @@ class Group(object):
         """
         self._slack_instance = slack_instance
         self._group_details = group_details
+        self._client = slack_instance.client
+        self._history_id = group_details.get('id', None)
 
     @property
     def group_id(self):
@@ -322,13 +598,13 @@ class Group(object):
 
         """
         ch_history = self._slack_instance.client.api_call(
-                                    method="groups.history",
+                                    method=self.HISTORY_METHOD,
                                     channel=self.group_id)
         return [Message(history_message) for history_message in
                 ch_history.get('messages')]
 
 
-class Channel(object):
+class Channel(HistoryMixin):
     """
     Model for a Channel
 
@@ -336,6 +612,9 @@ class Channel(object):
 
     https://api.slack.com/types/channel
     """
+
+    HISTORY_METHOD = 'channels.history'
+
     def __init__(self, slack_instance, channel_details):
         """
         Initialise object
@@ -346,6 +625,8 @@ class Channel(object):
         """
         self.__slack_instance = slack_instance
         self._channel_details = channel_details
+        self._client = slack_instance.client
+        self._history_id = channel_details.get('id', None)
 
     @property
     def channel_id(self):
@@ -409,12 +690,34 @@ class Channel(object):
 
         """
         ch_history = self.__slack_instance.client.api_call(
-                                    method="channels.history",
+                                    method=self.HISTORY_METHOD,
                                     channel=self.channel_id)
         return [Message(history_message) for history_message in
                 ch_history.get('messages')]
 
 
+class Conversation(Channel):
+    """
+    Model for a conversation, a public or private channel alike
+
+    Not all attributes are populated here though.
+
+    https://api.slack.com/types/conversation
+    """
+
+    HISTORY_METHOD = 'conversations.history'
+
+    @property
+    def is_private(self):
+        """
+        Whether the conversation is a private channel
+
+        Returns: boolean
+
+        """
+        return self._channel_details.get('is_private', None)
+
+
 class Message(object):
     """
     Model for a Message
@@ -463,6 +766,16 @@ class Message(object):
         return [Attachment(m_attachment) for m_attachment in
                 self._message_details.get('attachments', [])]
 
+    @property
+    def links(self):
+        """
+        URLs posted in the text of the message
+
+        Returns: list of strings
+
+        """
+        return LINK.findall(self._message_details.get('text') or '')
+
     @property
     def user(self):
         """
@@ -486,6 +799,46 @@ class Message(object):
                                       tzlocal.get_localzone())
         return date
 
+    @property
+    def ts(self):  # pylint: disable=invalid-name
+        """
+        Timestamp of the message as given by Slack, unique per channel
+
+        Returns: string
+
+        """
+        return self._message_details.get('ts', None)
+
+    @property
+    def thread_ts(self):
+        """
+        Timestamp of the parent message if the message is in a thread
+
+        Returns: string
+
+        """
+        return self._message_details.get('thread_ts', None)
+
+    @property
+    def reply_count(self):
+        """
+        Number of replies of the thread the message is the parent of
+
+        Returns: integer
+
+        """
+        return self._message_details.get('reply_count', 0)
+
+    @property
+    def latest_reply(self):
+        """
+        Timestamp of the last reply of the thread the message is the parent of
+
+        Returns: string
+
+        """
+        return self._message_details.get('latest_reply', None)
+
     @property
     def unix_time(self):
         """
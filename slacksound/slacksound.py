@@ -31,15 +31,38 @@ Main code for slacksound
 
 """
 
+import atexit
 import logging
+import logging.config
 import os
 import json
 import argparse
+import sys
+import threading
 import time
 
 from collections import namedtuple
+from functools import partial
 from slackapi import Slack
 from spotifyclient import SpotifyClient
+from resolver import TrackResolver
+from pipeline import VotePipeline
+from replay import replay
+from profiling import TickTimer, Profiler, dump_on_signal
+from scheduler import PollScheduler
+from tracking import TrackingWindow, PendingUnfurls, ThreadTracker
+from state import VoteState, load_session
+from backfill import Backfill
+from datetime import datetime
+from logconfig import JsonFormatter, parse_levels, start_queue_logging
+from events import EventsReceiver, EventStore
+from transport import Transport, RateLimiter
+from cache import SQLiteCache
+from index import TrackIndex
+from outbox import Outbox, OutboxFlusher
+from budget import DurationBudget
+from supervisor import Supervisor, SharedRateLimiter
+from hotreload import ConfigWatcher, options_changed
 
 try:
     import configparser
@@ -60,7 +83,6 @@ __status__ = '''Development'''  # "Prototype", "Development", "Production".
 # This is the main prefix used for logging
 LOGGER_BASENAME = '''slacksound'''
 LOGGER = logging.getLogger(LOGGER_BASENAME)
-LOGGER.setLevel(logging.DEBUG)
 
 
 SlackSound = namedtuple('Config', ['playlist',
@@ -68,6 +90,15 @@ SlackSound = namedtuple('Config', ['playlist',
                                    'channel',
                                    'count'])
 
+# Options of [spotify] that need a new connection when they change
+SPOTIFY_OPTIONS = ('client_id',
+                   'client_secret',
+                   'username',
+                   'password',
+                   'callback_url',
+                   'scope',
+                   'calls_per_second')
+
 
 def get_arguments():
     """
@@ -76,6 +107,19 @@ def get_arguments():
     """
     # https://docs.python.org/3/library/argparse.html
     parser = argparse.ArgumentParser(description='''Create playlists democratically by reactions in Slack''')
+    parser.add_argument('command',
+                        nargs='?',
+                        help=('run follows the channel live, replay runs the '
+                              'vote pipeline over recorded history and '
+                              'backfill builds the playlist from the past '
+                              'history of the channel and supervise runs '
+                              'every binding on a pool of worker processes. '
+                              'Defaults to run.'),
+                        default='run',
+                        choices=['run',
+                                 'replay',
+                                 'backfill',
+                                 'supervise'])
     parser.add_argument('--log-config',
                         '-l',
                         action='store',
@@ -93,12 +137,182 @@ def get_arguments():
                                  'WARNING',
                                  'ERROR',
                                  'CRITICAL'])
+    parser.add_argument('--log-levels',
+                        help=('Levels of single subsystems, such as '
+                              'resolver=DEBUG,spotifyclient=WARNING'),
+                        dest='log_levels',
+                        action='store',
+                        default='')
+    parser.add_argument('--log-format',
+                        help='Format of the log output. Defaults to text.',
+                        dest='log_format',
+                        action='store',
+                        default='text',
+                        choices=['text',
+                                 'json'])
     parser.add_argument('--credentials',
                         dest='credentials',
                         action='store',
                         default=False,
                         required=False)
+    parser.add_argument('--workers',
+                        help='Number of concurrent Spotify lookups. Defaults to 4.',
+                        dest='workers',
+                        action='store',
+                        type=int,
+                        default=4)
+    parser.add_argument('--max-pending',
+                        help=('Number of lookups that can wait for a worker '
+                              'before new ones block. Defaults to 32.'),
+                        dest='max_pending',
+                        action='store',
+                        type=int,
+                        default=32)
+    parser.add_argument('--source',
+                        help=('Slack export channel directory or recorded '
+                              'history file to replay'),
+                        dest='source',
+                        action='store',
+                        default='')
+    parser.add_argument('--fixture',
+                        help='Recorded Spotify searches to replay against',
+                        dest='fixture',
+                        action='store',
+                        default='')
+    parser.add_argument('--profile',
+                        help=('Run under cProfile and write the stats to this '
+                              'file on exit and on SIGUSR1'),
+                        dest='profile',
+                        action='store',
+                        default='')
+    parser.add_argument('--slow-tick',
+                        help=('Log the timing breakdown of ticks slower than '
+                              'this many seconds. Defaults to 2.'),
+                        dest='slow_tick',
+                        action='store',
+                        type=float,
+                        default=2.0)
+    parser.add_argument('--min-interval',
+                        help=('Seconds between polls while the channel is busy. '
+                              'Defaults to 1.'),
+                        dest='min_interval',
+                        action='store',
+                        type=float,
+                        default=1.0)
+    parser.add_argument('--max-interval',
+                        help=('Seconds between polls once the channel is quiet. '
+                              'Defaults to 60.'),
+                        dest='max_interval',
+                        action='store',
+                        type=float,
+                        default=60.0)
+    parser.add_argument('--calls-per-minute',
+                        help=('Slack calls allowed per minute across all '
+                              'channels. Defaults to 50.'),
+                        dest='calls_per_minute',
+                        action='store',
+                        type=int,
+                        default=50)
+    parser.add_argument('--window-age',
+                        help=('Seconds a message is considered for votes. '
+                              '0 disables the limit. Defaults to 86400.'),
+                        dest='window_age',
+                        action='store',
+                        type=float,
+                        default=86400.0)
+    parser.add_argument('--window-size',
+                        help=('Messages considered for votes at most. '
+                              '0 disables the limit. Defaults to 1000.'),
+                        dest='window_size',
+                        action='store',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--reset',
+                        help=('How to prepare the playlist on start. reconcile '
+                              'makes it hold the tracks of the session or the '
+                              'saved state, wipe empties it and keep leaves it '
+                              'as it is. Defaults to reconcile.'),
+                        dest='reset',
+                        action='store',
+                        default='reconcile',
+                        choices=['reconcile',
+                                 'wipe',
+                                 'keep'])
+    parser.add_argument('--max-duration',
+                        help=('Minutes of music the playlist can hold. The '
+                              'least voted songs are removed to make room for '
+                              'new ones. Defaults to 0, no limit.'),
+                        dest='max_duration',
+                        action='store',
+                        type=float,
+                        default=0)
+    parser.add_argument('--state',
+                        help=('File the voted tracks are saved to. '
+                              'Defaults to ~/.slacksound.state'),
+                        dest='state',
+                        action='store',
+                        default='{home}/.slacksound.state'.format(home=os.path.expanduser('~')))
+    parser.add_argument('--outbox',
+                        help=('File of the voted songs waiting to be added to '
+                              'the playlist. Defaults to ~/.slacksound.outbox'),
+                        dest='outbox',
+                        action='store',
+                        default='{home}/.slacksound.outbox'.format(home=os.path.expanduser('~')))
+    parser.add_argument('--session',
+                        help=('JSON list of the tracks the playlist should start '
+                              'with, as IDs, URIs or links'),
+                        dest='session',
+                        action='store',
+                        default='')
+    parser.add_argument('--cursor',
+                        help=('File the backfill progress is saved to. '
+                              'Defaults to ~/.slacksound.backfill.<channel>'),
+                        dest='cursor',
+                        action='store',
+                        default='')
+    parser.add_argument('--since',
+                        help='Date of the oldest message to backfill, as YYYY-MM-DD',
+                        dest='since',
+                        action='store',
+                        default='')
+    parser.add_argument('--top',
+                        help='Most voted songs to backfill. Defaults to all.',
+                        dest='top',
+                        action='store',
+                        type=int,
+                        default=None)
+    parser.add_argument('--ingest',
+                        help=('How to get new messages and reactions. poll '
+                              'reads the channel history, events receives '
+                              "Slack's Events API callbacks. Defaults to poll."),
+                        dest='ingest',
+                        action='store',
+                        default='poll',
+                        choices=['poll',
+                                 'events'])
+    parser.add_argument('--events-host',
+                        help='Address to receive events on. Defaults to 0.0.0.0',
+                        dest='events_host',
+                        action='store',
+                        default='0.0.0.0')
+    parser.add_argument('--events-port',
+                        help='Port to receive events on. Defaults to 3000',
+                        dest='events_port',
+                        action='store',
+                        type=int,
+                        default=3000)
+    parser.add_argument('--processes',
+                        help=('Worker processes to run the bindings on. '
+                              'Defaults to the number of CPUs.'),
+                        dest='processes',
+                        action='store',
+                        type=int,
+                        default=None)
     args = parser.parse_args()
+    if args.command == 'replay' and not (args.source and args.fixture):
+        parser.error('replay needs --source and --fixture')
+    if args.command == 'supervise' and args.ingest == 'events':
+        parser.error('supervise only supports --ingest poll')
     return args
 
 
@@ -120,13 +334,20 @@ def setup_logging(args):
         logging.config.dictConfig(configuration)
     else:
         handler = logging.StreamHandler()
-        handler.setLevel(args.log_level)
-        formatter = logging.Formatter(('%(asctime)s - '
-                                       '%(name)s - '
-                                       '%(levelname)s - '
-                                       '%(message)s'))
+        if args.log_format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(('%(asctime)s - '
+                                           '%(name)s - '
+                                           '%(levelname)s - '
+                                           '%(message)s'))
         handler.setFormatter(formatter)
-        LOGGER.addHandler(handler)
+        # The handler runs on the thread of the listener so that writing
+        # logs never blocks the vote loop.
+        listener = start_queue_logging([handler],
+                                       level=args.log_level,
+                                       levels=parse_levels(args.log_levels))
+        atexit.register(listener.stop)
 
 
 def get_credentials(filename=False):
@@ -143,10 +364,7 @@ def get_credentials(filename=False):
 
     :return: ConfigParser instance
     """
-    if filename:
-        credentials_file = filename
-    else:
-        credentials_file = '{home}/.slacksound'.format(home=os.path.expanduser('~'))
+    credentials_file = get_credentials_path(filename)
 
     LOGGER.info("Using credentials file %s", credentials_file)
     if not os.path.isfile(credentials_file):
@@ -156,41 +374,111 @@ def get_credentials(filename=False):
     return config
 
 
-def connect_spotify(credentials):
-    spotify = SpotifyClient(client_id=credentials.get('spotify', 'client_id'),
-                            client_secret=credentials.get('spotify', 'client_secret'),
-                            username=credentials.get('spotify', 'username'),
-                            password=credentials.get('spotify', 'password'),
-                            callback=credentials.get('spotify', 'callback_url'),
-                            scope=credentials.get('spotify', 'scope'))
-    return spotify
+def get_credentials_path(filename=False):
+    """
+    Location of the credentials file, ~/.slacksound unless one is given
+
+    Args:
+        filename: path of the filename
 
+    Returns: string
 
-def sanitize_title(title):
     """
-    Gets the artist and song name only
+    if filename:
+        return filename
+    return '{home}/.slacksound'.format(home=os.path.expanduser('~'))
+
 
-    Splits the string by the the first open parenthesis and gets first item
-    in the list
+def get_transport(credentials):
+    """
+    Builds the HTTP transport shared by Slack and Spotify
 
-    Examples:
-        in: 'Eric Clapton - Cocaine (Original Video)'
-        out: 'Eric Clapton - Cocaine'
+    Reads the optional [transport] section of the credentials file.
 
     Args:
-        title: string
+        credentials: ConfigParser instance
+
+    Returns: Transport object
+
+    """
+    options = {}
+    if credentials.has_section('transport'):
+        options = dict(credentials.items('transport'))
+    return Transport(pool_connections=int(options.get('pool_connections', 4)),
+                     pool_maxsize=int(options.get('pool_maxsize', 16)),
+                     timeout=float(options.get('timeout', 10)),
+                     compression=options.get('compression', 'true').lower() == 'true',
+                     etag_entries=int(options.get('etag_entries', 256)))
 
-    Returns: string
 
+def get_cache(credentials):
     """
-    return title.split('(')[0].strip()
+    Builds the resolution cache shared between processes, if configured
+
+    Reads the optional [cache] section of the credentials file.
 
+    Args:
+        credentials: ConfigParser instance
+
+    Returns: SQLiteCache object or None
 
-def get_most_popular_track(tracks):
-    sorted_tracks = sorted(tracks, key=lambda x: x.popularity, reverse=True)
-    if not sorted_tracks:
+    """
+    if not credentials.has_option('cache', 'path'):
+        return None
+    options = dict(credentials.items('cache'))
+    return SQLiteCache(os.path.expanduser(options.get('path')),
+                       ttl=float(options.get('ttl', 604800)))
+
+
+def get_index(credentials, read_only=False):
+    """
+    Opens the on disk index of resolved tracks, if configured
+
+    Reads the optional [index] section of the credentials file. A read only
+    index that was never written is left out.
+
+    Args:
+        credentials: ConfigParser instance
+        read_only: boolean, only look titles up, for processes that run
+            next to others using the same index
+
+    Returns: TrackIndex object or None
+
+    """
+    if not credentials.has_option('index', 'path'):
+        return None
+    path = os.path.expanduser(credentials.get('index', 'path'))
+    if read_only and not os.path.isfile(path):
+        LOGGER.warning('Index %s does not exist yet, titles will be searched for', path)
         return None
-    return sorted_tracks[0]
+    return TrackIndex(path, read_only=read_only)
+
+
+def get_calls_per_second(credentials):
+    if credentials.has_option('spotify', 'calls_per_second'):
+        return float(credentials.get('spotify', 'calls_per_second'))
+    return 10.0
+
+
+def connect_spotify(credentials, transport=None, cache=None, index=None, rate_limiter=None):
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(calls_per_second=get_calls_per_second(credentials),
+                                   transport=transport,
+                                   host='api.spotify.com')
+    elif transport:
+        # A limiter shared with other processes can't ask this transport.
+        transport.add_retry_listener(rate_limiter.retry_later)
+    spotify = SpotifyClient(client_id=credentials.get('spotify', 'client_id'),
+                            client_secret=credentials.get('spotify', 'client_secret'),
+                            username=credentials.get('spotify', 'username'),
+                            password=credentials.get('spotify', 'password'),
+                            callback=credentials.get('spotify', 'callback_url'),
+                            scope=credentials.get('spotify', 'scope'),
+                            transport=transport,
+                            cache=cache,
+                            index=index,
+                            rate_limiter=rate_limiter)
+    return spotify
 
 
 def get_config_details(credentials):
@@ -201,56 +489,496 @@ def get_config_details(credentials):
     return config
 
 
-def main():
+def get_bindings(credentials):
     """
-    Main method.
-    This method holds what you want to execute when
-    the script is run on command line.
+    Gets every channel to playlist binding of the configuration
+
+    The [slack] and [spotify] sections make the first binding, every
+    [binding:<name>] section adds one more. Those only need a channel and
+    a playlist, reaction and count default to the ones of [slack].
+
+    Args:
+        credentials: ConfigParser object
+
+    Returns: list of SlackSound namedtuples
+
     """
-    start_time = time.time()
+    default = get_config_details(credentials)
+    bindings = [default]
+    for section in credentials.sections():
+        if not section.startswith('binding:'):
+            continue
+        count = default.count
+        if credentials.has_option(section, 'count'):
+            count = int(credentials.get(section, 'count'))
+        reaction = default.reaction
+        if credentials.has_option(section, 'reaction'):
+            reaction = credentials.get(section, 'reaction')
+        bindings.append(SlackSound(playlist=credentials.get(section, 'playlist'),
+                                   reaction=reaction,
+                                   channel=credentials.get(section, 'channel'),
+                                   count=count))
+    return bindings
+
+
+def prepare_playlist(playlist, state, args):
+    """
+    Gets the playlist ready for a new run
 
-    args = get_arguments()
-    setup_logging(args)
+    Reconciling only applies the difference between the playlist and the
+    tracks it should have, those of the session definition if one is given
+    or else the ones voted in previous runs. Without either, the playlist
+    ends up empty, as with wipe.
+
+    Args:
+        playlist: Playlist object
+        state: VoteState object
+        args: The arguments returned gathered from argparse
+    """
+    if args.reset == 'keep':
+        return
+    if args.reset == 'wipe':
+        playlist.delete_all_tracks()
+        state.replace([])
+        return
+    if args.session:
+        state.replace(load_session(args.session))
+    playlist.reconcile(state.tracks)
+
+
+def find_channel(slack, name):
+    """
+    Finds a public or private channel by name
+
+    Args:
+        slack: Slack object
+        name: string
+
+    Returns: Conversation object
+
+    """
+    channel = slack.get_conversation_by_name(name)
+    LOGGER.info("Found channel: %s", channel.name)
+    return channel
+
+
+def run_backfill(args, timer):  # pylint: disable=unused-argument
+    """
+    Builds the playlist from the past votes of the channel
+
+    Args:
+        args: The arguments returned gathered from argparse
+        timer: TickTimer object
+    """
     credentials = get_credentials(args.credentials)
     config_details = get_config_details(credentials)
-    spotify = connect_spotify(credentials)
+    transport = get_transport(credentials)
+    spotify = connect_spotify(credentials,
+                              transport,
+                              get_cache(credentials),
+                              get_index(credentials))
     playlist = spotify.get_playlist_by_name(config_details.playlist)
-    slack = Slack(credentials.get('slack', 'token'), bot=True)
-    channel = slack.get_group_by_name(config_details.channel)
-    if not channel:
-        channel = slack.get_channel_by_name(config_details.channel)
-    LOGGER.info("Found channel: %s", channel.name)
-    playlist.delete_all_tracks()
+    slack = Slack(credentials.get('slack', 'token'), transport=transport)
+    channel = find_channel(slack, config_details.channel)
+    since = 0
+    if args.since:
+        since = time.mktime(datetime.strptime(args.since, '%Y-%m-%d').timetuple())
+    cursor = args.cursor or '{home}/.slacksound.backfill.{channel}'.format(home=os.path.expanduser('~'),
+                                                                            channel=config_details.channel)
+    backfill = Backfill(channel,
+                        spotify,
+                        playlist,
+                        config_details,
+                        cursor,
+                        since=since,
+                        max_workers=args.workers)
+    added = backfill.run(top=args.top)
+    LOGGER.info('Backfill done, %s tracks added', len(added))
+
+
+def run_replay(args, timer):
+    """
+    Replays recorded history offline and logs the throughput
+
+    Args:
+        args: The arguments returned gathered from argparse
+        timer: TickTimer object
+    """
+    config_details = get_config_details(get_credentials(args.credentials))
+    stats = replay(args.source,
+                   args.fixture,
+                   config_details,
+                   max_workers=args.workers,
+                   max_pending=args.max_pending,
+                   timer=timer)
+    LOGGER.info('Replayed %s messages in %.3fs (%.1f messages/s), '
+                '%s tracks added, %s notifications',
+                stats.messages,
+                stats.elapsed,
+                stats.messages / stats.elapsed if stats.elapsed else 0.0,
+                stats.added,
+                stats.notifications)
+    LOGGER.info(timer.summary())
+
+
+def reload_config(previous,  # pylint: disable=too-many-arguments
+                  credentials,
+                  transport,
+                  channel,
+                  pipeline,
+                  resolver,
+                  flusher):
+    """
+    Applies the changes of the configuration file to the running bot
+
+    Reaction and count apply straight away. A new Slack token or new
+    Spotify credentials connect again over the same transport, and a new
+    channel or playlist is looked up, listing the playlists again if it is
+    a new one. Connections, caches and the messages tracked are kept, but
+    the RTM connection of a previous token is closed. The songs queued in
+    the outbox are flushed before switching playlists. If anything fails,
+    the running configuration is kept.
+
+    Args:
+        previous: ConfigParser object in use
+        credentials: ConfigParser object read from the changed file
+        transport: Transport object
+        channel: Conversation object followed
+        pipeline: VotePipeline object
+        resolver: TrackResolver object
+        flusher: OutboxFlusher object
+
+    Returns: tuple of the ConfigParser object and the channel now in use
+
+    """
+    slack = pipeline.slack
+    try:
+        config_details = get_config_details(credentials)
+        if options_changed(previous, credentials, 'slack', 'token'):
+            LOGGER.info('Slack token changed, connecting again')
+            slack = Slack(credentials.get('slack', 'token'), bot=True, transport=transport)
+        spotify = None
+        if options_changed(previous, credentials, 'spotify', *SPOTIFY_OPTIONS):
+            LOGGER.info('Spotify credentials changed, connecting again')
+            spotify = connect_spotify(credentials,
+                                      transport,
+                                      get_cache(credentials),
+                                      resolver.spotify.index)
+        playlist = None
+        if spotify or options_changed(previous, credentials, 'spotify', 'playlist'):
+            playlist = (spotify or resolver.spotify).get_playlist_by_name(config_details.playlist)
+            if playlist is None:
+                raise ValueError('There is no playlist {}'.format(config_details.playlist))
+            playlist.refresh(force=pipeline.budget is not None)
+        if slack is not pipeline.slack or options_changed(previous, credentials, 'slack', 'channel'):
+            channel = find_channel(slack, config_details.channel)
+    except Exception:  # pylint: disable=broad-except
+        LOGGER.exception('Could not apply the new configuration, keeping the running one')
+        if slack is not pipeline.slack:
+            slack.close()
+        return previous, channel
+    if slack is not pipeline.slack:
+        pipeline.slack.close()
+    if spotify:
+        resolver.spotify = spotify
+    if playlist:
+        flusher.flush()
+        flusher.playlist = playlist
+        if pipeline.budget is not None:
+            pipeline.budget.sync(playlist.tracks)
+        if pipeline.state:
+            pipeline.state.replace([track.track_id for track in playlist.iter_tracks()])
+    pipeline.reconfigure(config_details, slack, playlist)
+    LOGGER.info('Following %s for playlist %s, :%s: reactions needed: %s',
+                config_details.channel, config_details.playlist,
+                config_details.reaction, config_details.count)
+    return credentials, channel
+
+
+def watch_config(watcher,  # pylint: disable=too-many-arguments
+                 transport,
+                 pipeline,
+                 resolver,
+                 flusher,
+                 previous,
+                 channel):
+    """
+    Applies the configuration file if it changed since it was last read
+
+    Args:
+        watcher: ConfigWatcher object
+        transport: Transport object
+        pipeline: VotePipeline object
+        resolver: TrackResolver object
+        flusher: OutboxFlusher object
+        previous: ConfigParser object in use
+        channel: Conversation object followed
+
+    Returns: tuple of the ConfigParser object and the channel now in use
+
+    """
+    credentials = watcher.poll()
+    if not credentials:
+        return previous, channel
+    return reload_config(previous, credentials, transport, channel, pipeline, resolver, flusher)
+
+
+def follow_events(credentials, channel, pipeline, args, reload=None):
+    """
+    Feeds the vote pipeline from Slack's Events API instead of polling
+
+    Args:
+        credentials: ConfigParser object
+        channel: Conversation object
+        pipeline: VotePipeline object
+        args: The arguments returned gathered from argparse
+        reload: callable taking the configuration and channel in use and
+            returning them as changed, if the configuration file did
+    """
+    receiver = EventsReceiver(credentials.get('slack', 'signing_secret'),
+                              host=args.events_host,
+                              port=args.events_port)
+    store = EventStore(channel.channel_id)
+    receiver.start()
+    try:
+        while True:
+            changed = [message for message in
+                       (store.apply(event) for event in receiver.drain())
+                       if message]
+            if changed:
+                pipeline.process(changed)
+            store.evict(pipeline.window.oldest)
+            if reload:
+                credentials, channel = reload(credentials, channel)
+                receiver.signing_secret = credentials.get('slack', 'signing_secret')
+                store.channel_id = channel.channel_id
+    finally:
+        receiver.stop()
+
+
+def run(args, timer, binding=None, rate_limiter=None, calls_per_minute=None):
+    """
+    Follows the channel and fills the playlist with the voted songs
+
+    Args:
+        args: The arguments returned gathered from argparse
+        timer: TickTimer object
+        binding: SlackSound namedtuple, defaults to the one of [slack]
+        rate_limiter: limiter of the Spotify calls, defaults to one of its own
+        calls_per_minute: callable returning the Slack budget of the binding,
+            defaults to --calls-per-minute
+    """
+    start_time = time.time()
+
+    credentials = get_credentials(args.credentials)
+    config_details = binding or get_config_details(credentials)
+    state_path = args.state
+    outbox_path = args.outbox
+    if binding:
+        state_path = '{state}.{channel}'.format(state=args.state, channel=binding.channel)
+        outbox_path = '{outbox}.{channel}'.format(outbox=args.outbox, channel=binding.channel)
+    transport = get_transport(credentials)
+    # Supervised bindings run next to each other, the index has one writer at most.
+    spotify = connect_spotify(credentials,
+                              transport,
+                              get_cache(credentials),
+                              get_index(credentials, read_only=binding is not None),
+                              rate_limiter)
+    playlist = spotify.get_playlist_by_name(config_details.playlist)
+    slack = Slack(credentials.get('slack', 'token'), bot=True, transport=transport)
+    channel = find_channel(slack, config_details.channel)
+    state = VoteState(state_path)
+    prepare_playlist(playlist, state, args)
     slack.post_message("SlackSound started! Add your :{}: reaction to the link. "
                        "The minimum votes are: {}".format(config_details.reaction,
                                                           config_details.count),
                        config_details.channel)
 
-    blacklisted = []
-
+    # The votes are checked against the local copy of the playlist, and the
+    # tracks added by ID have no duration until they are read again.
+    playlist.refresh(force=bool(args.max_duration))
+    budget = None
+    if args.max_duration:
+        budget = DurationBudget(int(args.max_duration * 60000), playlist.tracks)
+    outbox = Outbox(outbox_path)
+    flusher = OutboxFlusher(outbox, playlist, budget=budget)
+    flusher.start()
+    resolver = TrackResolver(spotify,
+                             max_workers=args.workers,
+                             max_pending=args.max_pending)
+    window = TrackingWindow(start_time,
+                            max_age=args.window_age,
+                            max_count=args.window_size)
+    pipeline = VotePipeline(slack,
+                            playlist,
+                            resolver,
+                            config_details,
+                            timer=timer,
+                            window=window,
+                            state=state,
+                            unfurls=PendingUnfurls() if args.ingest == 'poll' else None,
+                            outbox=outbox,
+                            budget=budget,
+                            threads=ThreadTracker() if args.ingest == 'poll' else None)
+
+    # Supervised bindings are restarted by the supervisor instead.
+    watcher = reload = None
+    if not binding:
+        watcher = ConfigWatcher(get_credentials_path(args.credentials), get_credentials)
+        reload = partial(watch_config, watcher, transport, pipeline, resolver, flusher)
+
+    if args.ingest == 'events':
+        follow_events(credentials, channel, pipeline, args, reload)
+        return
+
+    if calls_per_minute is None:
+        calls_per_minute = partial(int, args.calls_per_minute)
+    scheduler = PollScheduler(min_interval=args.min_interval,
+                              max_interval=args.max_interval,
+                              calls_per_minute=calls_per_minute(),
+                              transport=transport)
+
+    # Links that are not unfurled yet are asked for on their own, so the
+    # whole channel is not polled sooner just to see their attachments.
+    channel_id = channel.channel_id
+    next_poll = time.time() + scheduler.delay(channel_id)
+    calls = transport.calls('slack.com')
     while True:
+        wake = min(next_poll, pipeline.unfurls.next_due or next_poll)
+        if watcher:
+            wake = min(wake, time.time() + watcher.interval)
+        time.sleep(max(0, wake - time.time()))
+        if reload:
+            credentials, channel = reload(credentials, channel)
+            if channel.channel_id != channel_id:
+                scheduler.forget(channel_id)
+                channel_id = channel.channel_id
+                next_poll = time.time()
+        due = pipeline.unfurls.due()
+        if due:
+            pipeline.process(message for message in
+                             (channel.get_message(timestamp) for timestamp in due)
+                             if message)
+        if time.time() >= next_poll:
+            pipeline.process(channel.iter_history(oldest=window.oldest))
+            pipeline.process_threads(channel.iter_replies)
+            # Everything called since the previous poll, notifications and
+            # unfurls included, counts towards the budget of the next ones.
+            polled = transport.calls('slack.com')
+            scheduler.calls_per_minute = calls_per_minute()
+            scheduler.observe(channel_id, pipeline.signature, polled - calls)
+            calls = polled
+            next_poll = time.time() + scheduler.delay(channel_id)
+
+
+def get_binding_budget(calls_per_minute, total):
+    """
+    Share of the Slack budget of every binding
+
+    Args:
+        calls_per_minute: integer, budget of all the bindings
+        total: shared Value of the number of bindings
+
+    Returns: integer
+
+    """
+    return max(1, calls_per_minute // max(total.value, 1))
+
+
+def run_worker(args, rate_limiter, bindings, total):
+    """
+    Runs a shard of the bindings, one thread each, in a worker process
+
+    The worker exits as soon as one of its bindings fails so that the
+    supervisor starts it again.
+
+    Args:
+        args: The arguments returned gathered from argparse
+        rate_limiter: SharedRateLimiter object
+        bindings: list of SlackSound namedtuples
+        total: shared Value of the number of bindings of all the workers
+    """
+    # The thread of the log listener does not survive the fork.
+    logging.getLogger().handlers = []
+    setup_logging(args)
+    # Read on every poll, the supervisor updates it as bindings come and go.
+    calls_per_minute = partial(get_binding_budget, args.calls_per_minute, total)
+    threads = []
+    for binding in bindings:
+        thread = threading.Thread(target=run,
+                                  args=(args, TickTimer(slow_tick=args.slow_tick, logger=LOGGER)),
+                                  kwargs={'binding': binding,
+                                          'rate_limiter': rate_limiter,
+                                          'calls_per_minute': calls_per_minute},
+                                  name=binding.channel)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    while all(thread.is_alive() for thread in threads):
         time.sleep(1)
-        for message in channel.history:
-            if message.unix_time >= start_time:
-                for reaction in message.reaction:
-                    for attachment in message.attachments:
-                        sanitized_title = sanitize_title(attachment.title)
-                        tracks = spotify.get_track_by_title(sanitized_title)
-                        if not tracks and sanitized_title not in blacklisted:
-                            LOGGER.warning("Couldn't find the song")
-                            blacklisted.append(sanitized_title)
-                            slack.post_message("Couldn't find the song",
-                                               config_details.channel)
-                        track = get_most_popular_track(tracks)
-                        if track:
-                            if reaction.count >= config_details.count and reaction.name == config_details.reaction:
-                                track_uris = [plist.uri for plist in playlist.tracks]
-                                if track.uri not in track_uris:
-                                    playlist.add_track(track.track_id)
-                                    LOGGER.info('Track %s added to playlist', track.name)
-                                    slack.post_message(
-                                        "Song {} added".format(sanitized_title),
-                                        config_details.channel)
+    LOGGER.error('Binding of %s stopped, exiting',
+                 ', '.join(thread.name for thread in threads if not thread.is_alive()))
+    sys.exit(1)
+
+
+def run_supervisor(args, timer):  # pylint: disable=unused-argument
+    """
+    Runs every binding of the configuration on a pool of worker processes
+
+    All the workers draw from a single Spotify rate limit and share the
+    Slack budget in proportion to the bindings each one runs. When the
+    configuration file changes, only the workers whose bindings changed
+    are started again, or all of them if the credentials changed.
+
+    Args:
+        args: The arguments returned gathered from argparse
+        timer: TickTimer object
+    """
+    credentials = get_credentials(args.credentials)
+    watcher = ConfigWatcher(get_credentials_path(args.credentials), get_credentials)
+    rate_limiter = SharedRateLimiter(calls_per_second=get_calls_per_second(credentials))
+    supervisor = Supervisor(get_bindings(credentials),
+                            partial(run_worker, args, rate_limiter),
+                            processes=args.processes)
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(1)
+            supervisor.check()
+            changed = watcher.poll()
+            if not changed:
+                continue
+            try:
+                bindings = get_bindings(changed)
+            except configparser.Error:
+                LOGGER.exception('Could not read the bindings, keeping the running ones')
+                continue
+            restart_all = (options_changed(credentials, changed, 'slack', 'token') or
+                           options_changed(credentials, changed, 'spotify', *SPOTIFY_OPTIONS))
+            supervisor.reshard(bindings, restart_all=restart_all)
+            credentials = changed
+    finally:
+        supervisor.stop()
+
+
+def main():
+    """
+    Main method.
+    This method holds what you want to execute when
+    the script is run on command line.
+    """
+    args = get_arguments()
+    setup_logging(args)
+    timer = TickTimer(slow_tick=args.slow_tick, logger=LOGGER)
+    profiler = Profiler(args.profile) if args.profile else None
+    dump_on_signal(timer, LOGGER, profiler)
+    command = {'replay': run_replay,
+               'backfill': run_backfill,
+               'supervise': run_supervisor}.get(args.command, run)
+    if profiler:
+        profiler.run(command, args, timer)
+    else:
+        command(args, timer)
 
 
 if __name__ == '__main__':
@@ -31,7 +31,12 @@ Main code for spotifyclient
 
 """
 from spotifylib import Spotify
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+from index import normalize_title
 import logging
+import re
+import threading
 
 __author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
 __docformat__ = '''google'''
@@ -48,6 +53,81 @@ LOGGER_BASENAME = '''spotifyclient'''
 LOGGER = logging.getLogger(LOGGER_BASENAME)
 LOGGER.addHandler(logging.NullHandler())
 
+# Seconds a search that found nothing is cached for
+NOT_FOUND_TTL = 3600
+
+# Most tracks Spotify takes in one playlist mutation
+MAX_TRACKS_PER_CALL = 100
+
+
+# Weights of popularity, title similarity and artist match when scoring
+POPULARITY_WEIGHT = 0.4
+SIMILARITY_WEIGHT = 0.4
+ARTIST_WEIGHT = 0.2
+
+# Qualifiers of a release of a recording, like " - Remastered 2015" or
+# " (Live at Wembley)", which other releases of it don't have
+VERSION_QUALIFIER = (r'(?:\d{4}\s+)?(?:(?:digital(?:ly)?\s+)?remaster(?:ed)?|live|mono|stereo|'
+                     r'(?:single|album|radio|original)\s+(?:version|edit|mix))\b[^()\[\]]*')
+VERSION_SUFFIX = re.compile(r'\s*(?:\s-\s+{qualifier}|[(\[]\s*{qualifier}[)\]])\s*$'
+                            .format(qualifier=VERSION_QUALIFIER),
+                            flags=re.IGNORECASE | re.UNICODE)
+
+
+def strip_version(name):
+    """
+    Takes the qualifiers of the release off the name of a track
+
+    Examples:
+        in: 'Cocaine (Live at Wembley) - Remastered 2015'
+        out: 'Cocaine'
+
+    Args:
+        name: string
+
+    Returns: string
+
+    """
+    while True:
+        stripped = VERSION_SUFFIX.sub('', name)
+        if stripped == name:
+            return stripped
+        name = stripped
+
+
+def score_track(title, track):
+    """
+    Scores how well a track matches a title, from 0 to 1
+
+    Args:
+        title: string, normalized title looked up
+        track: Track object
+
+    Returns: float
+
+    """
+    name = normalize_title(' '.join(track.artists + [track.name or '']))
+    similarity = SequenceMatcher(None, title, name).ratio() if name else 0.0
+    artist = any(normalize_title(artist) in title for artist in track.artists)
+    return (POPULARITY_WEIGHT * (track.popularity or 0) / 100.0 +
+            SIMILARITY_WEIGHT * similarity +
+            ARTIST_WEIGHT * artist)
+
+
+def best_match(title, tracks):
+    """
+    Picks the track that best matches a title in a single pass
+
+    Args:
+        title: string
+        tracks: list of Track objects
+
+    Returns: Track object or None
+
+    """
+    normalized = normalize_title(title)
+    return max(tracks, key=lambda track: score_track(normalized, track)) if tracks else None
+
 
 class SpotifyClient(object):
     def __init__(self,
@@ -56,7 +136,11 @@ class SpotifyClient(object):
                  username,
                  password,
                  callback,
-                 scope):
+                 scope,
+                 transport=None,
+                 cache=None,
+                 index=None,
+                 rate_limiter=None):
         """
         Initialise object to interact with Spotify API
 
@@ -69,6 +153,10 @@ class SpotifyClient(object):
             password: string
             callback: string
             scope: string
+            transport: Transport object to do the HTTP calls with, optional
+            cache: SQLiteCache object shared with other processes, optional
+            index: TrackIndex object to look titles up first, optional
+            rate_limiter: RateLimiter object searches wait on, optional
         """
         self._logger = logging.getLogger('{base}.{suffix}'
                                          .format(base=LOGGER_BASENAME,
@@ -81,6 +169,11 @@ class SpotifyClient(object):
                                 password=password,
                                 callback=callback,
                                 scope=scope)
+        if transport:
+            transport.mount_spotify(self._spotify)
+        self._cache = cache
+        self._index = index
+        self._rate_limiter = rate_limiter
         self._playlists = None
 
     @property
@@ -99,11 +192,23 @@ class SpotifyClient(object):
                                for playlist in raw_playlists.get('items')]
         return self._playlists
 
+    @property
+    def index(self):
+        """
+        Index the titles are looked up in first
+
+        Returns: TrackIndex object or None
+
+        """
+        return self._index
+
     def get_track_by_title(self, track_title, limit=5):
         """
         Looks up on Spotify for a text string and returns tracks if found
 
-        The limit is an optional argument to retrieve more results
+        The limit is an optional argument to retrieve more results. Titles
+        found in the index only return the track that best matched them,
+        with all its details if the cache still has them.
 
         Examples:
             'Eric Clapton - Cocaine'
@@ -116,22 +221,77 @@ class SpotifyClient(object):
         Returns: list of Track objects
 
         """
+        if self._index is not None:
+            indexed = self._index.get(track_title)
+            if indexed:
+                cached = self._cache.get('track', indexed.get('id')) if self._cache else None
+                return [Track(cached or indexed)]
+        key = '{limit}:{title}'.format(limit=limit, title=track_title.lower())
+        if self._cache:
+            cached = self._cache.get('search', key)
+            if cached is not None:
+                return [Track(track) for track in cached]
         self._logger.debug('Looking for title: %s', track_title)
+        if self._rate_limiter:
+            self._rate_limiter.acquire()
         songs = self._spotify.search(q=track_title.encode('utf-8'), limit=limit, type='track')
-        return [Track(track) for track in songs.get('tracks', {}).get('items')]
+        items = songs.get('tracks', {}).get('items')
+        if self._cache:
+            # Titles not found are retried sooner in case they get published
+            self._cache.set('search', key, items,
+                            ttl=None if items else NOT_FOUND_TTL)
+            for track in items:
+                self._cache.set('track', track.get('id'), track)
+        tracks = [Track(track) for track in items]
+        if self._index is not None and tracks:
+            self._index.put(track_title,
+                            items[tracks.index(best_match(track_title, tracks))])
+        return tracks
+
+    def get_tracks_by_titles(self, track_titles, max_workers=4, limit=5):
+        """
+        Looks up many titles concurrently and picks the best track of each
+
+        Searches go through the rate limiter, if any, so a large batch does
+        not exceed it.
+
+        Args:
+            track_titles: iterable of strings
+            max_workers: integer, searches running at the same time
+            limit: integer, candidates scored per title
+
+        Returns: dictionary of title to Track object, None if not found
+
+        """
+        titles = list(set(track_titles))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            results = executor.map(lambda title: self.get_track_by_title(title, limit),
+                                   titles)
+            return {title: best_match(title, tracks)
+                    for title, tracks in zip(titles, results)}
+        finally:
+            executor.shutdown()
 
     def get_playlist_by_name(self, playlist_name):
         """
         Looks into all playlists and returns the one that matched
 
+        The playlists are listed again if it is not among the ones known, as
+        it may have been created since they were listed.
+
         Args:
             playlist_name: string
 
-        Returns: Playlist object
+        Returns: Playlist object, None if there is none with that name
 
         """
         playlist = next((plist for plist in self.playlists
                          if plist.name == playlist_name), None)
+        if playlist is None:
+            self._playlists = None
+            playlist = next((plist for plist in self.playlists
+                             if plist.name == playlist_name), None)
         return playlist
 
 
@@ -147,6 +307,16 @@ class Track(object):
         """
         self._track_details = track_details
 
+    @property
+    def details(self):
+        """
+        Details of the track as returned by Spotify
+
+        Returns: dictionary
+
+        """
+        return self._track_details
+
     @property
     def uri(self):
         """
@@ -167,6 +337,17 @@ class Track(object):
         """
         return self._track_details.get('id', None)
 
+    @property
+    def artists(self):
+        """
+        Names of the artists of the track
+
+        Returns: list of strings
+
+        """
+        return [artist.get('name', '') for artist in
+                self._track_details.get('artists', [])]
+
     @property
     def popularity(self):
         """
@@ -197,6 +378,110 @@ class Track(object):
         """
         return self._track_details.get('duration_ms', None)
 
+    @property
+    def isrc(self):
+        """
+        International Standard Recording Code, the same for every release
+        of a recording
+
+        Returns: string
+
+        """
+        return self._track_details.get('external_ids', {}).get('isrc', None)
+
+    @property
+    def recording_keys(self):
+        """
+        Keys that identify the recording of the track across releases
+
+        The ISRC if Spotify has it, and the first artist and the name
+        normalized, without qualifiers like remastered or live, as those
+        releases usually get an ISRC of their own.
+
+        Returns: list of strings
+
+        """
+        keys = []
+        if self.isrc:
+            keys.append('isrc:{}'.format(self.isrc.upper()))
+        if self.name and self.artists:
+            keys.append('name:{}'.format(normalize_title(u'{} {}'.format(self.artists[0],
+                                                                          strip_version(self.name)))))
+        return keys
+
+
+class RecordingIndex(object):
+    """
+    Recordings of the tracks of a playlist
+
+    Tells in constant time whether a track is a version of a recording
+    that is in the playlist already, like a remaster, a live take or the
+    single of an album track.
+    """
+
+    def __init__(self, tracks=()):
+        """
+        Initialise object
+
+        Args:
+            tracks: iterable of Track objects
+        """
+        self._tracks = {}
+        self._keys = {}
+        for track in tracks:
+            self.add(track)
+
+    def add(self, track):
+        """
+        Adds the recording of a track
+
+        The keys known already for the track are kept, so adding it again
+        by ID only loses nothing.
+
+        Args:
+            track: Track object
+
+        """
+        keys = self._keys.setdefault(track.track_id, [])
+        for key in track.recording_keys:
+            if key not in keys:
+                keys.append(key)
+                self._tracks.setdefault(key, []).append(track.track_id)
+
+    def discard(self, track_id):
+        """
+        Removes the recording of a track, if it is there
+
+        Other tracks of the same recording are still found.
+
+        Args:
+            track_id: string
+
+        """
+        for key in self._keys.pop(track_id, []):
+            track_ids = self._tracks[key]
+            track_ids.remove(track_id)
+            if not track_ids:
+                del self._tracks[key]
+
+    def find(self, track):
+        """
+        Gets the track in the index with the same recording
+
+        Args:
+            track: Track object
+
+        Returns: string, ID of the track found, or None
+
+        """
+        if track.track_id in self._keys:
+            return track.track_id
+        return next((self._tracks[key][0] for key in track.recording_keys
+                     if key in self._tracks), None)
+
+    def __len__(self):
+        return len(self._keys)
+
 
 class Playlist(object):
     """Playlist model"""
@@ -217,6 +502,21 @@ class Playlist(object):
         self._username = username
         self._spotify = spotify_instance
         self._playlist_details = playlist_details
+        self._snapshot_id = playlist_details.get('snapshot_id')
+        self._mirror = None
+        self.recordings = RecordingIndex()
+        # The outbox flusher changes the mirror while the votes are checked
+        self._lock = threading.RLock()
+
+    @property
+    def snapshot_id(self):
+        """
+        Version of the playlist the local mirror reflects
+
+        Returns: string
+
+        """
+        return self._snapshot_id
 
     @property
     def tracks(self):
@@ -225,11 +525,116 @@ class Playlist(object):
 
         Returns: list of Track objects
 
+        """
+        return list(self.iter_tracks())
+
+    def iter_tracks(self, page_size=100):
+        """
+        Get the tracks in the playlist
+
+        The tracks come from the local mirror, which is only read again from
+        Spotify if the playlist changed since it was last seen.
+
+        Args:
+            page_size: integer, tracks per page when the mirror is refetched
+
+        Returns: iterator of Track objects
+
+        """
+        with self._lock:
+            self.refresh(page_size)
+            return iter(list(self._mirror))
+
+    def find_recording(self, track):
+        """
+        Gets the track of the playlist that is a version of the given one
+
+        Only the local mirror is looked at, Spotify is just asked for the
+        tracks the first time. Changes made by others are picked up by the
+        next refresh.
+
+        Args:
+            track: Track object
+
+        Returns: string, ID of the track in the playlist, or None
+
+        """
+        with self._lock:
+            if self._mirror is None:
+                self.refresh()
+            return self.recordings.find(track)
+
+    def refresh(self, page_size=100, force=False):
+        """
+        Syncs the local mirror if the playlist was changed by someone else
+
+        Only the snapshot ID is requested. The tracks are read again when it
+        differs from the one of the last read or mutation, and the difference
+        with the mirror is logged.
+
+        Args:
+            page_size: integer, tracks per page when the mirror is refetched
+            force: boolean, read the tracks again even if nothing changed,
+                to get the details of the tracks added by ID
+
+        Returns: boolean, whether the tracks were read again
+
+        """
+        with self._lock:
+            remote = self._spotify.user_playlist(self._username,
+                                                 self.playlist_id,
+                                                 fields='snapshot_id').get('snapshot_id')
+            if not force and self._mirror is not None and remote == self._snapshot_id:
+                return False
+            tracks = list(self._fetch_tracks(page_size))
+            if self._mirror is not None:
+                mirrored = set(track.uri for track in self._mirror)
+                fetched = set(track.uri for track in tracks)
+                self._logger.info('Playlist %s changed remotely, %s tracks added and %s removed',
+                                  self.name,
+                                  len(fetched - mirrored),
+                                  len(mirrored - fetched))
+            self._mirror = tracks
+            self.recordings = RecordingIndex(tracks)
+            self._snapshot_id = remote
+            return True
+
+    def _fetch_tracks(self, page_size=100):
+        """
+        Get the tracks in the playlist one page at a time
+
+        Following pages are only requested if the consumer keeps iterating.
+
+        Args:
+            page_size: integer
+
+        Returns: generator of Track objects
+
         """
         songs_playlist = self._spotify.user_playlist_tracks(user=self._username,
-                                                            playlist_id=self.playlist_id)
-        return [Track(track.get('track')) for track
-                in songs_playlist.get('items')]
+                                                            playlist_id=self.playlist_id,
+                                                            limit=page_size)
+        while True:
+            for item in songs_playlist.get('items', []):
+                if item.get('track'):
+                    yield Track(item.get('track'))
+            if not songs_playlist.get('next'):
+                return
+            songs_playlist = self._spotify.next(songs_playlist)
+
+    def _update_snapshot(self, result):
+        """
+        Keeps the snapshot ID returned by a mutation
+
+        Args:
+            result: dictionary returned by Spotify
+
+        Returns: Snapshot ID
+
+        """
+        if result and result.get('snapshot_id'):
+            self._snapshot_id = result.get('snapshot_id')
+        return self._snapshot_id
 
     def delete_all_tracks(self):
         """
@@ -238,27 +643,147 @@ class Playlist(object):
         Returns: Snapshot ID
 
         """
-        track_ids = [track.track_id for track in self.tracks]
-        return self._spotify.user_playlist_remove_all_occurrences_of_tracks(self._username,
-                                                                            self.playlist_id,
-                                                                            track_ids)
+        with self._lock:
+            track_ids = [track.track_id for track in self.iter_tracks()]
+            for start in range(0, len(track_ids), MAX_TRACKS_PER_CALL):
+                result = self._spotify.user_playlist_remove_all_occurrences_of_tracks(
+                    self._username,
+                    self.playlist_id,
+                    track_ids[start:start + MAX_TRACKS_PER_CALL],
+                    snapshot_id=self._snapshot_id)
+                self._update_snapshot(result)
+            self._mirror = []
+            self.recordings = RecordingIndex()
+            return self._snapshot_id
 
     def add_track(self, track_id):
         """
         Add a track to the playlist
 
         Args:
-            track_id: string
+            track_id: string, or Track object to keep its recording
 
         Returns: Boolean
 
         """
-        self._logger.info("Adding song %s", track_id)
-        self._spotify.user_playlist_add_tracks(user=self._username,
-                                               playlist_id=self.uri,
-                                               tracks=[track_id])
+        self.add_tracks([track_id])
         return True
 
+    def add_tracks(self, track_ids):
+        """
+        Adds many tracks to the playlist, as few calls as possible
+
+        Args:
+            track_ids: list of strings, or Track objects to keep their recordings
+
+        Returns: Snapshot ID
+
+        """
+        tracks = [track if isinstance(track, Track) else
+                  Track({'id': track, 'uri': 'spotify:track:{}'.format(track)})
+                  for track in track_ids]
+        with self._lock:
+            for start in range(0, len(tracks), MAX_TRACKS_PER_CALL):
+                chunk = tracks[start:start + MAX_TRACKS_PER_CALL]
+                self._logger.info("Adding %s songs", len(chunk))
+                result = self._spotify.user_playlist_add_tracks(user=self._username,
+                                                                playlist_id=self.uri,
+                                                                tracks=[track.track_id
+                                                                        for track in chunk])
+                self._update_snapshot(result)
+                if self._mirror is not None:
+                    self._mirror.extend(chunk)
+                    for track in chunk:
+                        self.recordings.add(track)
+            return self._snapshot_id
+
+    def reconcile(self, track_ids):
+        """
+        Makes the playlist hold exactly the given tracks
+
+        Only the tracks missing are added and only the ones not wanted are
+        removed, instead of emptying and filling the playlist again.
+
+        Args:
+            track_ids: list of strings
+
+        Returns: tuple of the lists of track IDs added and removed
+
+        """
+        current = [track.track_id for track in self.iter_tracks()]
+        wanted = set(track_ids)
+        present = set(current)
+        removed = [track_id for track_id in current if track_id not in wanted]
+        added = []
+        for track_id in track_ids:
+            if track_id not in present:
+                present.add(track_id)
+                added.append(track_id)
+        if removed:
+            self.remove_tracks(removed)
+        if added:
+            self.add_tracks(added)
+        self._logger.info('Reconciled playlist %s: %s added, %s removed',
+                          self.name, len(added), len(removed))
+        return added, removed
+
+    def remove_tracks(self, track_ids):
+        """
+        Removes tracks from the playlist
+
+        The known snapshot ID is sent along so Spotify applies the removal to
+        the version of the playlist the mirror reflects.
+
+        Args:
+            track_ids: list of strings
+
+        Returns: Snapshot ID
+
+        """
+        with self._lock:
+            for start in range(0, len(track_ids), MAX_TRACKS_PER_CALL):
+                result = self._spotify.user_playlist_remove_all_occurrences_of_tracks(
+                    self._username,
+                    self.playlist_id,
+                    track_ids[start:start + MAX_TRACKS_PER_CALL],
+                    snapshot_id=self._snapshot_id)
+                self._update_snapshot(result)
+            if self._mirror is not None:
+                removed = set(track_ids)
+                self._mirror = [track for track in self._mirror
+                                if track.track_id not in removed]
+                for track_id in removed:
+                    self.recordings.discard(track_id)
+            return self._snapshot_id
+
+    def reorder(self, range_start, insert_before, range_length=1):
+        """
+        Moves tracks within the playlist
+
+        Args:
+            range_start: integer, position of the first track to move
+            insert_before: integer, position to move them before
+            range_length: integer, number of tracks to move
+
+        Returns: Snapshot ID
+
+        """
+        with self._lock:
+            result = self._spotify.user_playlist_reorder_tracks(self._username,
+                                                                self.playlist_id,
+                                                                range_start,
+                                                                insert_before,
+                                                                range_length=range_length,
+                                                                snapshot_id=self._snapshot_id)
+            self._update_snapshot(result)
+            if self._mirror is not None:
+                moved = self._mirror[range_start:range_start + range_length]
+                del self._mirror[range_start:range_start + range_length]
+                if insert_before > range_start:
+                    insert_before -= range_length
+                self._mirror[insert_before:insert_before] = moved
+            return self._snapshot_id
+
     @property
     def href(self):
         """
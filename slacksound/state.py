@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: state.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for state
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import os
+import threading
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''state'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def track_id_from(reference):
+    """
+    Gets the track ID out of a Spotify URI or link
+
+    Examples:
+        in: 'spotify:track:6rqhFgbbKwnb9MLmUQDhG6'
+        out: '6rqhFgbbKwnb9MLmUQDhG6'
+
+    Args:
+        reference: string, track ID, URI or open.spotify.com link
+
+    Returns: string
+
+    """
+    return reference.rstrip('/').split('?')[0].replace(':', '/').split('/')[-1]
+
+
+def load_session(path):
+    """
+    Reads a session definition, the list of tracks a playlist should have
+
+    Args:
+        path: string, JSON file with a list of track IDs, URIs or links
+
+    Returns: list of track IDs
+
+    """
+    with open(path) as session_file:
+        return [track_id_from(reference) for reference in json.load(session_file)]
+
+
+class VoteState(object):
+    """
+    Tracks voted into the playlist, persisted in a JSON file
+
+    The file is replaced atomically on every change so that a crash never
+    leaves it half written.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise object
+
+        Args:
+            path: string, location of the state file
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._path = path
+        self._lock = threading.Lock()
+        self._tracks = []
+        if os.path.isfile(path):
+            with open(path) as state_file:
+                self._tracks = json.load(state_file).get('tracks', [])
+            self._logger.debug('Loaded %s voted tracks from %s',
+                               len(self._tracks), path)
+
+    @property
+    def tracks(self):
+        """
+        IDs of the voted tracks, in the order they were voted
+
+        Returns: list of strings
+
+        """
+        with self._lock:
+            return list(self._tracks)
+
+    def add(self, track_id):
+        """
+        Records a voted track
+
+        Args:
+            track_id: string
+
+        """
+        with self._lock:
+            if track_id not in self._tracks:
+                self._tracks.append(track_id)
+                self._save()
+
+    def remove(self, track_ids):
+        """
+        Forgets tracks taken out of the playlist
+
+        Args:
+            track_ids: list of strings
+
+        """
+        with self._lock:
+            removed = set(track_ids)
+            self._tracks = [track_id for track_id in self._tracks
+                            if track_id not in removed]
+            self._save()
+
+    def replace(self, track_ids):
+        """
+        Replaces all the voted tracks
+
+        Args:
+            track_ids: list of strings
+
+        """
+        with self._lock:
+            self._tracks = list(track_ids)
+            self._save()
+
+    def _save(self):
+        """Writes the state to a temporary file and moves it in place"""
+        temporary = '{}.tmp'.format(self._path)
+        with open(temporary, 'w') as state_file:
+            json.dump({'tracks': self._tracks}, state_file)
+        os.rename(temporary, self._path)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: supervisor.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for supervisor
+
+Runs many channel to playlist bindings on a pool of worker processes.
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import time
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''supervisor'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring
+
+    Every node gets many points on the ring and a key belongs to the node of
+    the first point after its hash, so adding or removing a node only moves
+    the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        """
+        Initialise object
+
+        Args:
+            nodes: iterable of strings
+            replicas: integer, points per node
+        """
+        points = sorted((_hash('{node}-{replica}'.format(node=node, replica=replica)), node)
+                        for node in nodes
+                        for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def node(self, key):
+        """
+        Gets the node a key belongs to
+
+        Args:
+            key: string
+
+        Returns: string
+
+        """
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[position]
+
+
+class SharedRateLimiter(object):
+    """
+    Token bucket shared by all the worker processes
+
+    It has the same interface as RateLimiter, its state lives in shared
+    memory so every process draws from the same budget. When any process
+    is asked by the host to retry later, all of them wait.
+    """
+
+    def __init__(self, calls_per_second=10.0, burst=10, host='api.spotify.com'):
+        """
+        Initialise object
+
+        Args:
+            calls_per_second: float
+            burst: integer
+            host: string, host whose Retry-After is honoured
+        """
+        self.calls_per_second = calls_per_second
+        self.burst = burst
+        self.host = host
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.Value('d', float(burst), lock=False)
+        self._updated = multiprocessing.Value('d', time.time(), lock=False)
+        self._retry_at = multiprocessing.Value('d', 0.0, lock=False)
+
+    def retry_later(self, host, seconds):
+        """
+        Holds the calls back after a host answered with Retry-After
+
+        Args:
+            host: string
+            seconds: float
+
+        """
+        if host != self.host:
+            return
+        with self._lock:
+            self._retry_at.value = max(self._retry_at.value, time.time() + seconds)
+
+    def acquire(self):
+        """
+        Blocks until a call can be made
+
+        Returns: float, seconds waited
+
+        """
+        with self._lock:
+            retry_after = max(self._retry_at.value - time.time(), 0.0)
+        if retry_after:
+            time.sleep(retry_after)
+        with self._lock:
+            now = time.time()
+            self._tokens.value = min(self.burst,
+                                     self._tokens.value +
+                                     (now - self._updated.value) * self.calls_per_second)
+            self._updated.value = now
+            self._tokens.value -= 1
+            tokens = self._tokens.value
+        wait = -tokens / self.calls_per_second if tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return retry_after + wait
+
+
+class Supervisor(object):
+    """
+    Shards bindings over worker processes and keeps them running
+
+    Bindings are assigned to workers by consistent hash of their channel,
+    so the same channel always lands on the same worker, also when bindings
+    are added or removed. Workers that die are started again, waiting
+    longer every time one keeps crashing. The number of bindings of all the
+    workers lives in shared memory, so the workers left running see it
+    change when bindings are added or removed.
+    """
+
+    def __init__(self, bindings, target, processes=None, max_backoff=60.0):
+        """
+        Initialise object
+
+        Args:
+            bindings: list of SlackSound namedtuples
+            target: callable run by every worker with its list of bindings
+                and the shared Value of the number of bindings of all the
+                workers
+            processes: integer, defaults to the number of CPUs
+            max_backoff: float, most seconds to wait before a restart
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._target = target
+        self._max_backoff = max_backoff
+        self._ring = HashRing(['worker-{}'.format(number)
+                               for number in range(processes or multiprocessing.cpu_count())])
+        self._total = multiprocessing.Value('i', len(bindings))
+        self.shards = self._shard(bindings)
+        self._workers = {}
+        self._started = {}
+        self._due = {}
+        self._restarts = {}
+
+    @property
+    def total(self):
+        """
+        Number of bindings of all the workers
+
+        Returns: integer
+
+        """
+        return self._total.value
+
+    def _shard(self, bindings):
+        shards = {}
+        for binding in bindings:
+            shards.setdefault(self._ring.node(binding.channel), []).append(binding)
+        return shards
+
+    def _start(self, name):
+        worker = multiprocessing.Process(target=self._target,
+                                         args=(self.shards[name], self._total),
+                                         name=name)
+        worker.daemon = True
+        worker.start()
+        self._workers[name] = worker
+        self._started[name] = time.time()
+        self._logger.info('Started %s with channels %s', name,
+                          ', '.join(binding.channel for binding in self.shards[name]))
+
+    def _terminate(self, name):
+        worker = self._workers.pop(name, None)
+        self._due.pop(name, None)
+        if worker:
+            worker.terminate()
+            worker.join()
+
+    def start(self):
+        """Starts a worker for every shard"""
+        for name in self.shards:
+            self._start(name)
+
+    def reshard(self, bindings, restart_all=False):
+        """
+        Switches to a new list of bindings
+
+        Only the workers whose bindings changed are started again, the rest
+        go on undisturbed.
+
+        Args:
+            bindings: list of SlackSound namedtuples
+            restart_all: boolean, start every worker again anyway
+
+        Returns: list of names of the workers started again or stopped
+
+        """
+        shards = self._shard(bindings)
+        changed = sorted(name for name in set(self.shards) | set(shards)
+                         if restart_all or self.shards.get(name) != shards.get(name))
+        for name in changed:
+            self._terminate(name)
+        self.shards = shards
+        self._total.value = len(bindings)
+        for name in changed:
+            if name in shards:
+                self._start(name)
+            else:
+                self._logger.info('Stopped %s, it has no channels left', name)
+        return changed
+
+    def check(self):
+        """
+        Restarts the workers that died
+
+        Returns: list of names of the workers restarted
+
+        """
+        restarted = []
+        now = time.time()
+        for name, worker in list(self._workers.items()):
+            if worker.is_alive():
+                continue
+            if name not in self._due:
+                if now - self._started[name] > self._max_backoff:
+                    self._restarts[name] = 0
+                self._restarts[name] = self._restarts.get(name, 0) + 1
+                backoff = min(2 ** (self._restarts[name] - 1), self._max_backoff)
+                self._logger.error('%s exited with code %s, restarting in %ss',
+                                   name, worker.exitcode, backoff)
+                self._due[name] = now + backoff
+            if now >= self._due[name]:
+                del self._due[name]
+                self._start(name)
+                restarted.append(name)
+        return restarted
+
+    def stop(self):
+        """Terminates all the workers"""
+        for worker in self._workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        for worker in self._workers.values():
+            worker.join()
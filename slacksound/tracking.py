@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: tracking.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for tracking
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import heapq
+import logging
+import time
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''tracking'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+def fingerprint(message):
+    """
+    Summarises everything of a message that can change a vote
+
+    That is every reaction with its count and users, and the titles of the
+    attachments as Slack unfurls links some time after they are posted.
+
+    Args:
+        message: Message object
+
+    Returns: integer
+
+    """
+    reactions = tuple(sorted((reaction.name,
+                              reaction.count,
+                              tuple(sorted(reaction.users)))
+                             for reaction in message.reaction))
+    titles = tuple(attachment.title for attachment in message.attachments)
+    return hash((reactions, titles))
+
+
+class ReactionTracker(object):
+    """
+    Remembers the fingerprint of every message seen
+
+    Only messages that are new or whose fingerprint changed since they were
+    last seen are reported as changed.
+    """
+
+    def __init__(self):
+        """Initialise object"""
+        self._fingerprints = {}
+        self.generation = 0
+
+    def changed(self, message):
+        """
+        Whether a message changed since it was last seen
+
+        Args:
+            message: Message object
+
+        Returns: boolean
+
+        """
+        current = fingerprint(message)
+        if self._fingerprints.get(message.ts) == current:
+            return False
+        self._fingerprints[message.ts] = current
+        self.generation += 1
+        return True
+
+    def forget(self, timestamp):
+        """
+        Stops tracking a message
+
+        Args:
+            timestamp: string, ts of the message
+
+        """
+        self._fingerprints.pop(timestamp, None)
+
+    def timestamps(self):
+        """
+        Timestamps of all the messages tracked
+
+        Returns: list of strings
+
+        """
+        return list(self._fingerprints)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def __contains__(self, timestamp):
+        return timestamp in self._fingerprints
+
+
+class TrackingWindow(object):
+    """
+    Bounds the messages that are still considered for votes
+
+    Messages leave the window when they get older than max_age, when more
+    than max_count are tracked, or once they are settled: their song was
+    added to the playlist, was there already or can't be found. The oldest
+    boundary only moves forward, so messages left behind are not fetched
+    again, and settled ones are remembered only until the boundary passes
+    them.
+    """
+
+    def __init__(self, start_time=0, max_age=None, max_count=None):
+        """
+        Initialise object
+
+        Args:
+            start_time: float, unix time of the oldest message to consider
+            max_age: float, seconds a message is considered for, optional
+            max_count: integer, messages tracked at most, optional
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.oldest = start_time
+        self.max_age = max_age
+        self.max_count = max_count
+        self._settled = set()
+
+    def contains(self, message):
+        """
+        Whether a message still needs to be looked at
+
+        Args:
+            message: Message object
+
+        Returns: boolean
+
+        """
+        return message.unix_time >= self.oldest and message.ts not in self._settled
+
+    def settle(self, message, tracker):
+        """
+        Takes a message out of the window for good
+
+        Args:
+            message: Message object
+            tracker: ReactionTracker object
+
+        """
+        self._settled.add(message.ts)
+        tracker.forget(message.ts)
+
+    def evict(self, tracker, now=None):
+        """
+        Moves the window forward, dropping what fell out of it
+
+        Args:
+            tracker: ReactionTracker object
+            now: float, unix time, defaults to the current time
+
+        Returns: integer, number of messages evicted
+
+        """
+        if self.max_age:
+            self.oldest = max(self.oldest, (now or time.time()) - self.max_age)
+        timestamps = tracker.timestamps()
+        if self.max_count and len(timestamps) > self.max_count:
+            kept = heapq.nlargest(self.max_count, timestamps, key=float)
+            self.oldest = max(self.oldest, float(kept[-1]))
+        evicted = [timestamp for timestamp in timestamps
+                   if float(timestamp) < self.oldest]
+        for timestamp in evicted:
+            tracker.forget(timestamp)
+        self._settled = set(timestamp for timestamp in self._settled
+                            if float(timestamp) >= self.oldest)
+        if evicted:
+            self._logger.debug('Evicted %s messages older than %s',
+                               len(evicted), self.oldest)
+        return len(evicted)
+
+
+class PendingUnfurls(object):
+    """
+    Messages whose links Slack has not unfurled yet
+
+    Slack adds the attachments of a link some time after the message is
+    posted. Those messages are asked for again on their own, waiting longer
+    after every try, until their attachments show up or max_age passes,
+    as some links never unfurl.
+    """
+
+    def __init__(self, initial=1.0, backoff=2, max_delay=30.0, max_age=300.0):
+        """
+        Initialise object
+
+        Args:
+            initial: float, seconds to wait before the first try
+            backoff: number, factor the wait grows by after every try
+            max_delay: float, longest wait between tries
+            max_age: float, seconds after which a message is given up on
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.initial = initial
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.max_age = max_age
+        self._pending = {}
+
+    def observe(self, message, now=None):
+        """
+        Starts or stops waiting for the unfurl of a message
+
+        Args:
+            message: Message object
+            now: float, unix time, defaults to the current time
+
+        """
+        if message.attachments or not message.links:
+            self._pending.pop(message.ts, None)
+        elif message.ts not in self._pending:
+            now = time.time() if now is None else now
+            self._pending[message.ts] = [now + self.initial, self.initial, now]
+
+    def due(self, now=None):
+        """
+        Timestamps of the messages to ask for again
+
+        Every timestamp returned is scheduled for its next try.
+
+        Args:
+            now: float, unix time, defaults to the current time
+
+        Returns: list of strings
+
+        """
+        now = time.time() if now is None else now
+        due = []
+        for timestamp, (when, delay, first) in list(self._pending.items()):
+            if when > now:
+                continue
+            if now - first > self.max_age:
+                self._logger.debug('Links of %s never unfurled', timestamp)
+                del self._pending[timestamp]
+                continue
+            delay = min(delay * self.backoff, self.max_delay)
+            self._pending[timestamp] = [now + delay, delay, first]
+            due.append(timestamp)
+        return due
+
+    @property
+    def next_due(self):
+        """
+        Unix time of the next try, None if nothing is pending
+
+        Returns: float
+
+        """
+        return min(entry[0] for entry in self._pending.values()) if self._pending else None
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class ThreadTracker(object):
+    """
+    Threads whose replies need to be fetched
+
+    A thread is fetched when its parent shows a new latest reply, from the
+    last reply fetched on, and while some of its replies with links are
+    still open for votes, from the oldest of those on. Threads that are
+    quiet and settled cost no calls.
+    """
+
+    def __init__(self):
+        """Initialise object"""
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self._latest = {}
+        self._cursors = {}
+        self._open = {}
+        self._changed = set()
+
+    def observe(self, message):
+        """
+        Notes the latest reply of a thread parent
+
+        Args:
+            message: Message object
+
+        Returns: boolean, whether the thread got new replies
+
+        """
+        if not message.reply_count or message.latest_reply == self._latest.get(message.ts):
+            return False
+        self._latest[message.ts] = message.latest_reply
+        self._changed.add(message.ts)
+        return True
+
+    def due(self):
+        """
+        Threads to fetch, with the reply to fetch them from
+
+        Returns: list of (thread ts, oldest reply ts) tuples
+
+        """
+        threads = self._changed | set(self._open)
+        self._changed = set()
+        return [(thread_ts, self._open.get(thread_ts, self._cursors.get(thread_ts, 0)))
+                for thread_ts in sorted(threads, key=float)]
+
+    def fetched(self, thread_ts, replies, open_replies):
+        """
+        Moves the cursor of a thread past the replies fetched
+
+        Args:
+            thread_ts: string
+            replies: list of Message objects fetched
+            open_replies: list of the ts of the replies still open for votes
+
+        """
+        if replies:
+            self._cursors[thread_ts] = max([reply.ts for reply in replies] +
+                                           [self._cursors.get(thread_ts, '0')], key=float)
+        if open_replies:
+            self._open[thread_ts] = min(open_replies, key=float)
+        else:
+            self._open.pop(thread_ts, None)
+
+    def evict(self, oldest):
+        """
+        Stops following the threads of parents older than a boundary
+
+        Args:
+            oldest: float, unix time
+
+        """
+        for thread_ts in [thread_ts for thread_ts in self._latest if float(thread_ts) < oldest]:
+            self._latest.pop(thread_ts, None)
+            self._cursors.pop(thread_ts, None)
+            self._open.pop(thread_ts, None)
+            self._changed.discard(thread_ts)
+
+    def __len__(self):
+        return len(self._latest)
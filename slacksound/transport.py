@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File: transport.py
+#
+# Copyright 2017 Oriol Fabregas
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to
+#  deal in the Software without restriction, including without limitation the
+#  rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+#  sell copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#  DEALINGS IN THE SOFTWARE.
+#
+
+"""
+Main code for transport
+
+.. _Google Python Style Guide:
+   http://google.github.io/styleguide/pyguide.html
+
+"""
+
+import json
+import logging
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+import six
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+from slackclient.slackrequest import SlackRequest
+
+__author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
+__docformat__ = '''google'''
+__date__ = '''2017-10-13'''
+__copyright__ = '''Copyright 2017, Oriol Fabregas'''
+__credits__ = ["Oriol Fabregas"]
+__license__ = '''MIT'''
+__maintainer__ = '''Oriol Fabregas'''
+__email__ = '''<fabregas.oriol@gmail.com>'''
+__status__ = '''Development'''  # "Prototype", "Development", "Production".
+
+
+# This is the main prefix used for logging
+LOGGER_BASENAME = '''transport'''
+LOGGER = logging.getLogger(LOGGER_BASENAME)
+LOGGER.addHandler(logging.NullHandler())
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that keeps its connection pools open
+
+    Spotipy calls close() on the adapter of every response it gets, which
+    for a regular HTTPAdapter drops all the pooled connections.
+    """
+
+    def close(self):
+        """Ignores per response closes so connections are reused"""
+        pass
+
+    def shutdown(self):
+        """Closes all pooled connections"""
+        super(KeepAliveAdapter, self).close()
+
+
+class ETagAdapter(KeepAliveAdapter):
+    """
+    KeepAliveAdapter that revalidates GET responses by their ETag
+
+    The bodies of the last responses with an ETag are kept. The same GET
+    is sent again with If-None-Match and, when the server answers 304 Not
+    Modified, the kept body is returned as a 200 so callers can't tell.
+    """
+
+    def __init__(self, max_entries=256, **kwargs):
+        """
+        Initialise object
+
+        Args:
+            max_entries: integer, responses kept, least recently used dropped
+            **kwargs: arguments of HTTPAdapter
+        """
+        super(ETagAdapter, self).__init__(**kwargs)
+        self.max_entries = max_entries
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._etag_lock = threading.Lock()
+
+    def send(self, request, **kwargs):  # pylint: disable=arguments-differ
+        """
+        Sends a request, conditionally if its response is kept
+
+        Args:
+            request: PreparedRequest object
+            **kwargs: arguments of HTTPAdapter.send
+
+        Returns: Response object
+
+        """
+        if request.method != 'GET' or kwargs.get('stream'):
+            return super(ETagAdapter, self).send(request, **kwargs)
+        with self._etag_lock:
+            entry = self._entries.pop(request.url, None)
+            if entry:
+                self._entries[request.url] = entry
+        if entry:
+            request.headers['If-None-Match'] = entry[0]
+        response = super(ETagAdapter, self).send(request, **kwargs)
+        if response.status_code == 304 and entry:
+            # Reading the empty body gives the connection back to the pool
+            response.content  # pylint: disable=pointless-statement
+            response.close()
+            response.status_code = 200
+            response.reason = 'OK'
+            response._content = entry[1]  # pylint: disable=protected-access
+            response.headers.update(entry[2])
+            self.hits += 1
+        elif response.status_code == 200 and response.headers.get('ETag'):
+            headers = dict((name, response.headers[name])
+                           for name in ('Content-Type',) if name in response.headers)
+            with self._etag_lock:
+                self._entries[request.url] = (response.headers['ETag'],
+                                              response.content,
+                                              headers)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return response
+
+
+class Transport(object):
+    """
+    Pooled HTTP transport shared by the Slack and Spotify clients
+
+    One connection pool is mounted on every session handed to it, so both
+    clients reuse open keep-alive connections instead of doing a new TLS
+    handshake per call.
+    """
+
+    def __init__(self,
+                 pool_connections=4,
+                 pool_maxsize=16,
+                 timeout=10,
+                 compression=True,
+                 etag_entries=256):
+        """
+        Initialise object
+
+        Args:
+            pool_connections: integer, number of hosts to keep pools for
+            pool_maxsize: integer, connections kept open per host
+            timeout: float, seconds to wait for every call
+            compression: boolean, whether to accept gzip/deflate responses
+            etag_entries: integer, Spotify responses kept for revalidation
+        """
+        self._logger = logging.getLogger('{base}.{suffix}'
+                                         .format(base=LOGGER_BASENAME,
+                                                 suffix=self.__class__.__name__)
+                                         )
+        self.timeout = timeout
+        self.compression = compression
+        self._adapter = KeepAliveAdapter(pool_connections=pool_connections,
+                                         pool_maxsize=pool_maxsize)
+        self._spotify_adapter = ETagAdapter(max_entries=etag_entries,
+                                            pool_connections=1,
+                                            pool_maxsize=pool_maxsize)
+        self.session = Session()
+        self.mount(self.session)
+        self._lock = threading.Lock()
+        self._retry_at = {}
+        self._calls = Counter()
+        self._listeners = []
+
+    def mount(self, session):
+        """
+        Makes a session use the shared connection pool
+
+        Args:
+            session: Session object
+
+        Returns: Session object
+
+        """
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+        if not self.compression:
+            session.headers['Accept-Encoding'] = 'identity'
+        return session
+
+    def mount_slack(self, client):
+        """
+        Injects the transport in a SlackClient
+
+        Args:
+            client: SlackClient object
+
+        Returns: SlackClient object
+
+        """
+        client.server.api_requester = PooledSlackRequest(
+            self, proxies=client.server.proxies)
+        return client
+
+    def mount_spotify(self, spotify):
+        """
+        Injects the transport in an authenticated Spotipy object
+
+        The session itself is kept as spotifylib patches it to renew tokens.
+        Reads of the Spotify API are revalidated by their ETag, so unchanged
+        playlists are not downloaded again.
+
+        Args:
+            spotify: Spotify object
+
+        Returns: Spotify object
+
+        """
+        session = spotify._session  # pylint: disable=protected-access
+        self.mount(session)
+        session.mount('https://api.spotify.com/', self._spotify_adapter)
+        session.hooks['response'].append(
+            lambda response, *args, **kwargs: self.note_response(response))
+        spotify.requests_timeout = self.timeout
+        return spotify
+
+    def note_response(self, response):
+        """
+        Counts the call and remembers when a rate limited host can be called again
+
+        Args:
+            response: Response object
+
+        Returns: Response object
+
+        """
+        host = urlparse(response.url).hostname
+        retry_after = response.headers.get('Retry-After')
+        with self._lock:
+            self._calls[host] += 1
+        if response.status_code == 429 and retry_after:
+            self._logger.warning('Rate limited by %s for %ss', host, retry_after)
+            with self._lock:
+                self._retry_at[host] = time.time() + float(retry_after)
+                listeners = list(self._listeners)
+            for listener in listeners:
+                listener(host, float(retry_after))
+        return response
+
+    def add_retry_listener(self, listener):
+        """
+        Tells a callable whenever a host asks to retry later
+
+        Args:
+            listener: callable taking the host and the seconds to wait
+
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def calls(self, host):
+        """
+        Number of calls made to a host so far
+
+        Args:
+            host: string
+
+        Returns: integer
+
+        """
+        with self._lock:
+            return self._calls[host]
+
+    def retry_after(self, host):
+        """
+        Seconds left until a rate limited host can be called again
+
+        Args:
+            host: string
+
+        Returns: float, 0 if the host is not rate limited
+
+        """
+        with self._lock:
+            retry_at = self._retry_at.get(host, 0)
+        return max(retry_at - time.time(), 0.0)
+
+    def close(self):
+        """Closes all pooled connections"""
+        self._adapter.shutdown()
+        self._spotify_adapter.shutdown()
+
+
+class RateLimiter(object):
+    """
+    Token bucket spreading calls to a host over time
+
+    Up to burst calls go through straight away, after that one every
+    1 / calls_per_second seconds. Calls also wait while the host asked to
+    retry later.
+    """
+
+    def __init__(self, calls_per_second=10.0, burst=10, transport=None, host=None):
+        """
+        Initialise object
+
+        Args:
+            calls_per_second: float
+            burst: integer
+            transport: Transport object reporting Retry-After, optional
+            host: string, host whose Retry-After is honoured
+        """
+        self.calls_per_second = calls_per_second
+        self.burst = burst
+        self._transport = transport
+        self._host = host
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.time()
+
+    def acquire(self):
+        """
+        Blocks until a call can be made
+
+        Returns: float, seconds waited
+
+        """
+        waited = 0.0
+        if self._transport and self._host:
+            retry_after = self._transport.retry_after(self._host)
+            if retry_after:
+                time.sleep(retry_after)
+                waited += retry_after
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.calls_per_second)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.calls_per_second if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return waited + wait
+
+
+class PooledSlackRequest(SlackRequest):
+    """SlackRequest doing its calls through a Transport"""
+
+    def __init__(self, transport, proxies=None):
+        """
+        Initialise object
+
+        Args:
+            transport: Transport object
+            proxies: dictionary
+        """
+        super(PooledSlackRequest, self).__init__(proxies=proxies)
+        self._transport = transport
+
+    def do(self, token, request="?", post_data=None, domain="slack.com", timeout=None):
+        """
+        Performs a POST request to the Slack Web API
+
+        Args:
+            token: string
+            request: string, API method
+            post_data: dictionary
+            domain: string
+            timeout: float, defaults to the one of the transport
+
+        Returns: Response object
+
+        """
+        post_data = post_data or {}
+        files = None
+        if request == 'files.upload' and 'file' in post_data:
+            files = {'file': post_data.pop('file')}
+        for key, value in six.iteritems(post_data):
+            if not isinstance(value, six.string_types):
+                post_data[key] = json.dumps(value)
+        post_data['token'] = token
+        url = 'https://{domain}/api/{request}'.format(domain=domain,
+                                                      request=request)
+        response = self._transport.session.post(url,
+                                                headers={'user-agent': self.get_user_agent()},
+                                                data=post_data,
+                                                files=files,
+                                                timeout=timeout or self._transport.timeout,
+                                                proxies=self.proxies)
+        return self._transport.note_response(response)
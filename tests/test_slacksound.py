@@ -33,7 +33,55 @@ Tests for `slacksound` module.
 
 """
 
+import hashlib
+import hmac
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import Future
+from functools import partial
+from unittest import TestCase
 from betamax.fixtures import unittest
+from requests import PreparedRequest, Response
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+# The modules of the package import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'slacksound'))
+
+# pylint: disable=wrong-import-position
+import profiling  # noqa: E402
+import slacksound  # noqa: E402
+import spotifyclient  # noqa: E402
+import transport  # noqa: E402
+from backfill import Backfill  # noqa: E402
+from budget import DurationBudget  # noqa: E402
+from cache import SQLiteCache  # noqa: E402
+from events import EventsReceiver, EventStore, verify_signature  # noqa: E402
+from hotreload import ConfigWatcher  # noqa: E402
+from index import TrackIndex  # noqa: E402
+from logconfig import JsonFormatter, parse_levels  # noqa: E402
+from outbox import ADD, REMOVE, CircuitBreaker, Outbox, OutboxFlusher  # noqa: E402
+from pipeline import VotePipeline  # noqa: E402
+from resolver import TrackResolver  # noqa: E402
+from scheduler import PollScheduler  # noqa: E402
+from slackapi import Channel, Conversation, Message, iter_history_pages  # noqa: E402
+from state import VoteState  # noqa: E402
+from supervisor import HashRing, SharedRateLimiter, Supervisor  # noqa: E402
+from tracking import PendingUnfurls, ReactionTracker, ThreadTracker, TrackingWindow, fingerprint  # noqa: E402
+# pylint: enable=wrong-import-position
 
 __author__ = '''Oriol Fabregas <fabregas.oriol@gmail.com>'''
 __docformat__ = '''google'''
@@ -63,3 +111,1324 @@ class TestSlacksound(unittest.BetamaxTestCase):
         This is where you should tear down what you've setup in setUp before. This method is called after every test.
         """
         pass
+
+
+class FakeSpotify(object):
+    """Stands in for the spotipy client, counting the searches"""
+
+    def __init__(self, **kwargs):
+        self.searches = []
+        self.results = {}
+        self.playlists = []
+
+    def search(self, q, limit, type):  # pylint: disable=redefined-builtin,invalid-name
+        self.searches.append(q)
+        return {'tracks': {'items': self.results.get(q, [])}}
+
+    def user_playlists(self, user):
+        return {'items': list(self.playlists)}
+
+
+COCAINE = {'id': '0' * 21 + 'a',
+           'uri': 'spotify:track:' + '0' * 21 + 'a',
+           'name': 'Cocaine',
+           'popularity': 60,
+           'duration_ms': 221000,
+           'artists': [{'name': 'Eric Clapton'}],
+           'external_ids': {'isrc': 'USUM70000001'}}
+
+
+class TestTrackIndexLookup(TestCase):
+
+    def setUp(self):
+        """Builds a client with a fake Spotify and a new index"""
+        self.directory = tempfile.mkdtemp()
+        self.original = spotifyclient.Spotify
+        spotifyclient.Spotify = FakeSpotify
+        self.index = TrackIndex(os.path.join(self.directory, 'index'))
+        self.client = spotifyclient.SpotifyClient('id', 'secret', 'user', 'password',
+                                                  'callback', 'scope', index=self.index)
+        self.spotify = self.client._spotify  # pylint: disable=protected-access
+        self.spotify.results[b'Eric Clapton - Cocaine'] = [COCAINE]
+
+    def tearDown(self):
+        spotifyclient.Spotify = self.original
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_second_lookup_is_served_from_the_index(self):
+        first = self.client.get_track_by_title('Eric Clapton - Cocaine')
+        second = self.client.get_track_by_title('Eric Clapton - Cocaine')
+        self.assertEqual(len(self.spotify.searches), 1)
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual([track.track_id for track in first],
+                         [track.track_id for track in second])
+
+    def test_index_keeps_the_best_match_and_its_recording(self):
+        karaoke = dict(COCAINE, id='0' * 21 + 'b', popularity=70,
+                       artists=[{'name': 'Sing King'}],
+                       external_ids={'isrc': 'GBKAR0000001'})
+        self.spotify.results[b'Eric Clapton - Cocaine'] = [karaoke, COCAINE]
+        self.client.get_track_by_title('Eric Clapton - Cocaine')
+        indexed, = self.client.get_track_by_title('Eric Clapton - Cocaine')
+        self.assertEqual(indexed.track_id, COCAINE['id'])
+        self.assertIn('isrc:USUM70000001', indexed.recording_keys)
+
+    def test_read_only_index_is_not_written(self):
+        self.client.get_track_by_title('Eric Clapton - Cocaine')
+        reader = TrackIndex(os.path.join(self.directory, 'index'), read_only=True)
+        self.assertEqual(reader.get('eric clapton cocaine')['id'], COCAINE['id'])
+        reader.put('Eric Clapton - Layla', COCAINE)
+        self.assertIsNone(reader.get('Eric Clapton - Layla'))
+        reader.close()
+
+
+class TestTrackIndex(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_titles_are_looked_up_by_their_normalized_form(self):
+        index = TrackIndex(self.path)
+        index.put("Bon Jovi - Livin' On A Prayer", COCAINE)
+        self.assertEqual(index.get('bon jovi livin on a prayer')['id'], COCAINE['id'])
+        self.assertIsNone(index.get('Eric Clapton - Layla'))
+        index.put('Bon Jovi - Livin On A Prayer', dict(COCAINE, popularity=10))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get("Bon Jovi - Livin' On A Prayer")['popularity'], 10)
+        index.close()
+
+    def test_index_grows_and_persists(self):
+        index = TrackIndex(self.path, slots=8)
+        for number in range(20):
+            index.put('title {}'.format(number), dict(COCAINE, duration_ms=number))
+        index.close()
+        reopened = TrackIndex(self.path)
+        self.assertEqual(len(reopened), 20)
+        self.assertEqual([reopened.get('title {}'.format(number))['duration_ms'] for number in range(20)],
+                         list(range(20)))
+        reopened.close()
+
+    def test_second_writer_only_reads(self):
+        first = TrackIndex(self.path, slots=8)
+        first.put('Eric Clapton - Cocaine', COCAINE)
+        second = TrackIndex(self.path)
+        self.assertTrue(second.read_only)
+        second.put('Bon Jovi - Livin On A Prayer', dict(COCAINE, id='0' * 21 + 'b'))
+        for number in range(10):
+            first.put('title {}'.format(number), COCAINE)
+        self.assertEqual(first.get('Eric Clapton - Cocaine')['id'], COCAINE['id'])
+        self.assertIsNone(first.get('Bon Jovi - Livin On A Prayer'))
+        # Growing the index keeps the lock
+        third = TrackIndex(self.path)
+        self.assertTrue(third.read_only)
+        for index in (first, second, third):
+            index.close()
+        reopened = TrackIndex(self.path)
+        self.assertFalse(reopened.read_only)
+        reopened.close()
+
+    def test_other_files_are_refused(self):
+        with open(self.path, 'wb') as other:
+            other.write(b'not an index' * 10)
+        self.assertRaises(ValueError, TrackIndex, self.path)
+
+
+class TestBestMatch(TestCase):
+
+    def setUp(self):
+        self.original = spotifyclient.Track(COCAINE)
+        self.cover = spotifyclient.Track(dict(COCAINE, id='0' * 21 + 'b', popularity=70,
+                                              artists=[{'name': 'Sing King'}]))
+
+    def test_artist_and_title_beat_popularity(self):
+        self.assertIs(spotifyclient.best_match('Eric Clapton - Cocaine', [self.cover, self.original]),
+                      self.original)
+
+    def test_scores_stay_between_0_and_1(self):
+        score = spotifyclient.score_track('eric clapton cocaine', self.original)
+        self.assertGreater(score, spotifyclient.score_track('eric clapton cocaine', self.cover))
+        self.assertLessEqual(score, 1)
+        self.assertEqual(spotifyclient.score_track('eric clapton cocaine', spotifyclient.Track({})), 0)
+
+    def test_nothing_to_match(self):
+        self.assertIsNone(spotifyclient.best_match('Eric Clapton - Cocaine', []))
+
+    def test_batch_resolves_every_title_once(self):
+        original = spotifyclient.Spotify
+        spotifyclient.Spotify = FakeSpotify
+        try:
+            client = spotifyclient.SpotifyClient('id', 'secret', 'user', 'password', 'callback', 'scope')
+        finally:
+            spotifyclient.Spotify = original
+        spotify = client._spotify  # pylint: disable=protected-access
+        spotify.results[b'Eric Clapton - Cocaine'] = [dict(COCAINE, id='0' * 21 + 'b', popularity=70,
+                                                          artists=[{'name': 'Sing King'}]), COCAINE]
+        found = client.get_tracks_by_titles(['Eric Clapton - Cocaine', 'Eric Clapton - Cocaine', 'Nothing'])
+        self.assertEqual(dict((title, track and track.track_id) for title, track in found.items()),
+                         {'Eric Clapton - Cocaine': COCAINE['id'], 'Nothing': None})
+        self.assertEqual(sorted(spotify.searches), [b'Eric Clapton - Cocaine', b'Nothing'])
+
+
+class SlowSpotify(object):
+    """Spotify client whose lookups wait until they are let through"""
+
+    def __init__(self):
+        self.titles = []
+        self.go = threading.Event()
+
+    def get_track_by_title(self, title):
+        self.titles.append(title)
+        self.go.wait(10)
+        return [spotifyclient.Track(dict(COCAINE, name=title))]
+
+
+class TestTrackResolver(TestCase):
+
+    def setUp(self):
+        self.spotify = SlowSpotify()
+        self.resolver = TrackResolver(self.spotify, max_workers=1, max_pending=1)
+
+    def tearDown(self):
+        self.spotify.go.set()
+        self.resolver.shutdown()
+
+    def test_title_in_flight_is_looked_up_once(self):
+        first = self.resolver.resolve('Cocaine')
+        self.assertIs(self.resolver.resolve('Cocaine'), first)
+        self.spotify.go.set()
+        self.assertEqual(first.result(10)[0].name, 'Cocaine')
+        self.assertEqual(self.spotify.titles, ['Cocaine'])
+
+    def test_new_titles_wait_for_a_free_slot(self):
+        self.resolver.resolve('Cocaine')
+        waiting = threading.Thread(target=self.resolver.resolve, args=('Layla',))
+        waiting.start()
+        waiting.join(0.2)
+        self.assertTrue(waiting.is_alive())
+        self.spotify.go.set()
+        waiting.join(10)
+        self.assertFalse(waiting.is_alive())
+
+
+class FakePlaylist(object):
+    """Stands in for a Playlist, failing while Spotify is down"""
+
+    name = 'playlist'
+
+    def __init__(self, track_ids=()):
+        self.track_ids = list(track_ids)
+        self.added = []
+        self.down = False
+
+    def iter_tracks(self):
+        if self.down:
+            raise IOError('Spotify is down')
+        return iter([spotifyclient.Track({'id': track_id}) for track_id in self.track_ids])
+
+    def add_tracks(self, tracks):
+        self.added.extend(tracks)
+        self.track_ids.extend(getattr(track, 'track_id', track) for track in tracks)
+
+    def remove_tracks(self, track_ids):
+        self.track_ids = [track_id for track_id in self.track_ids if track_id not in track_ids]
+
+    def add_track(self, track):
+        self.add_tracks([track.track_id])
+
+    def find_recording(self, track):
+        return track.track_id if track.track_id in self.track_ids else None
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.directory, 'outbox'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_removal_replaces_the_queued_addition(self):
+        self.assertTrue(self.outbox.put('a'))
+        self.assertFalse(self.outbox.put('a'))
+        self.assertTrue(self.outbox.put('a', REMOVE))
+        self.assertEqual([entry[:2] for entry in self.outbox.peek()], [('a', REMOVE)])
+        self.assertNotIn('a', self.outbox)
+
+    def test_change_queued_while_flushing_is_kept(self):
+        self.outbox.put('a')
+        entries = self.outbox.peek()
+        self.outbox.put('a', REMOVE)
+        self.outbox.done(entries)
+        self.assertEqual([entry[:2] for entry in self.outbox.peek()], [('a', REMOVE)])
+
+    def test_flusher_applies_removals_and_additions(self):
+        playlist = FakePlaylist(['a', 'b'])
+        self.outbox.put('a', REMOVE)
+        self.outbox.put('c', ADD)
+        self.outbox.put('b', ADD)
+        self.assertEqual(OutboxFlusher(self.outbox, playlist).flush(), 2)
+        self.assertEqual(playlist.track_ids, ['b', 'c'])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_flusher_adds_the_tracks_with_their_details(self):
+        playlist = FakePlaylist()
+        self.outbox.put(spotifyclient.Track(COCAINE))
+        OutboxFlusher(self.outbox, playlist).flush()
+        self.assertEqual(playlist.added[0].isrc, 'USUM70000001')
+
+    def test_queued_recordings_survive_a_restart(self):
+        self.outbox.put(spotifyclient.Track(COCAINE))
+        reopened = Outbox(os.path.join(self.directory, 'outbox'))
+        remaster = spotifyclient.Track(dict(COCAINE, id='0' * 21 + 'c'))
+        self.assertEqual(reopened.find_recording(remaster), COCAINE['id'])
+        reopened.done(reopened.peek())
+        self.assertIsNone(reopened.find_recording(remaster))
+
+    def test_changes_wait_while_spotify_is_down(self):
+        playlist = FakePlaylist()
+        playlist.down = True
+        flusher = OutboxFlusher(self.outbox, playlist, CircuitBreaker(threshold=1))
+        self.outbox.put('a')
+        self.assertEqual(flusher.flush(), 0)
+        self.assertTrue(flusher.breaker.is_open)
+        self.assertEqual(len(self.outbox), 1)
+
+
+class FakeSlack(object):
+    """Stands in for the Slack client, keeping the messages posted"""
+
+    def __init__(self):
+        self.posted = []
+        self.closed = False
+
+    def post_message(self, text, channel):
+        self.posted.append((text, channel))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResolver(object):
+    """Resolves every title with the next of the given results"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def resolve(self, title):
+        future = Future()
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+        return future
+
+
+Config = namedtuple('Config', ['playlist', 'reaction', 'channel', 'count'])
+
+
+def posted(ts, text='<https://youtu.be/x>', attachments=None, **details):
+    return Message(dict(details, ts=ts, text=text, attachments=attachments or []))
+
+
+class TestVotePipeline(TestCase):
+
+    def setUp(self):
+        self.playlist = FakePlaylist()
+        self.slack = FakeSlack()
+        self.message = Message({'ts': '1500000000.000100',
+                                'attachments': [{'title': 'Eric Clapton - Cocaine (Live)'}],
+                                'reactions': [{'name': 'thumbsup', 'count': 2}]})
+
+    def pipeline(self, resolver):
+        return VotePipeline(self.slack, self.playlist, resolver,
+                            Config('playlist', 'thumbsup', 'general', 2))
+
+    def test_failed_lookup_is_retried_on_the_next_pass(self):
+        pipeline = self.pipeline(FakeResolver(IOError('Spotify is down'),
+                                              [spotifyclient.Track(COCAINE)]))
+        pipeline.process([self.message])
+        self.assertEqual(self.playlist.track_ids, [])
+        pipeline.process([self.message])
+        self.assertEqual(self.playlist.track_ids, [COCAINE['id']])
+        self.assertEqual(self.slack.posted, [('Song Eric Clapton - Cocaine added', 'general')])
+
+    def test_replies_to_settled_parents_are_followed(self):
+        pipeline = self.pipeline(FakeResolver([spotifyclient.Track(COCAINE)]))
+        pipeline.threads = ThreadTracker()
+        pipeline.process([self.message])
+        self.assertEqual(pipeline.threads.due(), [])
+        replied = Message({'ts': self.message.ts,
+                           'attachments': [{'title': 'Eric Clapton - Cocaine'}],
+                           'reactions': [{'name': 'thumbsup', 'count': 2}],
+                           'reply_count': 1,
+                           'latest_reply': '1500000100.000100'})
+        pipeline.process([replied])
+        self.assertEqual(pipeline.threads.due(), [(self.message.ts, 0)])
+
+    def test_replies_are_not_waited_for_on_their_own(self):
+        pipeline = self.pipeline(FakeResolver())
+        pipeline.threads = ThreadTracker()
+        pipeline.unfurls = PendingUnfurls()
+        parent = posted('1500000000.000100', reply_count=1, latest_reply='1500000001.000100')
+        reply = posted('1500000001.000100', thread_ts=parent.ts)
+        pipeline.process([parent])
+        self.assertEqual(len(pipeline.unfurls), 1)
+        pipeline.process_threads(lambda thread_ts, oldest: [reply])
+        self.assertEqual(len(pipeline.unfurls), 1)
+        self.assertEqual(pipeline.threads.due(), [(parent.ts, reply.ts)])
+
+    def test_votes_keep_counting_towards_the_budget(self):
+        pipeline = self.pipeline(FakeResolver([spotifyclient.Track(COCAINE)],
+                                              [spotifyclient.Track(COCAINE)]))
+        pipeline.budget = DurationBudget(10 * 60000)
+        pipeline.process([self.message])
+        more_votes = Message({'ts': self.message.ts,
+                              'attachments': [{'title': 'Eric Clapton - Cocaine'}],
+                              'reactions': [{'name': 'thumbsup', 'count': 5}]})
+        pipeline.process([more_votes])
+        self.assertEqual(self.playlist.track_ids, [COCAINE['id']])
+        self.assertIsNone(pipeline.budget.admit(song('other', 8), 5))
+        self.assertEqual(pipeline.budget.admit(song('other', 8), 6), [COCAINE['id']])
+
+
+class FakeClock(object):
+    """Clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeLogger(object):
+    """Logger keeping the warnings"""
+
+    def __init__(self):
+        self.warnings = []
+
+    def warning(self, message, *args):
+        self.warnings.append(message % args)
+
+
+class TestTickTimer(TestCase):
+
+    def setUp(self):
+        self.original = profiling.default_timer
+        self.clock = profiling.default_timer = FakeClock()
+        self.logger = FakeLogger()
+        self.timer = profiling.TickTimer(slow_tick=2.0, logger=self.logger)
+
+    def tearDown(self):
+        profiling.default_timer = self.original
+
+    def fetch(self, count):
+        for number in range(count):
+            self.clock.advance(0.5)
+            yield number
+
+    def test_nested_spans_count_once(self):
+        self.timer.start_tick()
+        with self.timer.span('evaluate'):
+            self.clock.advance(0.25)
+            with self.timer.span('resolve'):
+                self.clock.advance(1.0)
+        self.assertEqual(self.timer.end_tick(), 1.25)
+        self.assertEqual(self.timer.totals['evaluate'], 0.25)
+        self.assertEqual(self.timer.totals['resolve'], 1.0)
+        self.assertEqual(self.logger.warnings, [])
+
+    def test_slow_ticks_are_logged_and_kept(self):
+        for count in (2, 6):
+            self.timer.start_tick()
+            self.assertEqual(list(self.timer.timed_iter('fetch', self.fetch(count))), list(range(count)))
+            self.timer.end_tick()
+        self.assertEqual((self.timer.ticks, self.timer.slow_ticks), (2, 1))
+        self.assertEqual(self.timer.totals['fetch'], 4.0)
+        self.assertEqual(self.timer.maximums['fetch'], 3.0)
+        self.assertTrue(self.logger.warnings[0].startswith('Slow tick took 3.000s: fetch=3.000s'))
+
+
+class FakeRaw(io.BytesIO):
+    """Body of a response that notes when its connection is released"""
+
+    released = False
+
+    def release_conn(self):
+        self.released = True
+
+
+class TestETagAdapter(TestCase):
+
+    def setUp(self):
+        self.original = transport.KeepAliveAdapter.send
+        self.responses = []
+        transport.KeepAliveAdapter.send = lambda adapter, request, **kwargs: self.responses.pop(0)
+        self.adapter = transport.ETagAdapter()
+        self.request = PreparedRequest()
+        self.request.prepare(method='GET', url='https://api.spotify.com/v1/me')
+
+    def tearDown(self):
+        transport.KeepAliveAdapter.send = self.original
+
+    def respond(self, status, body, headers):
+        response = Response()
+        response.status_code = status
+        response.raw = FakeRaw(body)
+        response.headers.update(headers)
+        self.responses.append(response)
+        return response
+
+    def test_not_modified_releases_the_connection(self):
+        self.respond(200, b'{"id": "me"}', {'ETag': '"1"', 'Content-Type': 'application/json'})
+        self.adapter.send(self.request)
+        not_modified = self.respond(304, b'', {'ETag': '"1"'})
+        response = self.adapter.send(self.request)
+        self.assertEqual(self.request.headers['If-None-Match'], '"1"')
+        self.assertTrue(not_modified.raw.released)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'id': 'me'})
+        self.assertEqual(self.adapter.hits, 1)
+
+
+def slack_response(status=200, headers=None):
+    response = Response()
+    response.status_code = status
+    response.url = 'https://slack.com/api/conversations.history'
+    response.headers.update(headers or {})
+    return response
+
+
+class TestTransport(TestCase):
+
+    def setUp(self):
+        self.transport = transport.Transport(timeout=5)
+        self.posts = []
+        self.transport.session.post = self.post
+
+    def tearDown(self):
+        self.transport.close()
+
+    def post(self, url, **kwargs):
+        self.posts.append((url, kwargs))
+        return slack_response()
+
+    def test_slack_calls_go_through_the_shared_session(self):
+        requester = transport.PooledSlackRequest(self.transport)
+        requester.do('xoxb-1', 'chat.postMessage', {'channel': 'C1', 'attachments': [{'title': 'x'}]})
+        (url, details), = self.posts
+        self.assertEqual(url, 'https://slack.com/api/chat.postMessage')
+        self.assertEqual(details['data'], {'channel': 'C1', 'attachments': '[{"title": "x"}]',
+                                           'token': 'xoxb-1'})
+        self.assertEqual(details['timeout'], 5)
+        self.assertEqual(self.transport.calls('slack.com'), 1)
+
+    def test_connections_outlive_the_closes_of_spotipy(self):
+        adapter = self.transport.session.get_adapter('https://api.spotify.com/v1/me')
+        adapter.poolmanager.connection_from_url('https://api.spotify.com/')
+        adapter.close()
+        self.assertEqual(len(adapter.poolmanager.pools), 1)
+
+    def test_rate_limiter_lets_a_burst_through_and_spaces_the_rest(self):
+        limiter = transport.RateLimiter(calls_per_second=20.0, burst=2)
+        self.assertEqual([limiter.acquire(), limiter.acquire()], [0.0, 0.0])
+        self.assertGreater(limiter.acquire(), 0.04)
+
+    def test_rate_limiter_waits_while_the_host_asks_to(self):
+        limiter = transport.RateLimiter(transport=self.transport, host='api.spotify.com')
+        spotify = slack_response(429, {'Retry-After': '0.2'})
+        spotify.url = 'https://api.spotify.com/v1/search'
+        self.transport.note_response(spotify)
+        self.assertGreater(limiter.acquire(), 0.1)
+
+
+class TestPollScheduler(TestCase):
+
+    def setUp(self):
+        self.transport = transport.Transport()
+        self.scheduler = PollScheduler(min_interval=1.0, max_interval=8.0, calls_per_minute=60,
+                                       transport=self.transport)
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_quiet_channels_back_off_until_something_changes(self):
+        self.assertEqual([self.scheduler.observe('C1', 'same') for _ in range(5)], [1.0, 2.0, 4.0, 8.0, 8.0])
+        self.assertEqual(self.scheduler.observe('C1', 'new'), 1.0)
+        self.assertEqual(self.scheduler.delay('C1'), 1.0)
+
+    def test_floor_follows_the_calls_every_poll_made(self):
+        self.scheduler.observe('C1', 'a', calls=3)
+        self.assertEqual(self.scheduler.observe('C2', 'a', calls=2), 5.0)
+        self.assertEqual(self.scheduler.observe('C1', 'b', calls=1), 3.0)
+        self.scheduler.forget('C2')
+        self.assertEqual(self.scheduler.observe('C1', 'c', calls=1), 1.0)
+
+    def test_nothing_is_polled_while_slack_asks_to_wait(self):
+        self.transport.note_response(slack_response())
+        self.transport.note_response(slack_response(429, {'Retry-After': '30'}))
+        self.assertEqual(self.transport.calls('slack.com'), 2)
+        self.assertEqual(self.transport.calls('api.spotify.com'), 0)
+        self.scheduler.observe('C1', 'a')
+        self.assertGreater(self.scheduler.delay('C1'), 29)
+
+
+class TestRecordingIndex(TestCase):
+
+    def setUp(self):
+        self.track = spotifyclient.Track(COCAINE)
+        self.remaster = spotifyclient.Track(dict(COCAINE, id='0' * 21 + 'c'))
+        self.index = spotifyclient.RecordingIndex([self.track])
+
+    def test_finds_other_versions_of_a_recording(self):
+        self.assertEqual(self.index.find(self.remaster), COCAINE['id'])
+        self.assertIsNone(self.index.find(spotifyclient.Track({'id': 'x', 'name': 'Layla'})))
+
+    def test_adding_by_id_keeps_the_known_keys(self):
+        self.index.add(spotifyclient.Track({'id': COCAINE['id']}))
+        self.assertEqual(self.index.find(self.remaster), COCAINE['id'])
+        self.index.discard(COCAINE['id'])
+        self.assertIsNone(self.index.find(self.remaster))
+        self.assertEqual(len(self.index), 0)
+
+    def test_other_version_is_found_once_one_is_discarded(self):
+        self.index.add(self.remaster)
+        self.index.discard(COCAINE['id'])
+        self.assertEqual(self.index.find(self.track), self.remaster.track_id)
+
+    def test_version_qualifiers_are_ignored(self):
+        for name in ('Cocaine - Remastered 2015', 'Cocaine (Live)', 'Cocaine (2011 Remaster)',
+                     'Cocaine - Single Version', 'Cocaine (Live at Wembley 1986) - Remastered'):
+            version = spotifyclient.Track(dict(COCAINE, id='0' * 21 + 'd', name=name,
+                                               external_ids={'isrc': 'GBUM71500001'}))
+            self.assertEqual(self.index.find(version), COCAINE['id'], name)
+        karaoke = spotifyclient.Track(dict(COCAINE, id='0' * 21 + 'e', name='Cocaine (Karaoke Version)',
+                                           external_ids={'isrc': 'GBUM71500002'}))
+        self.assertIsNone(self.index.find(karaoke))
+
+
+class FakePlaylistApi(object):
+    """Spotipy calls on a single playlist, counting the pages read"""
+
+    def __init__(self, track_ids=()):
+        self.track_ids = list(track_ids)
+        self.snapshot = 1
+        self.pages = 0
+        self.removed_from = []
+
+    def change(self, track_ids):
+        """Changes the playlist as someone else would"""
+        self.track_ids = list(track_ids)
+        return self.mutated()
+
+    def mutated(self):
+        self.snapshot += 1
+        return {'snapshot_id': str(self.snapshot)}
+
+    def user_playlist(self, user, playlist_id, fields):  # pylint: disable=unused-argument
+        return {'snapshot_id': str(self.snapshot)}
+
+    def user_playlist_tracks(self, user, playlist_id, limit):  # pylint: disable=unused-argument
+        return self.page(0, limit)
+
+    def next(self, page):
+        return self.page(page['offset'] + page['limit'], page['limit'])
+
+    def page(self, offset, limit):
+        self.pages += 1
+        return {'items': [{'track': {'id': track_id, 'uri': 'spotify:track:' + track_id}}
+                          for track_id in self.track_ids[offset:offset + limit]],
+                'offset': offset,
+                'limit': limit,
+                'next': 'more' if offset + limit < len(self.track_ids) else None}
+
+    def user_playlist_add_tracks(self, user, playlist_id, tracks):  # pylint: disable=unused-argument
+        self.track_ids.extend(tracks)
+        return self.mutated()
+
+    def user_playlist_remove_all_occurrences_of_tracks(self,  # pylint: disable=unused-argument
+                                                       user,
+                                                       playlist_id,
+                                                       tracks,
+                                                       snapshot_id=None):
+        self.removed_from.append(snapshot_id)
+        return self.change([track_id for track_id in self.track_ids if track_id not in tracks])
+
+
+class TestPlaylist(TestCase):
+
+    def setUp(self):
+        self.api = FakePlaylistApi(['a', 'b', 'c'])
+        self.playlist = spotifyclient.Playlist('user', self.api, {'id': 'P1', 'uri': 'spotify:playlist:P1'})
+
+    def test_tracks_are_read_again_only_when_the_snapshot_changed(self):
+        self.assertTrue(self.playlist.refresh(page_size=2))
+        self.assertEqual(self.api.pages, 2)
+        self.assertFalse(self.playlist.refresh(page_size=2))
+        self.assertEqual([track.track_id for track in self.playlist.iter_tracks()], ['a', 'b', 'c'])
+        self.assertEqual(self.api.pages, 2)
+        self.api.change(['a', 'd'])
+        self.assertTrue(self.playlist.refresh())
+        self.assertEqual([track.track_id for track in self.playlist.tracks], ['a', 'd'])
+        self.assertTrue(self.playlist.refresh(force=True))
+
+    def test_own_changes_keep_the_mirror_in_sync(self):
+        self.playlist.refresh()
+        self.playlist.add_tracks(['d'])
+        self.playlist.remove_tracks(['a'])
+        self.assertEqual(self.api.removed_from, ['2'])
+        self.assertFalse(self.playlist.refresh())
+        self.assertEqual([track.track_id for track in self.playlist.tracks], ['b', 'c', 'd'])
+        self.assertEqual(self.playlist.snapshot_id, '3')
+        self.assertEqual(self.api.pages, 1)
+
+    def test_reconcile_only_applies_the_difference(self):
+        self.assertEqual(self.playlist.reconcile(['c', 'd', 'd', 'a']), (['d'], ['b']))
+        self.assertEqual(self.api.track_ids, ['a', 'c', 'd'])
+        self.assertEqual(self.playlist.reconcile(['a', 'c', 'd']), ([], []))
+
+
+Options = namedtuple('Options', ['reset', 'session'])
+
+
+class TestVoteState(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state')
+        self.state = VoteState(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_votes_survive_a_restart(self):
+        for track_id in ('a', 'b', 'a', 'c'):
+            self.state.add(track_id)
+        self.state.remove(['b'])
+        self.assertEqual(VoteState(self.path).tracks, ['a', 'c'])
+        self.assertEqual(os.listdir(self.directory), ['state'])
+
+    def test_playlist_is_prepared_from_the_session_or_the_state(self):
+        api = FakePlaylistApi(['a', 'b'])
+        playlist = spotifyclient.Playlist('user', api, {'id': 'P1', 'uri': 'spotify:playlist:P1'})
+        self.state.replace(['b', 'c'])
+        slacksound.prepare_playlist(playlist, self.state, Options('keep', ''))
+        self.assertEqual(api.track_ids, ['a', 'b'])
+        slacksound.prepare_playlist(playlist, self.state, Options('reconcile', ''))
+        self.assertEqual(api.track_ids, ['b', 'c'])
+        session = os.path.join(self.directory, 'session.json')
+        with open(session, 'w') as session_file:
+            json.dump(['spotify:track:d', 'https://open.spotify.com/track/b?si=x'], session_file)
+        slacksound.prepare_playlist(playlist, self.state, Options('reconcile', session))
+        self.assertEqual((api.track_ids, self.state.tracks), (['b', 'd'], ['d', 'b']))
+        slacksound.prepare_playlist(playlist, self.state, Options('wipe', ''))
+        self.assertEqual((api.track_ids, self.state.tracks), ([], []))
+
+
+def song(track_id, minutes):
+    return spotifyclient.Track({'id': track_id, 'name': track_id, 'duration_ms': minutes * 60000})
+
+
+class TestDurationBudget(TestCase):
+
+    def setUp(self):
+        self.budget = DurationBudget(10 * 60000, [song('old', 4)])
+
+    def test_lowest_scores_make_room_oldest_first(self):
+        self.assertEqual(self.budget.admit(song('a', 3), 2), [])
+        self.assertEqual(self.budget.admit(song('b', 3), 2), [])
+        self.assertEqual(self.budget.admit(song('c', 3), 3), ['old'])
+        self.assertEqual(self.budget.admit(song('d', 3), 3), ['a'])
+        self.assertEqual(self.budget.total_ms, 9 * 60000)
+        self.assertEqual(len(self.budget), 3)
+
+    def test_higher_scores_are_not_evicted(self):
+        self.budget.admit(song('a', 6), 5)
+        self.assertEqual(self.budget.admit(song('b', 4), 5), ['old'])
+        self.assertIsNone(self.budget.admit(song('c', 3), 5))
+        self.assertEqual(self.budget.admit(song('c', 3), 6), ['a'])
+
+    def test_track_longer_than_the_budget_is_rejected(self):
+        self.assertIsNone(self.budget.admit(song('long', 11), 100))
+        self.assertEqual(len(self.budget), 1)
+
+    def test_rescored_tracks_keep_their_place(self):
+        self.budget.admit(song('a', 3), 2)
+        self.budget.admit(song('b', 3), 2)
+        self.budget.rescore('a', 4)
+        self.assertEqual(self.budget.admit(song('c', 3), 3), ['old'])
+        self.assertEqual(self.budget.admit(song('d', 3), 3), ['b'])
+
+    def test_sync_keeps_the_scores_of_the_tracks_still_there(self):
+        self.budget.admit(song('a', 3), 5)
+        self.budget.admit(song('b', 3), 2)
+        self.budget.sync([song('old', 4), song('a', 2), song('other', 1)])
+        self.assertEqual(self.budget.total_ms, 7 * 60000)
+        self.assertEqual(self.budget.admit(song('c', 5), 3), ['old'])
+        self.assertIsNone(self.budget.admit(song('d', 5), 3))
+        self.assertEqual(self.budget.admit(song('d', 5), 6), ['other', 'c'])
+
+    def test_flusher_syncs_the_budget_when_the_playlist_changed(self):
+        playlist = ChangedPlaylist([song('old', 4), song('other', 5)])
+        flusher = OutboxFlusher(None, playlist, budget=self.budget)
+        self.assertTrue(flusher.sync())
+        self.assertEqual(self.budget.total_ms, 9 * 60000)
+        self.assertEqual(self.budget.admit(song('a', 3), 1), ['old'])
+
+
+class ChangedPlaylist(FakePlaylist):
+    """Playlist someone else changed since it was last read"""
+
+    def __init__(self, tracks):
+        super(ChangedPlaylist, self).__init__()
+        self.tracks = tracks
+
+    @staticmethod
+    def refresh():
+        return True
+
+
+class FakeChannel(object):
+    """Channel whose history is a list of messages, newest first"""
+
+    name = 'general'
+
+    def __init__(self):
+        self.messages = []
+        self.requests = []
+
+    def post(self, ts, title, votes):
+        self.messages.insert(0, Message({'ts': ts,
+                                         'attachments': [{'title': title}],
+                                         'reactions': [{'name': 'thumbsup', 'count': votes}]}))
+
+    def iter_history_pages(self, oldest=0, latest=None):
+        self.requests.append(oldest)
+        page = [message for message in self.messages if message.unix_time > float(oldest)]
+        if page:
+            yield page
+
+
+class FakeTitles(object):
+    """Resolves every title to a track with the title as ID"""
+
+    def get_tracks_by_titles(self, titles, max_workers=4):
+        return {title: spotifyclient.Track({'id': title}) for title in titles}
+
+
+class TestBackfill(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cursor = os.path.join(self.directory, 'cursor')
+        self.channel = FakeChannel()
+        self.playlist = FakePlaylist()
+        self.channel.post('1500000000.000100', 'Layla', 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def backfill(self, count=2):
+        return Backfill(self.channel, FakeTitles(), self.playlist,
+                        Config('playlist', 'thumbsup', 'general', count), self.cursor)
+
+    def test_new_history_is_collected_when_run_again(self):
+        self.assertEqual(self.backfill().run(), ['Layla'])
+        self.channel.post('1500000100.000100', 'Cocaine', 2)
+        self.assertEqual(self.backfill().run(), ['Cocaine'])
+        self.assertEqual(self.channel.requests, [0, '1500000000.000100'])
+
+    def test_cursor_of_other_parameters_is_started_over(self):
+        self.backfill().run()
+        self.playlist.track_ids = []
+        self.assertEqual(self.backfill(count=3).run(), ['Layla'])
+        self.assertEqual(self.channel.requests, [0, 0])
+
+
+class FakeSlackClient(object):
+    """Answers every history call with the messages given, noting the calls"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.client = self
+        self.methods = []
+        self.calls = []
+
+    def api_call(self, method, **kwargs):
+        self.methods.append(method)
+        self.calls.append(kwargs)
+        return {'messages': self.messages}
+
+
+class TestHistory(TestCase):
+
+    def test_message_at_the_oldest_boundary_is_fetched(self):
+        client = FakeSlackClient([{'ts': '1500000000.000100'}])
+        pages = list(iter_history_pages(client, 'conversations.history', 'C1',
+                                        oldest=float('1500000000.000100')))
+        self.assertEqual(client.calls[0]['oldest'], '1500000000.000099')
+        self.assertEqual(len(pages), 1)
+
+    def test_models_read_their_own_history(self):
+        client = FakeSlackClient([{'ts': '1500000000.000100'}])
+        details = {'id': 'C1', 'name': 'general', 'is_private': True}
+        conversation = Conversation(client, details)
+        self.assertEqual(conversation.get_message('1500000000.000100').ts, '1500000000.000100')
+        list(Channel(client, details).iter_history())
+        self.assertEqual(client.methods, ['conversations.history', 'channels.history'])
+        self.assertEqual([call['channel'] for call in client.calls], ['C1', 'C1'])
+        self.assertTrue(conversation.is_private)
+
+
+class TestSQLiteCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count(self, cache):
+        return cache._connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]  # pylint: disable=protected-access
+
+    def test_expired_entries_are_purged_on_open(self):
+        cache = SQLiteCache(self.path)
+        cache.set('search', 'gone', [], ttl=-1)
+        cache.set('search', 'kept', [])
+        self.assertEqual(self.count(SQLiteCache(self.path)), 1)
+
+    def test_expired_entries_are_purged_periodically(self):
+        cache = SQLiteCache(self.path, purge_interval=0)
+        cache.set('search', 'gone', [], ttl=-1)
+        cache.set('search', 'kept', [])
+        self.assertEqual(self.count(cache), 1)
+        self.assertIsNone(cache.get('search', 'gone'))
+        self.assertEqual(cache.get('search', 'kept'), [])
+
+
+def sign(secret, timestamp, body):
+    return 'v0=' + hmac.new(secret.encode('utf-8'),
+                            b'v0:' + timestamp.encode('utf-8') + b':' + body,
+                            hashlib.sha256).hexdigest()
+
+
+class TestVerifySignature(TestCase):
+
+    def setUp(self):
+        self.body = b'{"type": "event_callback"}'
+        self.signature = sign('secret', '1500000000', self.body)
+
+    def test_signed_request_is_accepted(self):
+        self.assertTrue(verify_signature('secret', '1500000000', self.body, self.signature,
+                                         now=1500000060))
+
+    def test_tampered_request_is_rejected(self):
+        self.assertFalse(verify_signature('other', '1500000000', self.body, self.signature,
+                                          now=1500000060))
+        self.assertFalse(verify_signature('secret', '1500000000', self.body + b' ', self.signature,
+                                          now=1500000060))
+        self.assertFalse(verify_signature('secret', '1500000000', self.body, None,
+                                          now=1500000060))
+
+    def test_old_or_malformed_timestamp_is_rejected(self):
+        self.assertFalse(verify_signature('secret', '1500000000', self.body, self.signature,
+                                          now=1500000301))
+        self.assertFalse(verify_signature('secret', None, self.body, self.signature))
+        self.assertFalse(verify_signature('secret', 'yesterday', self.body, self.signature))
+
+
+class TestEventsReceiver(TestCase):
+
+    def setUp(self):
+        self.receiver = EventsReceiver('secret', host='127.0.0.1', port=0, max_queued=1)
+        self.receiver.start()
+
+    def tearDown(self):
+        self.receiver.stop()
+
+    def post(self, payload, secret='secret'):
+        body = json.dumps(payload).encode('utf-8')
+        timestamp = str(int(time.time()))
+        return self.receiver.accept({'X-Slack-Request-Timestamp': timestamp,
+                                     'X-Slack-Signature': sign(secret, timestamp, body)},
+                                    body)
+
+    def callback(self, event_id, event_type='reaction_added'):
+        return {'type': 'event_callback', 'event_id': event_id, 'event': {'type': event_type}}
+
+    def test_unsigned_request_is_refused(self):
+        self.assertEqual(self.post(self.callback('E1'), secret='other'), (401, b''))
+        self.assertEqual(self.receiver.drain(timeout=0), [])
+
+    def test_url_verification_echoes_the_challenge(self):
+        self.assertEqual(self.post({'type': 'url_verification', 'challenge': 'abc'}), (200, b'abc'))
+
+    def test_events_are_queued_once(self):
+        self.assertEqual(self.post(self.callback('E1')), (200, b''))
+        self.assertEqual(self.post(self.callback('E1')), (200, b''))
+        self.assertEqual(self.post(self.callback('E2', 'channel_created')), (200, b''))
+        self.assertEqual(self.receiver.drain(timeout=0), [{'type': 'reaction_added'}])
+
+    def test_full_queue_asks_for_a_retry(self):
+        self.post(self.callback('E1'))
+        self.assertEqual(self.post(self.callback('E2')), (503, b''))
+        self.receiver.drain(timeout=0)
+        self.assertEqual(self.post(self.callback('E2')), (200, b''))
+
+
+class TestEventStore(TestCase):
+
+    def setUp(self):
+        self.store = EventStore('C1')
+        self.store.apply({'type': 'message', 'channel': 'C1', 'ts': '1500000000.000100',
+                          'text': '<https://youtu.be/x>'})
+
+    def react(self, event_type, user, channel='C1'):
+        return self.store.apply({'type': event_type, 'user': user, 'reaction': 'thumbsup',
+                                 'item': {'type': 'message', 'channel': channel,
+                                          'ts': '1500000000.000100'}})
+
+    def test_reactions_are_counted_once_per_user(self):
+        self.react('reaction_added', 'U1')
+        self.react('reaction_added', 'U1')
+        message = self.react('reaction_added', 'U2')
+        self.assertEqual([(reaction.name, reaction.count) for reaction in message.reaction],
+                         [('thumbsup', 2)])
+        message = self.react('reaction_removed', 'U1')
+        self.assertEqual([reaction.count for reaction in message.reaction], [1])
+        message = self.react('reaction_removed', 'U2')
+        self.assertEqual(message.reaction, [])
+
+    def test_unfurl_updates_the_message(self):
+        message = self.store.apply({'type': 'message', 'subtype': 'message_changed', 'channel': 'C1',
+                                    'message': {'ts': '1500000000.000100',
+                                                'attachments': [{'title': 'Eric Clapton - Cocaine'}]}})
+        self.assertEqual([attachment.title for attachment in message.attachments],
+                         ['Eric Clapton - Cocaine'])
+
+    def test_other_channels_and_deleted_messages_are_ignored(self):
+        self.assertIsNone(self.react('reaction_added', 'U1', channel='C2'))
+        self.assertIsNone(self.store.apply({'type': 'message', 'channel': 'C2', 'ts': '1.0'}))
+        self.store.apply({'type': 'message', 'subtype': 'message_deleted', 'channel': 'C1',
+                          'deleted_ts': '1500000000.000100'})
+        self.assertEqual(len(self.store), 0)
+        self.assertIsNone(self.react('reaction_added', 'U1'))
+
+    def test_old_messages_are_evicted(self):
+        self.store.evict(1500000000.0002)
+        self.assertEqual(len(self.store), 0)
+
+
+class TestReactionTracker(TestCase):
+
+    def setUp(self):
+        self.tracker = ReactionTracker()
+
+    def test_only_new_or_changed_messages_are_reported(self):
+        votes = [{'name': 'thumbsup', 'count': 1, 'users': ['U1']}]
+        self.assertTrue(self.tracker.changed(posted('1.0', reactions=votes)))
+        self.assertFalse(self.tracker.changed(posted('1.0', reactions=votes)))
+        more_votes = [{'name': 'thumbsup', 'count': 2, 'users': ['U2', 'U1']}]
+        self.assertTrue(self.tracker.changed(posted('1.0', reactions=more_votes)))
+        self.assertTrue(self.tracker.changed(posted('1.0', reactions=more_votes,
+                                                    attachments=[{'title': 'Cocaine'}])))
+        self.assertEqual(self.tracker.generation, 3)
+        self.tracker.forget('1.0')
+        self.assertNotIn('1.0', self.tracker)
+        self.assertTrue(self.tracker.changed(posted('1.0')))
+
+    def test_fingerprint_ignores_the_order_of_reactions_and_users(self):
+        votes = [{'name': 'thumbsup', 'count': 2, 'users': ['U1', 'U2']},
+                 {'name': 'fire', 'count': 1, 'users': ['U3']}]
+        shuffled = [{'name': 'fire', 'count': 1, 'users': ['U3']},
+                    {'name': 'thumbsup', 'count': 2, 'users': ['U2', 'U1']}]
+        self.assertEqual(fingerprint(posted('1.0', reactions=votes)),
+                         fingerprint(posted('1.0', reactions=shuffled)))
+
+
+class TestTrackingWindow(TestCase):
+
+    def setUp(self):
+        self.tracker = ReactionTracker()
+
+    def track(self, *timestamps):
+        for timestamp in timestamps:
+            self.tracker.changed(posted(timestamp))
+
+    def test_messages_older_than_max_age_are_evicted(self):
+        window = TrackingWindow(start_time=0, max_age=100)
+        self.track('10.0', '950.0', '990.0')
+        self.assertEqual(window.evict(self.tracker, now=1000), 1)
+        self.assertEqual(window.oldest, 900)
+        self.assertFalse(window.contains(posted('10.0')))
+        self.assertEqual(sorted(self.tracker.timestamps()), ['950.0', '990.0'])
+
+    def test_oldest_messages_beyond_max_count_are_evicted(self):
+        window = TrackingWindow(start_time=0, max_count=2)
+        self.track('3.0', '1.0', '2.0')
+        self.assertEqual(window.evict(self.tracker), 1)
+        self.assertEqual(window.oldest, 2.0)
+        self.assertTrue(window.contains(posted('2.0')))
+        self.assertNotIn('1.0', self.tracker)
+
+    def test_settled_messages_stay_out_of_the_window(self):
+        window = TrackingWindow(start_time=0)
+        self.track('5.0')
+        window.settle(posted('5.0'), self.tracker)
+        self.assertFalse(window.contains(posted('5.0')))
+        self.assertTrue(window.contains(posted('6.0')))
+        self.assertEqual(len(self.tracker), 0)
+
+
+class TestPendingUnfurls(TestCase):
+
+    def setUp(self):
+        self.unfurls = PendingUnfurls(initial=1.0, backoff=2, max_delay=3.0, max_age=10.0)
+
+    def test_messages_are_asked_for_with_growing_waits(self):
+        self.unfurls.observe(posted('1.0'), now=0)
+        self.assertEqual(self.unfurls.due(now=0.5), [])
+        self.assertEqual(self.unfurls.due(now=1), ['1.0'])
+        self.assertEqual(self.unfurls.next_due, 3)
+        self.assertEqual(self.unfurls.due(now=3), ['1.0'])
+        self.assertEqual(self.unfurls.next_due, 6)
+
+    def test_unfurled_or_linkless_messages_are_not_waited_for(self):
+        self.unfurls.observe(posted('1.0', text='no links'), now=0)
+        self.unfurls.observe(posted('2.0'), now=0)
+        self.unfurls.observe(posted('2.0', attachments=[{'title': 'Cocaine'}]), now=0)
+        self.assertEqual(len(self.unfurls), 0)
+        self.assertIsNone(self.unfurls.next_due)
+
+    def test_messages_are_given_up_on(self):
+        self.unfurls.observe(posted('1.0'), now=0)
+        self.assertEqual(self.unfurls.due(now=11), [])
+        self.assertEqual(len(self.unfurls), 0)
+
+
+class TestThreadTracker(TestCase):
+
+    def setUp(self):
+        self.threads = ThreadTracker()
+
+    def parent(self, latest_reply, ts='100.0'):
+        return posted(ts, reply_count=1, latest_reply=latest_reply)
+
+    def test_threads_are_fetched_from_the_last_reply(self):
+        self.assertFalse(self.threads.observe(posted('99.0')))
+        self.assertTrue(self.threads.observe(self.parent('101.0')))
+        self.assertFalse(self.threads.observe(self.parent('101.0')))
+        self.assertEqual(self.threads.due(), [('100.0', 0)])
+        self.threads.fetched('100.0', [posted('101.0')], [])
+        self.assertEqual(self.threads.due(), [])
+        self.threads.observe(self.parent('102.0'))
+        self.assertEqual(self.threads.due(), [('100.0', '101.0')])
+
+    def test_threads_with_open_replies_are_fetched_every_time(self):
+        self.threads.observe(self.parent('101.0'))
+        self.threads.due()
+        self.threads.fetched('100.0', [posted('101.0'), posted('102.0')], ['102.0', '101.0'])
+        self.assertEqual(self.threads.due(), [('100.0', '101.0')])
+        self.assertEqual(self.threads.due(), [('100.0', '101.0')])
+
+    def test_old_threads_are_evicted(self):
+        self.threads.observe(self.parent('101.0'))
+        self.threads.observe(self.parent('201.0', ts='200.0'))
+        self.threads.evict(150.0)
+        self.assertEqual(len(self.threads), 1)
+        self.assertEqual(self.threads.due(), [('200.0', 0)])
+
+
+def settings(token='xoxb-1', playlist='playlist', count='2'):
+    config = configparser.ConfigParser()
+    for section, options in (('slack', [('token', token), ('channel', 'general'),
+                                        ('reaction', 'thumbsup'), ('count', count)]),
+                             ('spotify', [('playlist', playlist)])):
+        config.add_section(section)
+        for option, value in options:
+            config.set(section, option, value)
+    return config
+
+
+class TestConfigWatcher(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'credentials')
+        self.write(settings())
+        self.watcher = ConfigWatcher(self.path, slacksound.get_credentials, interval=5.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, config):
+        with open(self.path, 'w') as config_file:
+            config.write(config_file)
+
+    def test_changes_are_read_once_the_interval_passed(self):
+        self.write(settings(count='10'))
+        now = time.time()
+        self.assertIsNone(self.watcher.poll(now))
+        self.assertEqual(self.watcher.poll(now + 5).get('slack', 'count'), '10')
+        self.assertIsNone(self.watcher.poll(now + 10))
+
+    def test_broken_file_keeps_the_running_configuration(self):
+        with open(self.path, 'w') as config_file:
+            config_file.write('count = 10\n')
+        self.assertIsNone(self.watcher.poll(time.time() + 5))
+
+
+class FakeClient(object):
+    """Spotify client with a fixed set of playlists"""
+
+    def __init__(self, **playlists):
+        self.playlists = playlists
+
+    def get_playlist_by_name(self, name):
+        return self.playlists.get(name)
+
+
+class TestReloadConfig(TestCase):
+
+    def setUp(self):
+        self.original = slacksound.Slack, slacksound.find_channel
+        slacksound.Slack = lambda token, **kwargs: FakeSlack()
+        slacksound.find_channel = lambda slack, name: (slack, name)
+        self.slack = FakeSlack()
+        self.playlist = FakePlaylist()
+        self.resolver = FakeResolver()
+        self.resolver.spotify = FakeClient(playlist=self.playlist)
+        self.pipeline = VotePipeline(self.slack, self.playlist, self.resolver,
+                                     Config('playlist', 'thumbsup', 'general', 2))
+        self.previous = settings()
+
+    def tearDown(self):
+        slacksound.Slack, slacksound.find_channel = self.original
+
+    def reload(self, credentials):
+        return slacksound.reload_config(self.previous, credentials, None, 'channel', self.pipeline,
+                                        self.resolver, OutboxFlusher(None, self.playlist))
+
+    def test_new_token_closes_the_previous_connection(self):
+        credentials = settings(token='xoxb-2', count='3')
+        self.assertEqual(self.reload(credentials), (credentials, (self.pipeline.slack, 'general')))
+        self.assertTrue(self.slack.closed)
+        self.assertIsNot(self.pipeline.slack, self.slack)
+        self.assertFalse(self.pipeline.slack.closed)
+        self.assertEqual(self.pipeline._config.count, 3)  # pylint: disable=protected-access
+
+    def test_unknown_playlist_keeps_the_running_configuration(self):
+        self.assertEqual(self.reload(settings(token='xoxb-2', playlist='other')),
+                         (self.previous, 'channel'))
+        self.assertIs(self.pipeline.slack, self.slack)
+        self.assertFalse(self.slack.closed)
+        self.assertIs(self.pipeline.playlist, self.playlist)
+
+    def test_playlists_created_since_they_were_listed_are_found(self):
+        original = spotifyclient.Spotify
+        spotifyclient.Spotify = FakeSpotify
+        try:
+            client = spotifyclient.SpotifyClient('id', 'secret', 'user', 'password', 'callback', 'scope')
+        finally:
+            spotifyclient.Spotify = original
+        client._spotify.playlists.append({'id': '1', 'name': 'playlist'})  # pylint: disable=protected-access
+        self.assertIsNone(client.get_playlist_by_name('other'))
+        client._spotify.playlists.append({'id': '2', 'name': 'other'})  # pylint: disable=protected-access
+        self.assertEqual(client.get_playlist_by_name('other').playlist_id, '2')
+
+
+class TestHashRing(TestCase):
+
+    def test_keys_stay_on_their_node(self):
+        keys = ['channel{}'.format(number) for number in range(200)]
+        ring = HashRing(['worker-0', 'worker-1', 'worker-2'])
+        before = dict((key, ring.node(key)) for key in keys)
+        self.assertEqual(before, dict((key, HashRing(['worker-2', 'worker-0', 'worker-1']).node(key))
+                                      for key in keys))
+        self.assertEqual(len(set(before.values())), 3)
+        grown = HashRing(['worker-0', 'worker-1', 'worker-2', 'worker-3'])
+        moved = [key for key in keys if grown.node(key) != before[key]]
+        self.assertTrue(all(grown.node(key) == 'worker-3' for key in moved))
+        self.assertLess(len(moved), len(keys) // 2)
+
+
+class TestSupervisor(TestCase):
+
+    def test_workers_left_running_see_the_new_total(self):
+        ring = HashRing(['worker-0', 'worker-1'])
+        channels = ['channel{}'.format(number) for number in range(20)]
+        first = [channel for channel in channels if ring.node(channel) == 'worker-0']
+        second = [channel for channel in channels if ring.node(channel) == 'worker-1']
+        bindings = [Config('playlist', 'thumbsup', channel, 2) for channel in (first[0], second[0])]
+        reports = multiprocessing.Queue()
+        supervisor = Supervisor(bindings, partial(report_total, reports), processes=2)
+        supervisor.start()
+        try:
+            self.assertEqual(sorted([reports.get(timeout=10), reports.get(timeout=10)]),
+                             [('worker-0', 2), ('worker-1', 2)])
+            changed = supervisor.reshard(bindings + [Config('playlist', 'thumbsup', first[1], 2)])
+            self.assertEqual(changed, ['worker-0'])
+            self.assertEqual(sorted([reports.get(timeout=10), reports.get(timeout=10)]),
+                             [('worker-0', 3), ('worker-1', 3)])
+            self.assertEqual(slacksound.get_binding_budget(50, multiprocessing.Value('i', 3)), 16)
+        finally:
+            supervisor.stop()
+
+    def test_retry_after_holds_back_every_process(self):
+        limiter = SharedRateLimiter(calls_per_second=1000.0)
+        limiter.retry_later('slack.com', 30)
+        self.assertLess(limiter.acquire(), 0.1)
+        limiter.retry_later('api.spotify.com', 0.2)
+        self.assertGreater(limiter.acquire(), 0.1)
+
+
+def report_total(reports, bindings, total):  # pylint: disable=unused-argument
+    """Worker telling its name and the total when it starts and once it changes"""
+    started = total.value
+    reports.put((multiprocessing.current_process().name, started))
+    deadline = time.time() + 10
+    while total.value == started and time.time() < deadline:
+        time.sleep(0.01)
+    reports.put((multiprocessing.current_process().name, total.value))
+
+
+class TestLogConfig(TestCase):
+
+    def record(self, message, *args, **extra):
+        record = logging.LogRecord('resolver', logging.WARNING, __file__, 1, message, args, None)
+        record.__dict__.update(extra)
+        record.created = 0
+        return record
+
+    def test_records_are_one_line_of_json_with_their_extra_fields(self):
+        line = JsonFormatter().format(self.record('Lookup for %s failed', 'Cocaine', title='Cocaine'))
+        self.assertNotIn('\n', line)
+        self.assertEqual(json.loads(line), {'time': '1970-01-01T00:00:00Z',
+                                            'level': 'WARNING',
+                                            'logger': 'resolver',
+                                            'thread': 'MainThread',
+                                            'message': 'Lookup for Cocaine failed',
+                                            'title': 'Cocaine'})
+
+    def test_exceptions_are_kept_in_the_entry(self):
+        try:
+            raise IOError('Spotify is down')
+        except IOError:
+            record = logging.LogRecord('resolver', logging.ERROR, __file__, 1, 'Failed', (), sys.exc_info())
+        self.assertIn('Spotify is down', json.loads(JsonFormatter().format(record))['exception'])
+
+    def test_levels_are_parsed_per_logger(self):
+        self.assertEqual(parse_levels(' resolver=debug, ,spotifyclient = WARNING'),
+                         {'resolver': 'DEBUG', 'spotifyclient': 'WARNING'})
+        self.assertEqual(parse_levels(''), {})